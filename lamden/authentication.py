@@ -17,11 +17,14 @@ DEFAULT_DOMAIN = '*'
 
 class SocketAuthenticator:
     def __init__(self, client: ContractingClient, ctx: zmq.asyncio.Context, bootnodes: dict={},
-                 loop=asyncio.get_event_loop(), domain='*', cert_dir=CERT_DIR, debug=False):
+                 loop=asyncio.get_event_loop(), domain='*', cert_dir=CERT_DIR, debug=False, socket_pool=None):
 
         # Create the directory if it doesn't exist
         self.client = client
 
+        # Outgoing connections to drop when a node leaves the governance set
+        self.socket_pool = socket_pool
+
         self.cert_dir = pathlib.Path.home() / cert_dir
         self.cert_dir.mkdir(parents=True, exist_ok=True)
 
@@ -73,6 +76,9 @@ class SocketAuthenticator:
 
         self.log.info(f'Refreshing keys for {len(masternode_list)} masters and {len(delegate_list)} delegates.')
 
+        if self.socket_pool is not None:
+            self.socket_pool.retain(masternode_list + delegate_list)
+
         self.authenticator.configure_curve(domain=self.domain, location=self.cert_dir)
 
     def add_verifying_key(self, vk: str):
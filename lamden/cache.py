@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import threading
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, max_size=10_000):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+        # Caches are shared between the event loop and storage executor threads
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            try:
+                value = self.items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+
+            # Evict the least recently used items once over capacity
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def add(self, key, value):
+        # Stores value only if key is not cached yet and returns whatever is cached. Fills from a slow read use this so
+        # a value set in the meantime by a writer is never replaced with the older one.
+        if self.max_size <= 0:
+            return value
+
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+
+            self.items[key] = value
+
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+            return value
+
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return self.hits / total
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate
+        }
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
@@ -1,7 +1,7 @@
 import argparse
 from lamden.cli.start import start_node, join_network
 # from lamden.cli.update import verify_access, verify_pkg, trigger, vote, check_ready_quorum
-from lamden.storage import BlockStorage
+from lamden.storage import BlockStorage, NonceStorage
 from contracting.client import ContractDriver
 
 
@@ -27,6 +27,34 @@ def flush(args):
         print('Invalid option. < blocks | state | all >')
 
 
+def indexes(args):
+    storages = [BlockStorage(), NonceStorage()]
+
+    if args.action == 'verify':
+        ok = True
+        for s in storages:
+            for collection, missing in s.missing_indexes().items():
+                if len(missing) > 0:
+                    ok = False
+                    print(f'{collection} is missing indexes: {", ".join(missing)}')
+        if ok:
+            print('All indexes present.')
+    elif args.action == 'rebuild':
+        errors = []
+        for s in storages:
+            errors.extend(s.rebuild_indexes())
+
+        for error in errors:
+            print(error)
+
+        if len(errors) > 0:
+            print('Some indexes were not rebuilt.')
+        else:
+            print('Indexes rebuilt.')
+    else:
+        print('Invalid option. < verify | rebuild >')
+
+
 def setup_cilparser(parser):
     # create parser for update commands
     subparser = parser.add_subparsers(title='subcommands', description='Network update commands',
@@ -44,6 +72,9 @@ def setup_cilparser(parser):
     flush_parser = subparser.add_parser('flush')
     flush_parser.add_argument('storage_type', type=str)
 
+    indexes_parser = subparser.add_parser('indexes')
+    indexes_parser.add_argument('action', type=str)
+
     join_parser = subparser.add_parser('join')
     join_parser.add_argument('node_type', type=str)
     join_parser.add_argument('-k', '--key', type=str)
@@ -70,6 +101,9 @@ def main():
     elif args.command == 'flush':
         flush(args)
 
+    elif args.command == 'indexes':
+        indexes(args)
+
     elif args.command == 'join':
         join_network(args)
 
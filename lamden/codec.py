@@ -0,0 +1,309 @@
+import decimal
+from contracting.db.encoder import encode, decode
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+from contracting.stdlib.bridge.time import Datetime, Timedelta
+from lamden.logger.base import get_logger
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = get_logger('Codec')
+
+'''
+Router messages are sent either as a single frame of JSON (the original format, understood by every peer) or as two
+frames: a header naming the codec and the encoded payload. A peer only receives the two frame format after it has
+advertised the codec with a 'codecs' list in one of its own messages.
+
+A codec name can carry a compression suffix, e.g. 'msgpack+zstd'. Payloads under COMPRESSION_THRESHOLD bytes are sent
+with the plain header ('msgpack') so small messages skip compression entirely.
+'''
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+ZSTD = 'zstd'
+
+COMPRESSION_THRESHOLD = 1024
+
+# Refuse to inflate anything claiming to be larger than this
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+# msgpack extension codes for the contracting types that JSON encodes as tagged dicts
+DECIMAL = 1
+DATETIME = 2
+TIMEDELTA = 3
+
+
+class Codec:
+    name = None
+
+    def encode(self, msg):
+        raise NotImplementedError
+
+    def decode(self, payload):
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = JSON
+
+    def encode(self, msg):
+        return encode(msg).encode()
+
+    def decode(self, payload):
+        return decode(payload)
+
+
+def default(o):
+    if isinstance(o, (ContractingDecimal, decimal.Decimal)):
+        return msgpack.ExtType(DECIMAL, str(o).encode())
+
+    if isinstance(o, Datetime):
+        d = o._datetime
+        return msgpack.ExtType(DATETIME, msgpack.packb([
+            d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond
+        ]))
+
+    if isinstance(o, Timedelta):
+        t = o._timedelta
+        return msgpack.ExtType(TIMEDELTA, msgpack.packb([t.days, t.seconds]))
+
+    raise TypeError(f'Cannot encode {type(o)}')
+
+
+def ext_hook(code, data):
+    if code == DECIMAL:
+        return ContractingDecimal(data.decode())
+
+    if code == DATETIME:
+        return Datetime(*msgpack.unpackb(data))
+
+    if code == TIMEDELTA:
+        days, seconds = msgpack.unpackb(data)
+        return Timedelta(days=days, seconds=seconds)
+
+    return msgpack.ExtType(code, data)
+
+
+class MsgpackCodec(Codec):
+    name = MSGPACK
+
+    def encode(self, msg):
+        return msgpack.packb(msg, default=default, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, ext_hook=ext_hook, raw=False, strict_map_key=False)
+
+
+CODECS = {
+    JSON: JSONCodec()
+}
+
+if msgpack is not None:
+    CODECS[MSGPACK] = MsgpackCodec()
+
+
+# Compression dictionaries are built from these rather than trained, so every peer derives byte for byte the same
+# dictionary from the code it runs. They follow the shape of blocks, work batches and contenders on the wire.
+HASH = '0' * 64
+SIGNATURE = '0' * 128
+
+SAMPLE_TRANSACTION = {
+    'metadata': {
+        'signature': SIGNATURE,
+        'timestamp': 0
+    },
+    'payload': {
+        'contract': 'currency',
+        'function': 'transfer',
+        'kwargs': {
+            'amount': 0,
+            'to': HASH
+        },
+        'nonce': 0,
+        'processor': HASH,
+        'sender': HASH,
+        'stamps_supplied': 0
+    }
+}
+
+SAMPLE_SUBBLOCK = {
+    'input_hash': HASH,
+    'merkle_tree': {
+        'leaves': [HASH],
+        'signature': SIGNATURE
+    },
+    'previous': HASH,
+    'signer': HASH,
+    'subblock': 0,
+    'transactions': [{
+        'hash': HASH,
+        'result': 'None',
+        'stamps_used': 0,
+        'state': [{
+            'key': f'currency.balances:{HASH}',
+            'value': 0
+        }],
+        'status': 0,
+        'transaction': SAMPLE_TRANSACTION
+    }]
+}
+
+SAMPLES = [
+    {
+        'input_hash': HASH,
+        'sender': HASH,
+        'signature': SIGNATURE,
+        'timestamp': 0,
+        'transactions': [SAMPLE_TRANSACTION]
+    },
+    [SAMPLE_SUBBLOCK],
+    {
+        'hash': HASH,
+        'number': 0,
+        'previous': HASH,
+        'subblocks': [SAMPLE_SUBBLOCK]
+    }
+]
+
+
+class ZstdCompressor:
+    name = ZSTD
+
+    def __init__(self, codec: Codec, level=3):
+        # Raw content dictionary: the most recent bytes get the cheapest references, so the block sample goes last
+        content = b''.join(codec.encode(sample) for sample in SAMPLES)
+        self.dictionary = zstandard.ZstdCompressionDict(content, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=self.dictionary)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, payload):
+        compressed = self.compressor.compress(payload)
+
+        self.messages += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(compressed)
+
+        return compressed
+
+    def decompress(self, payload):
+        size = zstandard.frame_content_size(payload)
+        if size < 0 or size > MAX_DECOMPRESSED_SIZE:
+            raise ValueError(f'Refusing to decompress {size} bytes.')
+
+        return self.decompressor.decompress(payload)
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    @property
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_saved
+        }
+
+
+# Keyed by the full codec name, e.g. 'msgpack+zstd'
+COMPRESSORS = {}
+
+if zstandard is not None:
+    for base in list(CODECS.keys()):
+        COMPRESSORS[f'{base}+{ZSTD}'] = ZstdCompressor(CODECS[base])
+
+# Most preferred first. JSON is always understood so it is never advertised.
+PREFERENCE = [f'{MSGPACK}+{ZSTD}', MSGPACK, f'{JSON}+{ZSTD}']
+
+
+def supported(name):
+    if not isinstance(name, str):
+        return False
+
+    if '+' in name:
+        return name in COMPRESSORS
+
+    return name in CODECS
+
+
+def available():
+    return [name for name in PREFERENCE if supported(name)]
+
+
+def negotiate(offered):
+    if not isinstance(offered, list):
+        return JSON
+
+    for name in available():
+        if name in offered:
+            return name
+
+    return JSON
+
+
+def pack(msg, codec_name=None):
+    if codec_name is None or codec_name == JSON:
+        return [CODECS[JSON].encode(msg)]
+
+    base = codec_name.split('+')[0]
+
+    try:
+        payload = CODECS[base].encode(msg)
+    except (KeyError, TypeError, OverflowError, ValueError):
+        # Ints past 64 bits and unknown types still go out, just as JSON
+        return [CODECS[JSON].encode(msg)]
+
+    compressor = COMPRESSORS.get(codec_name)
+    if compressor is not None and len(payload) >= COMPRESSION_THRESHOLD:
+        return [codec_name.encode(), compressor.compress(payload)]
+
+    if base == JSON:
+        return [payload]
+
+    return [base.encode(), payload]
+
+
+def unpack(frames):
+    if len(frames) == 1:
+        return CODECS[JSON].decode(frames[0])
+
+    name, payload = header(frames), frames[-1]
+
+    codec = CODECS.get(name.split('+')[0])
+    if codec is None or ('+' in name and name not in COMPRESSORS):
+        logger.debug(f'Unknown codec {name}.')
+        return None
+
+    try:
+        if '+' in name:
+            payload = COMPRESSORS[name].decompress(payload)
+
+        return codec.decode(payload)
+    except Exception:
+        logger.debug(f'Could not decode {name} payload.')
+        return None
+
+
+def compression_stats():
+    return {name: compressor.stats for name, compressor in COMPRESSORS.items()}
+
+
+def header(frames):
+    # Name of the codec used for a received message
+    if len(frames) == 1:
+        return JSON
+
+    return frames[0].decode(errors='ignore')
@@ -1,6 +1,6 @@
 import time
 
-from lamden.crypto.canonical import format_dictionary
+from lamden.crypto.canonical import format_dictionary, tx_hash_from_tx
 from lamden.formatting import check_format, rules, primatives
 from contracting.db.encoder import encode
 from lamden import storage
@@ -48,6 +48,10 @@ class TransactionFormattingError(TransactionException):
     pass
 
 
+class TransactionExpired(TransactionException):
+    pass
+
+
 EXCEPTION_MAP = {
     TransactionNonceInvalid: {'error': 'Transaction nonce is invalid.'},
     TransactionProcessorInvalid: {'error': 'Transaction processor does not match expected processor.'},
@@ -57,25 +61,56 @@ EXCEPTION_MAP = {
     TransactionSignatureInvalid: {'error': 'Transaction is not signed by the sender.'},
     TransactionStampsNegative: {'error': 'Transaction has negative stamps supplied.'},
     TransactionException: {'error': 'Another error has occured.'},
-    TransactionFormattingError: {'error': 'Transaction is not formatted properly.'}
+    TransactionFormattingError: {'error': 'Transaction is not formatted properly.'},
+    TransactionExpired: {'error': 'Transaction timestamp is too old. Submit with a current timestamp.'}
 }
 
 
-def check_tx_formatting(tx: dict, expected_processor: str):
+def signature_triple(tx: dict):
+    # (vk, msg, signature) to check with wallet.verify_many. None for anything malformed, which fails verification.
+    try:
+        return tx['payload']['sender'], encode(tx['payload']), tx['metadata']['signature']
+    except (KeyError, TypeError):
+        return None
+
+
+def check_tx_formatting(tx: dict, expected_processor: str, signature_valid=None):
     if not check_format(tx, rules.TRANSACTION_RULES):
         raise TransactionFormattingError
 
-    if not wallet.verify(
+    # Callers that verified a whole batch of signatures at once pass the result in
+    if signature_valid is None:
+        signature_valid = wallet.verify(
             tx['payload']['sender'],
             encode(tx['payload']),
             tx['metadata']['signature']
-    ):
+        )
+
+    if not signature_valid:
         raise TransactionSignatureInvalid
 
     if tx['payload']['processor'] != expected_processor:
         raise TransactionProcessorInvalid
 
 
+def check_tx_batch(txs: list, expected_processor: str):
+    # The checks that need no nonce or contract state, for a whole batch. Module level so it can run on a process pool.
+    # Returns (exception class or None, tx hash) for each transaction.
+    signed = wallet.verify_many([signature_triple(tx) for tx in txs])
+
+    results = []
+    for tx, signature_valid in zip(txs, signed):
+        try:
+            check_tx_formatting(tx, expected_processor, signature_valid=signature_valid)
+        except TransactionException as e:
+            results.append((type(e), None))
+            continue
+
+        results.append((None, tx_hash_from_tx(tx)))
+
+    return results
+
+
 def get_nonces(sender, processor, driver: storage.NonceStorage):
     nonce = driver.get_nonce(
         processor=processor,
@@ -169,7 +204,7 @@ def build_transaction(wallet, contract: str, function: str, kwargs: dict, nonce:
 
 # Run through all tests
 def transaction_is_valid(transaction, expected_processor, client: ContractingClient, nonces: storage.NonceStorage, strict=True,
-                         tx_per_block=15, timeout=5):
+                         tx_per_block=15, timeout=5, signature_valid=None):
     # Check basic formatting so we can access via __getitem__ notation without errors
     if not check_format(transaction, rules.TRANSACTION_RULES):
         return TransactionFormattingError
@@ -181,7 +216,7 @@ def transaction_is_valid(transaction, expected_processor, client: ContractingCli
     sender = transaction['payload']['sender']
 
     # Checks if correct processor and if signature is valid
-    check_tx_formatting(transaction, expected_processor)
+    check_tx_formatting(transaction, expected_processor, signature_valid=signature_valid)
 
     # Gets the expected nonces
     nonce, pending_nonce = get_nonces(sender, processor, nonces)
@@ -3,22 +3,142 @@ import nacl.encoding
 import nacl.signing
 from zmq.utils import z85
 import secrets
+import asyncio
+import hashlib
+from lamden.cache import LRUCache
 from . import zbase
 
+# Parsed verifying keys by hex string. Senders and signers repeat, so most lookups skip parsing.
+VERIFY_KEYS = LRUCache(max_size=10_000)
+
+# Digests of (vk, msg, signature) triples that have verified. Keys are 32 bytes, so max_size bounds memory to about
+# 200 bytes an entry. Only successes are stored, so a flood of bad signatures cannot push out good ones.
+VERIFIED = LRUCache(max_size=100_000)
+
+# Signatures per chunk when a batch is spread over an executor
+VERIFY_CHUNK_SIZE = 250
+
+
+def get_verify_key(vk: str):
+    key = VERIFY_KEYS.get(vk, None)
+
+    if key is None:
+        key = nacl.signing.VerifyKey(bytes.fromhex(vk))
+        VERIFY_KEYS.set(vk, key)
+
+    return key
+
+
+def signature_digest(vk: str, msg: str, signature: str):
+    h = hashlib.sha3_256()
+
+    # Lengths first so that no other split of the same characters gives the same digest
+    h.update(f'{len(vk)}:{len(signature)}:'.encode())
+    h.update(vk.encode())
+    h.update(signature.encode())
+    h.update(msg.encode())
+
+    return h.digest()
+
 
 def verify(vk: str, msg: str, signature: str):
-    vk = bytes.fromhex(vk)
+    digest = signature_digest(vk, msg, signature)
+    if VERIFIED.get(digest, False):
+        return True
+
     msg = msg.encode()
     signature = bytes.fromhex(signature)
 
-    vk = nacl.signing.VerifyKey(vk)
+    vk = get_verify_key(vk)
     try:
         vk.verify(msg, signature)
     except nacl.exceptions.BadSignatureError:
         return False
+
+    VERIFIED.set(digest, True)
     return True
 
 
+def verify_chunk(triples: list):
+    # Module level so it can be sent to a process pool. Malformed triples (or None) count as invalid.
+    results = []
+    for triple in triples:
+        try:
+            results.append(verify(*triple))
+        except (TypeError, ValueError, AttributeError, nacl.exceptions.CryptoError):
+            results.append(False)
+
+    return results
+
+
+def cached_results(triples: list):
+    # True for triples already verified, None for the ones still to check
+    results = []
+    for triple in triples:
+        try:
+            results.append(True if VERIFIED.get(signature_digest(*triple), False) else None)
+        except (TypeError, AttributeError):
+            results.append(None)
+
+    return results
+
+
+def remember(triples: list, results: list):
+    # Worker processes have their own caches, so results coming back from them are recorded here
+    for triple, valid in zip(triples, results):
+        if valid:
+            VERIFIED.set(signature_digest(*triple), True)
+
+
+def chunk(triples: list, size=VERIFY_CHUNK_SIZE):
+    return [triples[i:i + size] for i in range(0, len(triples), size)]
+
+
+def verify_many(triples: list, executor=None):
+    # Verifies a list of (vk, msg, signature) triples and returns a list of bools in the same order
+    if executor is None or len(triples) <= VERIFY_CHUNK_SIZE:
+        return verify_chunk(triples)
+
+    results = cached_results(triples)
+    misses = [i for i in range(len(triples)) if results[i] is None]
+    unchecked = [triples[i] for i in misses]
+
+    checked = []
+    for chunk_results in executor.map(verify_chunk, chunk(unchecked)):
+        checked.extend(chunk_results)
+
+    remember(unchecked, checked)
+
+    for i, valid in zip(misses, checked):
+        results[i] = valid
+
+    return results
+
+
+async def verify_many_async(triples: list, executor=None):
+    # Same as verify_many, but the chunks run on the executor without blocking the event loop
+    if executor is None or len(triples) <= VERIFY_CHUNK_SIZE:
+        return verify_chunk(triples)
+
+    results = cached_results(triples)
+    misses = [i for i in range(len(triples)) if results[i] is None]
+    unchecked = [triples[i] for i in misses]
+
+    loop = asyncio.get_event_loop()
+    chunk_results = await asyncio.gather(*[
+        loop.run_in_executor(executor, verify_chunk, c) for c in chunk(unchecked)
+    ])
+
+    checked = [result for results in chunk_results for result in results]
+
+    remember(unchecked, checked)
+
+    for i, valid in zip(misses, checked):
+        results[i] = valid
+
+    return results
+
+
 class Wallet:
     def __init__(self, seed=None):
         if isinstance(seed, str):
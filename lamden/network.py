@@ -77,10 +77,11 @@ class PeerProcessor(router.Processor):
 
 
 class JoinProcessor(router.Processor):
-    def __init__(self, ctx, peers, wallet):
+    def __init__(self, ctx, peers, wallet, pool: router.SocketPool=None):
         self.ctx = ctx
         self.peers = peers
         self.wallet = wallet
+        self.pool = pool
 
     async def process_message(self, msg):
         # Send ping to peer server to verify
@@ -100,7 +101,8 @@ class JoinProcessor(router.Processor):
         #     return
 
         if msg.get('vk') not in self.peers or self.peers[msg.get('vk')] != msg.get('ip'):
-            await router.secure_multicast(msg=msg, service=JOIN_SERVICE, peer_map=self.peers, ctx=self.ctx, wallet=self.wallet)
+            await router.secure_multicast(msg=msg, service=JOIN_SERVICE, peer_map=self.peers, ctx=self.ctx, wallet=self.wallet,
+                                          pool=self.pool)
 
         self.peers[msg.get('vk')] = msg.get('ip')
 
@@ -114,10 +116,14 @@ class JoinProcessor(router.Processor):
 # }
 
 class Network:
-    def __init__(self, wallet: Wallet, ip_string: str, ctx: zmq.asyncio.Context, router: router.Router, pepper: str=PEPPER):
+    def __init__(self, wallet: Wallet, ip_string: str, ctx: zmq.asyncio.Context, router: router.Router, pepper: str=PEPPER,
+                 pool=None):
         self.wallet = wallet
         self.ctx = ctx
 
+        # Shared connections so that join and identity requests to the same peer are multiplexed on one socket
+        self.pool = pool
+
         self.peers = {
             self.wallet.verifying_key: ip_string
         }
@@ -125,7 +131,7 @@ class Network:
         # Add processors to router to accept and process networking messages
         self.ip = ip_string
         self.vk = self.wallet.verifying_key
-        self.join_processor = JoinProcessor(ctx=self.ctx, peers=self.peers, wallet=self.wallet)
+        self.join_processor = JoinProcessor(ctx=self.ctx, peers=self.peers, wallet=self.wallet, pool=self.pool)
         self.identity_processor = IdentityProcessor(wallet=self.wallet, ip_string=ip_string, pepper=pepper)
         self.peer_processor = PeerProcessor(peers=self.peers)
         self.log = get_logger('Peers')
@@ -148,7 +154,7 @@ class Network:
         while not self.all_vks_found(vks):
 
             coroutines = [router.secure_request(msg=self.join_msg, service=JOIN_SERVICE, wallet=self.wallet,
-                                                ctx=self.ctx, ip=ip, vk=vk) for vk, ip, in bootnodes.items()]
+                                                ctx=self.ctx, ip=ip, vk=vk, pool=self.pool) for vk, ip, in bootnodes.items()]
 
             results = await asyncio.gather(*coroutines)
 
@@ -158,12 +164,14 @@ class Network:
 
                 self.log.info(result)
 
-                for peer in result['peers']:
-
-                    response = await router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet,
-                                                           vk=peer.get('vk'),
-                                                           ip=peer.get('ip'), ctx=self.ctx)
+                # Check the identity of every returned peer at the same time
+                peers = result['peers']
+                responses = await asyncio.gather(*[
+                    router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet, vk=peer.get('vk'),
+                                          ip=peer.get('ip'), ctx=self.ctx, pool=self.pool) for peer in peers
+                ])
 
+                for peer, response in zip(peers, responses):
                     if response is None:
                         LOGGER.error(f'No response for identity proof for {peer.get("ip")}')
                         continue
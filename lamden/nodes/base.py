@@ -6,11 +6,15 @@ from contracting.db.driver import ContractDriver, encode
 import lamden
 import zmq.asyncio
 import asyncio
+import itertools
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contracting.client import ContractingClient
 import uvloop
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 import gc
+import time
 from lamden.logger.base import get_logger
 
 
@@ -20,10 +24,11 @@ WORK_SERVICE = 'work'
 CONTENDER_SERVICE = 'contenders'
 
 GET_BLOCK = 'get_block'
+GET_BLOCKS = 'get_blocks'
 GET_HEIGHT = 'get_height'
 
 
-async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
+async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context, pool: router.SocketPool=None):
     msg = {
         'name': GET_HEIGHT,
         'arg': ''
@@ -36,12 +41,13 @@ async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asy
         service=BLOCK_SERVICE,
         msg=msg,
         ctx=ctx,
+        pool=pool
     )
 
     return response
 
 
-async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
+async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context, pool: router.SocketPool=None):
     msg = {
         'name': GET_BLOCK,
         'arg': block_num
@@ -54,32 +60,73 @@ async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.a
         service=BLOCK_SERVICE,
         msg=msg,
         ctx=ctx,
+        pool=pool
     )
 
     return response
 
 
-class NewBlock(router.Processor):
-    def __init__(self, driver: ContractDriver):
-        self.q = []
+async def get_blocks(start: int, count: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context, pool: router.SocketPool=None):
+    msg = {
+        'name': GET_BLOCKS,
+        'arg': {
+            'start': start,
+            'count': count
+        }
+    }
+
+    response = await router.secure_request(
+        ip=ip,
+        vk=vk,
+        wallet=wallet,
+        service=BLOCK_SERVICE,
+        msg=msg,
+        ctx=ctx,
+        pool=pool
+    )
+
+    return response
+
+
+class NewBlock(router.Inbox):
+    def __init__(self, driver: ContractDriver, max_size=1_000):
+        super().__init__(max_size=max_size)
         self.driver = driver
         self.log = get_logger('NBN')
 
-    async def process_message(self, msg):
-        self.q.append(msg)
-
     async def wait_for_next_nbn(self):
-        while len(self.q) <= 0:
-            await asyncio.sleep(0)
+        await self.wait()
+
+        # Only the oldest notification matters. The rest are dropped with it.
+        return self.drain()[0]
 
-        nbn = self.q.pop(0)
+    def put(self, nbn):
+        if self.max_size is None or self.size() < self.max_size:
+            return super().put(nbn)
 
-        self.q.clear()
+        # Full. Keep the notifications closest to the current height and drop the furthest one, which may be the new
+        # one.
+        furthest = max(itertools.chain(self.ready, self.q), key=lambda queued: queued['number'])
 
-        return nbn
+        if nbn['number'] >= furthest['number']:
+            self.dropped += 1
+            return False
+
+        if furthest in self.q:
+            self.q.remove(furthest)
+        else:
+            self.ready.remove(furthest)
+
+        self.dropped += 1
+
+        return super().put(nbn)
 
     def clean(self, height):
+        if self.size() == 0:
+            return
+
         self.q = [nbn for nbn in self.q if nbn['number'] > height]
+        self.ready = deque(nbn for nbn in self.ready if nbn['number'] > height)
 
 
 def ensure_in_constitution(verifying_key: str, constitution: dict):
@@ -93,9 +140,18 @@ def ensure_in_constitution(verifying_key: str, constitution: dict):
 
 
 class Node:
-    def __init__(self, socket_base, ctx: zmq.asyncio.Context, wallet, constitution: dict, bootnodes={}, blocks=storage.BlockStorage(),
+    def __init__(self, socket_base, ctx: zmq.asyncio.Context, wallet, constitution: dict, bootnodes={}, blocks=None,
                  driver=ContractDriver(), debug=True, store=False, seed=None, bypass_catchup=False, node_type=None,
-                 genesis_path=lamden.contracts.__path__[0], reward_manager=rewards.RewardManager(), nonces=storage.NonceStorage()):
+                 genesis_path=lamden.contracts.__path__[0], reward_manager=rewards.RewardManager(), nonces=None,
+                 catchup_window=16, catchup_batch_size=64, catchup_attempts=3, storage_workers=4):
+
+        # Storage is created here rather than as a default argument so that importing this module does not
+        # connect to Mongo before it has been started
+        if blocks is None:
+            blocks = storage.BlockStorage()
+
+        if nonces is None:
+            nonces = storage.NonceStorage()
 
         self.driver = driver
         self.nonces = nonces
@@ -105,6 +161,9 @@ class Node:
 
         self.blocks = blocks
 
+        # Threads that the node's async storage wrappers run Mongo calls on. Shut down when the node stops.
+        self.storage_executor = ThreadPoolExecutor(max_workers=storage_workers)
+
         self.log = get_logger('Base')
         self.log.propagate = debug
         self.socket_base = socket_base
@@ -127,6 +186,11 @@ class Node:
             bootnodes=self.bootnodes, ctx=self.ctx, client=self.client
         )
 
+        # Warm CURVE connections to peers, on the authenticator's certificates and pruned whenever the governance
+        # sockets are refreshed
+        self.socket_pool = router.SocketPool(ctx=self.ctx, wallet=self.wallet, cert_dir=self.socket_authenticator.cert_dir)
+        self.socket_authenticator.socket_pool = self.socket_pool
+
         self.upgrade_manager = upgrade.UpgradeManager(client=self.client, wallet=self.wallet, node_type=node_type)
 
         self.router = router.Router(
@@ -140,7 +204,8 @@ class Node:
             wallet=wallet,
             ip_string=socket_base,
             ctx=self.ctx,
-            router=self.router
+            router=self.router,
+            pool=self.socket_pool
         )
 
         self.new_block_processor = NewBlock(driver=self.driver)
@@ -156,6 +221,11 @@ class Node:
 
         self.bypass_catchup = bypass_catchup
 
+        # Number of batch requests kept in flight during catchup, blocks per batch and retries per batch
+        self.catchup_window = catchup_window
+        self.catchup_batch_size = catchup_batch_size
+        self.catchup_attempts = catchup_attempts
+
     def seed_genesis_contracts(self):
         self.log.info('Setting up genesis contracts.')
         sync.setup_genesis_contracts(
@@ -174,7 +244,8 @@ class Node:
             ip=mn_seed,
             vk=mn_vk,
             wallet=self.wallet,
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.socket_pool
         )
 
         self.log.info(f'Current block: {current}, Latest available block: {latest}')
@@ -188,21 +259,136 @@ class Node:
             current = 1
 
         # Find the missing blocks process them
-        for i in range(current, latest + 1):
-            block = await get_block(
-                block_num=i,
-                ip=mn_seed,
-                vk=mn_vk,
-                wallet=self.wallet,
-                ctx=self.ctx
-            )
-            self.process_new_block(block)
+        await self.fetch_and_process_blocks(
+            start=current,
+            end=latest,
+            peers=self.catchup_peers(mn_seed=mn_seed, mn_vk=mn_vk)
+        )
 
         # Process any blocks that were made while we were catching up
-        while len(self.new_block_processor.q) > 0:
-            block = self.new_block_processor.q.pop(0)
+        for block in self.new_block_processor.drain():
             self.process_new_block(block)
 
+    def catchup_peers(self, mn_seed, mn_vk):
+        # The seed is always asked first. Other known masternodes share the load.
+        peers = [(mn_vk, mn_seed)]
+
+        for vk, ip in self.get_masternode_peers().items():
+            if vk != mn_vk and vk != self.wallet.verifying_key:
+                peers.append((vk, ip))
+
+        return peers
+
+    async def request_block(self, block_num, peer):
+        vk, ip = peer
+        block = await get_block(
+            block_num=block_num,
+            ip=ip,
+            vk=vk,
+            wallet=self.wallet,
+            ctx=self.ctx,
+            pool=self.socket_pool
+        )
+
+        # Peers answer with an OK message if they do not have the block
+        if not isinstance(block, dict) or block.get('number') != block_num:
+            return None
+
+        return block
+
+    async def request_blocks(self, start, count, peer):
+        vk, ip = peer
+        blocks = await get_blocks(
+            start=start,
+            count=count,
+            ip=ip,
+            vk=vk,
+            wallet=self.wallet,
+            ctx=self.ctx,
+            pool=self.socket_pool
+        )
+
+        # Peers that do not know get_blocks answer with an OK message. Fall back to a single block.
+        if not isinstance(blocks, list):
+            block = await self.request_block(start, peer)
+            return [] if block is None else [block]
+
+        # Keep the consecutive run that starts at the requested height
+        run = []
+        for block in blocks:
+            if not isinstance(block, dict) or block.get('number') != start + len(run):
+                break
+            run.append(block)
+
+        return run
+
+    async def fetch_and_process_blocks(self, start, end, peers):
+        # Keeps up to catchup_window batch requests in flight, buffers responses by height and applies them in order
+        in_flight = {}
+        buffered = {}
+
+        next_request = start
+        next_apply = start
+
+        total = end - start + 1
+        started = time.time()
+        last_log = started
+
+        def request(batch_start, count, attempt):
+            peer = peers[(batch_start // self.catchup_batch_size + attempt - 1) % len(peers)]
+            task = asyncio.ensure_future(self.request_blocks(batch_start, count, peer))
+            in_flight[batch_start] = (task, count, attempt)
+
+        while next_apply <= end:
+            # Bound the work ahead of the next block to apply so a slow batch cannot grow the buffer forever
+            while next_request <= end and len(in_flight) < self.catchup_window and \
+                    next_request - next_apply < self.catchup_window * self.catchup_batch_size:
+                count = min(self.catchup_batch_size, end - next_request + 1)
+                request(next_request, count, 1)
+                next_request += count
+
+            await asyncio.wait([t for t, _, _ in in_flight.values()], return_when=asyncio.FIRST_COMPLETED)
+
+            for batch_start, (task, count, attempt) in list(in_flight.items()):
+                if not task.done():
+                    continue
+
+                del in_flight[batch_start]
+                blocks = task.result()
+
+                for block in blocks:
+                    buffered[block['number']] = block
+
+                if len(blocks) == count:
+                    continue
+
+                # Nothing came back. Retry on the next peer.
+                if len(blocks) == 0:
+                    if attempt >= self.catchup_attempts:
+                        self.log.error(f'Could not get block #{batch_start} after {attempt} attempts. Stopping catchup.')
+                        for t, _, _ in in_flight.values():
+                            t.cancel()
+                        return
+
+                    request(batch_start, count, attempt + 1)
+
+                # A partial batch (byte budget reached) continues where it stopped
+                else:
+                    request(batch_start + len(blocks), count - len(blocks), 1)
+
+            while next_apply in buffered:
+                self.process_new_block(buffered.pop(next_apply))
+                next_apply += 1
+
+            if time.time() - last_log > 5:
+                done = next_apply - start
+                self.log.info(f'Catchup: {done}/{total} blocks, {done / (time.time() - started):.1f} blocks/s, '
+                              f'{len(in_flight)} requests in flight, {len(buffered)} buffered.')
+                last_log = time.time()
+
+        elapsed = time.time() - started
+        self.log.info(f'Caught up {total} blocks in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.1f} blocks/s).')
+
     def should_process(self, block):
         self.log.info(f'Processing block #{block["number"]}')
         # Test if block failed immediately
@@ -239,10 +425,12 @@ class Node:
         return good
 
     def update_state(self, block):
+        # Returns True if the block was valid and applied
         self.driver.clear_pending_state()
 
         # Check if the block is valid
-        if self.should_process(block):
+        processed = self.should_process(block)
+        if processed:
             self.log.info('Storing new block.')
             # Commit the state changes and nonces to the database
             storage.update_state_with_block(
@@ -264,17 +452,17 @@ class Node:
 
         self.new_block_processor.clean(self.current_height)
 
+        return processed
+
     def process_new_block(self, block):
         # Update the state and refresh the sockets so new nodes can join
-        self.update_state(block)
+        processed = self.update_state(block)
         self.socket_authenticator.refresh_governance_sockets()
 
-        # Store the block if it's a masternode
-        if self.store:
-            encoded_block = encode(block)
-            encoded_block = json.loads(encoded_block)
-
-            self.blocks.store_block(encoded_block)
+        # Store the block if it's a masternode. Rejected blocks are never stored, so they cannot take the place of the
+        # valid block at their height.
+        if self.store and processed:
+            self.store_block(block)
 
         # Prepare for the next block by flushing out driver and notification state
         # self.new_block_processor.clean()
@@ -285,6 +473,12 @@ class Node:
         gc.collect() # Force memory cleanup every block
         #self.nonces.flush_pending()
 
+    def store_block(self, block):
+        encoded_block = encode(block)
+        encoded_block = json.loads(encoded_block)
+
+        self.blocks.store_block(encoded_block)
+
     async def start(self):
         asyncio.ensure_future(self.router.serve())
 
@@ -327,8 +521,15 @@ class Node:
     def stop(self):
         # Kill the router and throw the running flag to stop the loop
         self.router.stop()
+        self.socket_pool.close()
         self.running = False
 
+        # Calls already queued still run, so blocks being stored are not cut off
+        self.storage_executor.shutdown(wait=False)
+
+        # Wakes up anything waiting on blocks so it sees that the node stopped
+        self.new_block_processor.notify()
+
     def _get_member_peers(self, contract_name):
         members = self.client.get_var(
             contract=contract_name,
@@ -4,18 +4,46 @@ from lamden.nodes import base
 from lamden.logger.base import get_logger
 import asyncio
 import time
-from lamden.crypto.wallet import verify
+from lamden.crypto.wallet import verify, verify_many_async
 from contracting.execution.executor import Executor
-from lamden.crypto import transaction
+from lamden.crypto import transaction, canonical
 from contracting.client import ContractingClient
 from lamden import storage
+from lamden.timing import AdaptiveTimeout
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 WORK_SERVICE = 'work'
 
 
-class WorkProcessor(router.Processor):
+def predict_block(subblocks, previous_hash, block_num):
+    # Hash of the block the masters produce from these subblocks if they agree with them. Signatures are left out of
+    # the block hash, so it can be computed before any are collected.
+    expected = canonical.block_from_subblocks(
+        subblocks=[{
+            'input_hash': sb['input_hash'],
+            'transactions': sb['transactions'],
+            'merkle_leaves': sb['merkle_tree']['leaves'],
+            'subblock': sb['subblock'],
+            'signatures': []
+        } for sb in subblocks],
+        previous_hash=previous_hash,
+        block_num=block_num
+    )
+
+    return expected['hash']
+
+
+class WorkProcessor(router.Inbox):
     def __init__(self, client: ContractingClient, nonces: storage.NonceStorage, debug=True, expired_batch=5,
-                 tx_timeout=5):
+                 tx_timeout=5, executor=None, on_work=None, batch_timeout=10):
+        super().__init__()
+
+        # Large batches have their signatures checked in chunks on this executor when one is given
+        self.executor = executor
+
+        # Called with every batch added, e.g. to pre-execute it
+        self.on_work = on_work
+
         self.new_work = defaultdict(list)
 
         self.log = get_logger('Work Inbox')
@@ -25,6 +53,9 @@ class WorkProcessor(router.Processor):
         self.expired_batch = expired_batch
         self.tx_timeout = tx_timeout
 
+        # Learns how far behind the first batch of a round the other masters' batches arrive
+        self.timing = AdaptiveTimeout(initial=batch_timeout, maximum=batch_timeout)
+
         self.client = client
         self.nonces = nonces
 
@@ -44,16 +75,21 @@ class WorkProcessor(router.Processor):
 
         if not verify(vk=msg['sender'], msg=msg['input_hash'], signature=msg['signature']):
             self.log.error(f'Invalidly signed TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            return self.add_work(shim)
 
         if int(time.time()) - msg['timestamp'] > self.expired_batch:
             self.log.error(f'Expired TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            return self.add_work(shim)
 
         # Add padded!
         # Iterate and delete transactions from list that fail
+        signed = await verify_many_async(
+            [transaction.signature_triple(tx) for tx in msg['transactions']],
+            executor=self.executor
+        )
+
         good_transactions = []
-        for tx in msg['transactions']:
+        for tx, signature_valid in zip(msg['transactions'], signed):
             try:
                 transaction.transaction_is_valid(
                     transaction=tx,
@@ -61,7 +97,8 @@ class WorkProcessor(router.Processor):
                     client=self.client,
                     nonces=self.nonces,
                     strict=False,
-                    timeout=self.expired_batch + self.tx_timeout
+                    timeout=self.expired_batch + self.tx_timeout,
+                    signature_valid=signature_valid
                 )
                 good_transactions.append(tx)
             except transaction.TransactionException as e:
@@ -70,28 +107,62 @@ class WorkProcessor(router.Processor):
         # Replace transactions with ones that do not pass.
         msg['transactions'] = good_transactions
 
-        self.new_work[msg['sender']].append(msg)
+        self.add_work(msg)
         self.log.info(f'{msg["sender"][:8]} has {len(self.new_work[msg["sender"]])} batches of work to do.')
 
-    async def gather_transaction_batches(self, masters: list, timeout=10):
+    def add_work(self, msg):
+        self.new_work[msg['sender']].append(msg)
+        self.notify()
+
+        if self.on_work is not None:
+            self.on_work(msg)
+
+    def pending_work(self):
+        for batches in self.new_work.values():
+            yield from batches
+
+    def drop_stale(self, master, height):
+        # Batches tagged for a block at or below height were meant for a round that is already over
+        batches = self.new_work[master]
+        while len(batches) > 0 and batches[0].get('height', height + 1) <= height:
+            stale = batches.pop(0)
+            self.log.error(f'Dropping batch for block {stale["height"]} from {master[:8]}. Now at {height}.')
+
+    def has_work(self, masters, height=None):
+        if height is not None:
+            for master in masters:
+                self.drop_stale(master, height)
+
+        return any(len(self.new_work[master]) > 0 for master in masters)
+
+    async def gather_transaction_batches(self, masters: list, timeout=None, height=None):
         # Wait until the queue is filled before starting timeout
         self.masters = masters
 
-        ready = False
-        while not ready:
-            for master in masters:
-                if len(self.new_work[master]) > 0:
-                    ready = True
-            await asyncio.sleep(0)
+        await self.wait(condition=lambda: self.has_work(masters, height))
+
+        # Without a fixed timeout, wait as long as the slowest master usually lags behind the first one
+        if timeout is None:
+            timeout = self.timing.timeout(masters)
 
-        # Now wait until the rest come in or the timeout is triggered
+        # Now wait until the rest come in or the timeout is triggered. One batch per master and round.
         next_work = []
+        responded = set()
         start = time.time()
         while len(next_work) < len(masters) and time.time() - start < timeout:
             for master in masters:
-                if len(self.new_work[master]) > 0:
+                if master not in responded and self.has_work([master], height):
                     next_work.append(self.new_work[master].pop(0))
-            await asyncio.sleep(0)
+                    responded.add(master)
+                    self.timing.record(master, time.time() - start)
+
+            if len(next_work) < len(masters):
+                await self.wait(
+                    condition=lambda: any(self.has_work([m], height) for m in masters if m not in responded),
+                    timeout=timeout - (time.time() - start)
+                )
+
+        self.timing.finish(missing=[master for master in masters if master not in responded])
 
         return next_work
 
@@ -187,16 +258,43 @@ class WorkProcessor(router.Processor):
 
 
 class Delegate(base.Node):
-    def __init__(self, parallelism=4, *args, **kwargs):
+    def __init__(self, parallelism=1, verify_workers=0, speculative=False, pipelined=False, *args, **kwargs):
 
         super().__init__(*args, **kwargs)
 
-        # Number of core / processes we push to
+        # Processes used to check signatures on large tx batches. 0 checks them on the event loop.
+        self.verify_executor = ProcessPoolExecutor(max_workers=verify_workers) if verify_workers > 0 else None
+
+        # Number of core / processes we push to. Above 1, batches are executed optimistically across that many
+        # processes; each one opens its own ContractDriver on the same storage as the node's driver.
         self.parallelism = parallelism
         self.executor = Executor(driver=self.driver)
-        self.transaction_executor = execution.SerialExecutor(executor=self.executor)
 
-        self.work_processor = WorkProcessor(client=self.client, nonces=self.nonces)
+        if parallelism > 1:
+            self.transaction_executor = execution.OptimisticExecutor(
+                executor=self.executor,
+                workers=parallelism,
+                driver_factory=execution.driver_on(self.driver.driver)
+            )
+        else:
+            self.transaction_executor = execution.SerialExecutor(executor=self.executor)
+
+        # Executes batches as soon as they arrive instead of waiting for the whole round. Pipelining goes further and
+        # executes the next round on top of this round's own results while the block is being confirmed.
+        self.pipelined = pipelined
+        self.speculative = speculative or pipelined
+
+        # (hash, number) of the block this node expects from its own results, while pipelining
+        self.expected_block = None
+        if self.speculative:
+            self.transaction_executor = execution.SpeculativeExecutor(self.transaction_executor)
+
+        self.work_processor = WorkProcessor(
+            client=self.client,
+            nonces=self.nonces,
+            executor=self.verify_executor,
+            on_work=self.schedule_pre_execution if self.speculative else None
+        )
         self.router.add_service(WORK_SERVICE, self.work_processor)
 
         self.upgrade_manager.node_type = 'delegate'
@@ -215,9 +313,12 @@ class Delegate(base.Node):
     async def acquire_work(self):
         current_masternodes = self.client.get_var(contract='masternodes', variable='S', arguments=['members'])
 
-        w = await self.work_processor.gather_transaction_batches(masters=current_masternodes)
+        w = await self.work_processor.gather_transaction_batches(
+            masters=current_masternodes,
+            height=self.current_height
+        )
 
-        self.log.info(f'Got {len(w)} batch(es) of work')
+        self.log.info(f'Got {len(w)} batch(es) of work. Timing: {self.work_processor.timing.stats}')
 
         expected_masters = set(current_masternodes)
         work.pad_work(work=w, expected_masters=list(expected_masters))
@@ -236,7 +337,8 @@ class Delegate(base.Node):
             wallet=self.wallet,
             ctx=self.ctx,
             vk=vk,
-            ip=ip
+            ip=ip,
+            pool=self.socket_pool
         )
 
         if peers is not None:
@@ -247,8 +349,54 @@ class Delegate(base.Node):
         block = await self.new_block_processor.wait_for_next_nbn()
         self.process_new_block(block)
 
+        # Batches for the next round that beat the block here were executed against the old state
+        if self.speculative:
+            for batch in list(self.work_processor.pending_work()):
+                self.pre_execute(batch)
+
         await self.update_sockets()
 
+    def process_new_block(self, block):
+        super().process_new_block(block)
+
+        if self.expected_block is not None and self.expected_block[0] != self.current_hash:
+            self.log.error(f'Block {self.current_height} differs from our results. Discarding pipelined work.')
+
+        self.expected_block = None
+
+        # Anything executed against another base is dropped here, which also rolls back pipelined work
+        if self.speculative:
+            self.transaction_executor.invalidate(self.current_hash)
+
+    def speculation_base(self):
+        # Block hash and height the next batches are executed on top of
+        if self.expected_block is not None:
+            return self.expected_block
+
+        return self.current_hash, self.current_height
+
+    def schedule_pre_execution(self, batch):
+        # Let the router finish with the message first
+        asyncio.get_event_loop().call_soon(self.pre_execute, batch)
+
+    def pre_execute(self, batch):
+        previous_hash, height = self.speculation_base()
+
+        # Tagged for some other round
+        if batch.get('height', height + 1) != height + 1:
+            return
+
+        stamp_cost = self.client.get_var(contract='stamp_cost', variable='S', arguments=['value'])
+
+        if self.transaction_executor.pre_execute(
+            driver=self.driver,
+            batch=batch,
+            previous_block_hash=previous_hash,
+            current_height=height,
+            stamp_cost=stamp_cost
+        ):
+            self.log.debug(f'Pre-executed {len(batch["transactions"])} transactions from {batch["sender"][:8]}.')
+
     async def process_new_work(self):
         if len(self.get_masternode_peers()) == 0:
             return
@@ -256,12 +404,16 @@ class Delegate(base.Node):
         filtered_work = await self.acquire_work()
 
         # Run mini catch up here to prevent 'desyncing'
-        self.log.info(f'{len(self.new_block_processor.q)} new block(s) to process before execution.')
+        self.log.info(f'{self.new_block_processor.size()} new block(s) to process before execution.')
 
-        while len(self.new_block_processor.q) > 0:
-            block = self.new_block_processor.q.pop(0)
+        for block in self.new_block_processor.drain():
             self.process_new_block(block)
 
+        # Our own results from the last round are only kept until its block arrives
+        if self.expected_block is not None:
+            self.driver.clear_pending_state()
+            self.expected_block = None
+
         results = self.transaction_executor.execute_work(
             driver=self.driver,
             work=filtered_work,
@@ -277,13 +429,28 @@ class Delegate(base.Node):
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.socket_pool
         )
 
         self.log.info(f'Work execution complete. Sending to masters.')
 
         self.new_block_processor.clean(self.current_height)
-        self.driver.clear_pending_state()
+
+        if self.pipelined:
+            # Keep this round's writes so the next round can run on top of them until the block replaces them
+            block_num = self.current_height + 1
+            self.expected_block = predict_block(results, self.current_hash, block_num), block_num
+        else:
+            self.driver.clear_pending_state()
+
+        if self.speculative:
+            self.transaction_executor.resume()
+            self.log.info(f'Speculative execution: {self.transaction_executor.stats}')
+
+        if self.pipelined:
+            for batch in list(self.work_processor.pending_work()):
+                self.pre_execute(batch)
 
     async def loop(self):
         self.log.info('=== ENTERING PROCESS NEW WORK STATE ===')
@@ -300,4 +467,11 @@ class Delegate(base.Node):
             await self.loop()
 
     def stop(self):
-        self.router.stop()
+        # Stops the router and closes pooled sockets
+        super().stop()
+
+        if self.verify_executor is not None:
+            self.verify_executor.shutdown(wait=False)
+
+        if hasattr(self.transaction_executor, 'stop_pool'):
+            self.transaction_executor.stop_pool()
@@ -1,34 +1,22 @@
 from contracting.execution.executor import Executor
+from contracting.db.driver import ContractDriver
 from contracting.stdlib.bridge.time import Datetime
 from contracting.db.encoder import encode, safe_repr
 from lamden.crypto.canonical import tx_hash_from_tx, format_dictionary, merklize
 from lamden.logger.base import get_logger
+from lamden.cache import MISSING
+from lamden.nodes.delegate.pool import WorkerPool
 from datetime import datetime
-
-import multiprocessing as mp
-import copy
-from time import time, sleep
-import queue
+from time import time
+import functools
 
 log = get_logger('EXE')
 
-__N_WORKER_PER_DELEGATES__ = 4
-__N_DELEGATES__ = 2
-__N_WORKER__ = __N_WORKER_PER_DELEGATES__ * __N_DELEGATES__
-
-
-PoolExecutor = None
-stop_cmd = None
-pool = []
-busy_pool = []
 
-N_TEST = 8
-WORKER_SLEEP = 0.0001
-RESULT_SLEEP = 0.01
-POOL_WAIT_SLEEP = 0.01
-
-TX_RERUN_SLEEP = 1
-N_TRY_PER_TX = 3
+def split(items, parts):
+    # Contiguous chunks, at most parts of them, so every worker gets one message per batch
+    size = -(-len(items) // max(parts, 1))
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 
 class TransactionExecutor:
@@ -46,13 +34,13 @@ class TransactionExecutor:
 
 
 class ConflictResolutionExecutor(TransactionExecutor):
-    def __init__(self, workers=8):
+    def __init__(self, executor, workers=8):
         self.workers = workers
-        self.executor = PoolExecutor
+        # Forked into each worker along with this object, where set_worker_executor makes it the one that runs
+        self.executor = executor
+        self.pool = None
 
     def execute_tx(self, transaction, stamp_cost, environment: dict = {}, tx_number=0):
-        #global PoolExecutor
-        #executor = PoolExecutor
         output = self.executor.execute(
             sender=transaction['payload']['sender'],
             contract_name=transaction['payload']['contract'],
@@ -95,89 +83,43 @@ class ConflictResolutionExecutor(TransactionExecutor):
         }
 
     def start_pool(self):
-        global stop_cmd
-        stop_cmd = mp.Value('i', 0)
-
-        for i in range(__N_WORKER__):
-            queue_in1 = mp.Queue()
-            queue_out1 = mp.Queue()
-            p = ProcessThread(queue_in1, queue_out1, stop_cmd, executor=self)
-            pool.append(p)
-            busy_pool.append(0)
-            p.start()
-
-        for i in range(5):
-            n_proc = 0
-            for i in range(__N_WORKER__):
-                if pool[i].is_alive():
-                    n_proc += 1
-            if n_proc == __N_WORKER__:
-                log.info(f" Workers started OK")
-                return True
-            sleep(1)
-        log.error(f" Can't start workers")
-        return False
+        # Workers are forked from this process and keep a copy of this executor
+        self.pool = WorkerPool(workers=self.workers, initializer=set_worker_executor, initargs=(self,))
+        self.pool.start()
+        return True
 
-    def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
+    def execute_numbered(self, numbered, stamp_cost, environment):
+        chunks = [(chunk, stamp_cost, environment) for chunk in split(numbered, self.workers)]
+
+        results = []
+        for outputs in self.pool.map(execute_chunk, chunks):
+            results.extend(outputs)
 
+        return results
+
+    def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
         environment = self.generate_environment(driver, timestamp, input_hash, bhash, num)
-        set_pool_executor(self.executor)
 
-        global pool
-        if len(pool) == 0:
+        if self.pool is None:
             self.start_pool()
-            log.debug(f'Initialyze pool {len(pool)}')
 
-        work_pool, active_workers = self.get_pool(len(batch['transactions']))
-        i = 0
         s = time()
-        global result_list2
-        result_list2 = []
-        log.debug(f"Start Pool len={active_workers}  prc={work_pool}")
-
-        for transaction in batch['transactions']:
-            log.debug(f'Transaction {i}   {type(self.executor)}')
-            it = (transaction, stamp_cost, environment, i)
-            i_prc = work_pool[i % active_workers]
-            pool[i_prc].q_in.put(it)
-            i += 1
-
-        N_tx = i
-        result_list2 = self.wait_tx_result(N_tx, work_pool)
-        self.free_pool(work_pool)
 
-        log.debug(f"End of pool. result_list={result_list2}")
+        numbered = list(enumerate(batch['transactions']))
+        tx_data = {tx['tx_number']: tx for tx in self.execute_numbered(numbered, stamp_cost, environment)}
 
-        tx_data = copy.deepcopy(result_list2)
-        result_list2 = []
-        tx_done_ok = [tx['tx_number'] for tx in tx_data]
-        tx_bad = [tx['tx_number'] for tx in tx_data if tx['status'] != 0]
-        log.debug(f"tx_data={len(tx_data)}  tx_done_ok={tx_done_ok}  tx_bad={tx_bad} duration= {time() - s}")
+        tx_bad = {n for n, tx in tx_data.items() if tx['status'] != 0}
+        log.debug(f"tx_data={len(tx_data)} tx_bad={tx_bad} duration={time() - s}")
 
+        # Failed transactions get one more run, and their new output takes the old one's place
         if len(tx_bad) > 0:
-            self.free_pool(work_pool)
-            work_pool, active_workers = self.get_pool(len(tx_bad))
-
-            log.debug(f'Bad transactions {len(tx_bad)}. Try to rerun {active_workers}  {work_pool}')
-            sleep(TX_RERUN_SLEEP)
-            i = 0
-            for transaction in batch['transactions']:
-                if i in tx_bad:
-                    log.debug(f'rerun Transaction {i}')
-                    it = (transaction, stamp_cost, environment, i)
-                    i_prc = work_pool[i % active_workers]
-                    pool[i_prc].q_in.put(it)
-
-                i += 1
-            N_tx_rerun = i
-            result_list2 = self.wait_tx_result(N_tx_rerun, work_pool)
-            log.debug(f"End of rerun. result_list={result_list2}")
-            self.free_pool(work_pool)
-
-            for r in result_list2:
-                tx_data.append(r)
+            log.debug(f'Bad transactions {len(tx_bad)}. Rerunning them.')
 
-        return tx_data
+            rerun = [(n, tx) for n, tx in numbered if n in tx_bad]
+            for tx in self.execute_numbered(rerun, stamp_cost, environment):
+                tx_data[tx['tx_number']] = tx
+
+        return [tx_data[n] for n in sorted(tx_data.keys())]
 
     def execute_work(self, driver, work, wallet, previous_block_hash, current_height=0, stamp_cost=20000,
                      parallelism=4):
@@ -224,97 +166,26 @@ class ConflictResolutionExecutor(TransactionExecutor):
 
         return subblocks
 
-    def get_pool(self, n_needed):
-        rez_pool = {}
-        cnt = 0
-        n_step = 0
-        if n_needed > 0:
-            if n_needed > __N_WORKER_PER_DELEGATES__:
-                n_needed = __N_WORKER_PER_DELEGATES__
-            while n_step < 3:
-                for i in range(__N_WORKER__):
-                    if busy_pool[i] == 0:
-                        busy_pool[i] = 1
-                        rez_pool[cnt] = i
-                        cnt += 1
-                    if cnt >= n_needed:
-                        break
-                if cnt > 0:
-                    break
-                else:
-                    sleep(POOL_WAIT_SLEEP)
-                    n_step += 1
-        return rez_pool, cnt
-
-    def free_pool(self, rez_pool):
-        for k, v in rez_pool.items():
-            busy_pool[v] = 0
-
     def stop_pool(self):
-        if pool is None:
-            return
-        global stop_cmd
-        stop_cmd.value = 1
-        for i in range(__N_WORKER__):
-            pool[i].join()
-        log.info(f" Workers stopped OK")
-
-    def wait_tx_result(self, N_tx, work_pool):
-        active_workers = len(work_pool)
-        kk = 0
-        k_step = 0
-        k_wait = N_tx * N_TRY_PER_TX
-        rez = []
-        while k_step < k_wait:
-            for i_tx in range(N_tx):
-                try:
-                    k_step += 1
-                    i_prc = work_pool[i_tx % active_workers]
-                    r = pool[i_prc].q_out.get_nowait()
-                    if r is not None:
-                        rez.append(r)
-                        kk += 1
-                except queue.Empty:
-                    sleep(RESULT_SLEEP)
-            if kk >= N_tx:
-                break
-        return rez
-
-
-class ProcessThread(mp.Process):
-    def __init__(self, q_in, q_out, s_stop, executor: ConflictResolutionExecutor):
-        super(ProcessThread, self).__init__()
-        self.q_in = q_in
-        self.q_out = q_out
-        self.s_stop = s_stop
-        self.executor = executor
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+
+# Set in each worker process by the pool initializer
+worker_executor = None
 
-    def run(self):
-        while 1:
-            if (int(self.s_stop.value) == 1):
-                # print("Process stopped")
-                break
-            # print("Process run")
-            try:
-                x = self.q_in.get_nowait()
-                if x is not None:
-                    # work()
-                    try:
-                        tx_input = x
-                        output = self.executor.execute_tx(tx_input[0], tx_input[1], environment= tx_input[2], tx_number=tx_input[3])
-                        self.q_out.put(output)
-                    except Exception as err:
-                        log.error(f"Worker stopped after exception={err}")
-                        break
-            except queue.Empty:
-                sleep(WORKER_SLEEP)
-        # print("Process exit")
-        return
-
-
-def set_pool_executor(executor: Executor):
-    global PoolExecutor
-    PoolExecutor = executor
+
+def set_worker_executor(executor):
+    global worker_executor
+    worker_executor = executor
+
+
+def execute_chunk(numbered, stamp_cost, environment):
+    return [
+        worker_executor.execute_tx(transaction, stamp_cost, environment=environment, tx_number=n)
+        for n, transaction in numbered
+    ]
 
 
 class SerialExecutor(TransactionExecutor):
@@ -440,3 +311,447 @@ class SerialExecutor(TransactionExecutor):
             i += 1
 
         return subblocks
+
+
+class AccessTracker:
+    # Records the keys a transaction reads and writes while it runs, by shadowing the driver methods every Variable,
+    # Hash and stamp lookup goes through. Read values are kept encoded so they can be compared against later state.
+    WRITES = ('set', 'delete')
+
+    # Reads over a prefix cannot be checked key by key
+    RANGE_READS = ('items', 'keys', 'values', 'iter_from_disk')
+
+    # Calls that change the whole cache at once
+    BULK_WRITES = ('clear_pending_state', 'commit', 'flush', 'revert', 'rollback')
+
+    def __init__(self, driver):
+        self.driver = driver
+
+        self.reads = {}
+        self.written = set()
+
+        # Cache value of every touched key from before the transaction ran
+        self.before = {}
+
+        self.ranged = False
+        self.bulk = False
+
+        self.shadowed = {}
+        self.instance_attributes = set()
+        self.size = 0
+
+    def touch(self, key):
+        if key not in self.before:
+            self.before[key] = self.driver.cache.get(key, MISSING)
+
+    def get(self, key, *args, **kwargs):
+        self.touch(key)
+        value = self.shadowed['get'](key, *args, **kwargs)
+
+        # A key the transaction wrote itself is not a dependency on anything before it
+        if key not in self.reads and key not in self.written:
+            self.reads[key] = encode(value)
+
+        return value
+
+    def write(self, name):
+        def write(key, *args, **kwargs):
+            self.touch(key)
+            self.written.add(key)
+            return self.shadowed[name](key, *args, **kwargs)
+        return write
+
+    def range_read(self, name):
+        def read(*args, **kwargs):
+            self.ranged = True
+            return self.shadowed[name](*args, **kwargs)
+        return read
+
+    def bulk_write(self, name):
+        def write(*args, **kwargs):
+            self.bulk = True
+            return self.shadowed[name](*args, **kwargs)
+        return write
+
+    def __enter__(self):
+        overrides = {'get': self.get}
+        for names, wrap in ((self.WRITES, self.write), (self.RANGE_READS, self.range_read),
+                            (self.BULK_WRITES, self.bulk_write)):
+            for name in names:
+                if hasattr(self.driver, name):
+                    overrides[name] = wrap(name)
+
+        for name, method in overrides.items():
+            if name in vars(self.driver):
+                self.instance_attributes.add(name)
+
+            self.shadowed[name] = getattr(self.driver, name)
+            setattr(self.driver, name, method)
+
+        self.size = len(self.driver.cache)
+
+        return self
+
+    def __exit__(self, *args):
+        own = vars(self.driver)
+        for name, method in self.shadowed.items():
+            if name in self.instance_attributes:
+                setattr(self.driver, name, method)
+            else:
+                # Drop the override so the class method shows through again
+                own.pop(name, None)
+
+    def writes(self):
+        # Cache entries the transaction left behind
+        cache = self.driver.cache
+        return {key: cache[key] for key in self.before.keys() if key in cache}
+
+    def untracked(self):
+        # True when the cache changed other than through the tracked keys, e.g. it was cleared
+        if self.bulk:
+            return True
+
+        cache = self.driver.cache
+
+        removed = sum(1 for key, value in self.before.items() if value is not MISSING and key not in cache)
+        added = sum(1 for key, value in self.before.items() if value is MISSING and key in cache)
+
+        return removed > 0 or len(cache) != self.size + added
+
+    def rollback(self):
+        cache = self.driver.cache
+        for key, value in self.before.items():
+            if value is MISSING:
+                cache.pop(key, None)
+            else:
+                cache[key] = value
+
+
+class Speculation:
+    def __init__(self, output, reads, writes, ranged=False, barrier=False):
+        self.output = output
+        self.reads = reads
+        self.writes = writes
+        self.ranged = ranged
+
+        # Set when the transaction changed driver state in a way the tracker could not follow
+        self.barrier = barrier
+
+
+def speculate(transaction_executor, transactions, stamp_cost, environment):
+    # Runs every transaction against the same starting state, leaving the driver cache as it was found
+    cache = transaction_executor.executor.driver.cache
+    base = dict(cache)
+
+    speculations = []
+    for transaction in transactions:
+        tracker = AccessTracker(transaction_executor.executor.driver)
+        with tracker:
+            output = transaction_executor.execute_tx(
+                transaction=transaction,
+                environment=environment,
+                stamp_cost=stamp_cost
+            )
+
+        writes = tracker.writes()
+        barrier = tracker.untracked()
+
+        if barrier:
+            cache.clear()
+            cache.update(base)
+        else:
+            tracker.rollback()
+
+        speculations.append(Speculation(output, tracker.reads, writes, ranged=tracker.ranged, barrier=barrier))
+
+    return speculations
+
+
+def init_worker(driver_factory):
+    set_worker_executor(SerialExecutor(executor=Executor(driver=driver_factory())))
+
+
+def driver_on(backing):
+    # Builds a fresh ContractDriver over the same storage as an existing one
+    return functools.partial(ContractDriver, driver=backing)
+
+
+def speculate_in_worker(base, transactions, stamp_cost, environment):
+    # Workers start from the delegate's cached state so they see the writes of earlier batches in the same work
+    cache = worker_executor.executor.driver.cache
+    cache.clear()
+    cache.update(base)
+
+    try:
+        return speculate(worker_executor, transactions, stamp_cost, environment)
+    finally:
+        cache.clear()
+
+
+class OptimisticExecutor(SerialExecutor):
+    # Executes a batch optimistically: every transaction first runs against the state at the start of the batch,
+    # spread over worker processes, while recording what it read and wrote. Results are then accepted in
+    # transaction order. A transaction whose reads were changed by an earlier one is executed again on top of the
+    # accepted state, so the output matches SerialExecutor exactly.
+    def __init__(self, executor, workers=0, driver_factory=None, min_parallel_batch=8):
+        super().__init__(executor=executor)
+
+        # 0 speculates in this process, which still only re-executes conflicting transactions
+        self.workers = workers
+
+        # Workers open their own driver. By default it sits on the same storage as the executor's driver.
+        self.driver_factory = driver_factory if driver_factory is not None else driver_on(executor.driver.driver)
+        self.min_parallel_batch = min_parallel_batch
+
+        self.pool = None
+
+        self.executed = 0
+        self.conflicts = 0
+
+    def start_pool(self):
+        if self.pool is None:
+            self.pool = WorkerPool(workers=self.workers, initializer=init_worker, initargs=(self.driver_factory,))
+            self.pool.start()
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def in_workers(self, transactions):
+        return self.workers > 0 and len(transactions) >= self.min_parallel_batch
+
+    def speculate(self, transactions, stamp_cost, environment):
+        if not self.in_workers(transactions):
+            return speculate(self, transactions, stamp_cost, environment)
+
+        self.start_pool()
+
+        base = dict(self.executor.driver.cache)
+        chunks = [(base, chunk, stamp_cost, environment) for chunk in split(transactions, self.workers)]
+
+        speculations = []
+        for chunk in self.pool.map(speculate_in_worker, chunks):
+            speculations.extend(chunk)
+
+        return speculations
+
+    def is_stale(self, speculation, changed, in_worker=False):
+        if speculation.barrier:
+            return True
+
+        if speculation.ranged and len(changed) > 0:
+            return True
+
+        driver = self.executor.driver
+        for key, value in speculation.reads.items():
+            if key in changed:
+                if encode(driver.cache.get(key)) != value:
+                    return True
+
+            # A worker read untouched keys from its own driver, which may not see the same state as this one
+            elif in_worker and encode(driver.get(key, mark=False)) != value:
+                return True
+
+        return False
+
+    def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
+        environment = self.generate_environment(driver, timestamp, input_hash, bhash, num)
+
+        transactions = batch['transactions']
+        in_worker = self.in_workers(transactions)
+        speculations = self.speculate(transactions, stamp_cost, environment)
+
+        cache = self.executor.driver.cache
+
+        # Keys changed by the transactions accepted so far in this batch
+        changed = set()
+
+        # After a change the tracker could not follow, the rest of the batch runs serially
+        serial = False
+
+        tx_data = []
+        for transaction, speculation in zip(transactions, speculations):
+            if serial or self.is_stale(speculation, changed, in_worker):
+                tracker = AccessTracker(self.executor.driver)
+                with tracker:
+                    output = self.execute_tx(transaction=transaction, environment=environment, stamp_cost=stamp_cost)
+
+                writes = tracker.writes()
+                serial = serial or speculation.barrier or tracker.untracked()
+
+                self.conflicts += 1
+            else:
+                output, writes = speculation.output, speculation.writes
+                cache.update(writes)
+
+            changed.update(writes.keys())
+            tx_data.append(output)
+
+        self.executed += len(transactions)
+
+        if len(transactions) > 0:
+            log.debug(f'Executed {len(transactions)} transactions, {self.conflicts} conflicts so far.')
+
+        return tx_data
+
+    @property
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'executed': self.executed,
+            'conflicts': self.conflicts
+        }
+
+
+class PreExecution:
+    def __init__(self, batch, stamp_cost, current_height, outputs, reads, writes):
+        self.transactions = batch['transactions']
+        self.timestamp = batch['timestamp']
+        self.stamp_cost = stamp_cost
+        self.current_height = current_height
+
+        self.outputs = outputs
+        self.reads = reads
+        self.writes = writes
+
+    def matches(self, batch, stamp_cost, current_height):
+        return self.stamp_cost == stamp_cost and \
+            self.current_height == current_height and \
+            self.timestamp == batch['timestamp'] and \
+            self.transactions == batch['transactions']
+
+
+class SpeculativeExecutor(SerialExecutor):
+    # Wraps another executor so batches can be executed as they arrive, ahead of the round they belong to. Results
+    # are kept by (input_hash, previous block hash) and reused by execute_work only while every key they read still
+    # holds the value they saw. A new block changes the previous hash, so old results never match.
+    def __init__(self, transaction_executor: TransactionExecutor, max_size=64):
+        super().__init__(executor=transaction_executor.executor)
+        self.transaction_executor = transaction_executor
+
+        self.results = {}
+        self.max_size = max_size
+
+        # Pre-execution needs a cache holding nothing but the state it is meant to build on
+        self.paused = False
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def has_result(self, batch, previous_block_hash):
+        return (batch['input_hash'], previous_block_hash) in self.results
+
+    def pre_execute(self, driver, batch, previous_block_hash, current_height, stamp_cost):
+        if self.paused or len(batch['transactions']) == 0 or self.has_result(batch, previous_block_hash):
+            return False
+
+        cache = driver.cache
+        base = dict(cache)
+
+        tracker = AccessTracker(driver)
+        with tracker:
+            outputs = self.transaction_executor.execute_tx_batch(
+                driver=driver,
+                batch=batch,
+                timestamp=batch['timestamp'],
+                input_hash=batch['input_hash'],
+                stamp_cost=stamp_cost,
+                bhash=previous_block_hash,
+                num=current_height
+            )
+
+        writes = tracker.writes()
+        untracked = tracker.untracked()
+
+        # Leave the driver exactly as it was found
+        if untracked:
+            cache.clear()
+            cache.update(base)
+        else:
+            tracker.rollback()
+
+        # Prefix reads cannot be checked again later, so those results are not kept
+        if untracked or tracker.ranged:
+            return False
+
+        self.results[(batch['input_hash'], previous_block_hash)] = PreExecution(
+            batch, stamp_cost, current_height, outputs, tracker.reads, writes
+        )
+
+        while len(self.results) > self.max_size:
+            self.results.pop(next(iter(self.results)))
+
+        return True
+
+    def invalidate(self, previous_block_hash):
+        stale = [key for key in self.results.keys() if key[1] != previous_block_hash]
+        for key in stale:
+            self.results.pop(key)
+
+        self.invalidated += len(stale)
+
+    def is_stale(self, pre: PreExecution, driver):
+        # Reads go against the live state, which covers earlier batches in the round as well as the block itself
+        for key, value in pre.reads.items():
+            if encode(driver.get(key, mark=False)) != value:
+                return True
+
+        return False
+
+    def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
+        pre = self.results.pop((input_hash, bhash), None)
+
+        if pre is not None and pre.matches(batch, stamp_cost, num) and not self.is_stale(pre, driver):
+            driver.cache.update(pre.writes)
+            self.hits += 1
+
+            return pre.outputs
+
+        if len(batch['transactions']) > 0:
+            self.misses += 1
+
+        return self.transaction_executor.execute_tx_batch(
+            driver=driver,
+            batch=batch,
+            timestamp=timestamp,
+            input_hash=input_hash,
+            stamp_cost=stamp_cost,
+            bhash=bhash,
+            num=num
+        )
+
+    def execute_work(self, driver, work, wallet, previous_block_hash, current_height=0, stamp_cost=20000,
+                     parallelism=4):
+        # Resumed by the delegate once the cache holds the state the next batches should build on
+        self.pause()
+
+        return super().execute_work(
+            driver=driver,
+            work=work,
+            wallet=wallet,
+            previous_block_hash=previous_block_hash,
+            current_height=current_height,
+            stamp_cost=stamp_cost,
+            parallelism=parallelism
+        )
+
+    def stop_pool(self):
+        if hasattr(self.transaction_executor, 'stop_pool'):
+            self.transaction_executor.stop_pool()
+
+    @property
+    def stats(self):
+        return {
+            'pending': len(self.results),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidated': self.invalidated
+        }
@@ -0,0 +1,189 @@
+from lamden.logger.base import get_logger
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+log = get_logger('Pool')
+
+'''
+Long lived worker processes fed over one pipe each. A task is a module level function plus its arguments, so a whole
+chunk of transactions goes out in a single message. Idle workers block on recv and the parent blocks in
+connection.wait until a result arrives or a worker exits, so nothing polls or sleeps.
+
+A worker that dies is replaced and its chunk is handed to the next free worker. A task that raises is reported back
+and raised from map once the chunks already in flight have come back.
+'''
+
+
+class WorkerError(Exception):
+    pass
+
+
+def work(conn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+
+        # None is the shutdown message
+        if task is None:
+            break
+
+        handler, args = task
+
+        try:
+            conn.send((True, handler(*args)))
+        except Exception as e:
+            conn.send((False, repr(e)))
+
+    conn.close()
+
+
+class Worker:
+    def __init__(self, ctx, initializer, initargs):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=work, args=(child, initializer, initargs), daemon=True)
+        self.process.start()
+
+        # The child end only lives in the worker now, so a crash shows up as EOF on this side
+        child.close()
+
+    def stop(self, timeout):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+        self.conn.close()
+
+
+class WorkerPool:
+    def __init__(self, workers=4, initializer=None, initargs=(), max_restarts=3, ctx=None):
+        self.size = workers
+        self.initializer = initializer
+        self.initargs = initargs
+
+        # Restarts allowed within a single map call before giving up
+        self.max_restarts = max_restarts
+
+        self.ctx = ctx or mp.get_context()
+        self.workers = []
+
+        self.tasks = 0
+        self.restarts = 0
+
+    def start(self):
+        while len(self.workers) < self.size:
+            self.workers.append(self.spawn())
+
+        log.info(f'Started {self.size} workers.')
+
+    def spawn(self):
+        return Worker(self.ctx, self.initializer, self.initargs)
+
+    @property
+    def started(self):
+        return len(self.workers) > 0
+
+    def replace(self, i):
+        worker = self.workers[i]
+        worker.process.join()
+        worker.conn.close()
+
+        log.error(f'Worker {i} exited with code {worker.process.exitcode}. Restarting it.')
+
+        self.workers[i] = self.spawn()
+        self.restarts += 1
+
+    def map(self, handler, chunks):
+        # Runs handler(*args) for every args tuple in chunks and returns the results in the same order
+        if not self.started:
+            self.start()
+
+        results = [None] * len(chunks)
+        pending = list(range(len(chunks)))
+        pending.reverse()
+
+        # Worker index -> chunk index it is running
+        running = {}
+
+        restarts = 0
+        error = None
+
+        while len(pending) > 0 or len(running) > 0:
+            # Stop handing out chunks after a failure, but collect everything still in flight
+            if error is None:
+                for i in range(len(self.workers)):
+                    if len(pending) == 0:
+                        break
+
+                    if i in running:
+                        continue
+
+                    # Workers can exit between batches, e.g. right after sending their last result
+                    if not self.workers[i].process.is_alive():
+                        self.replace(i)
+
+                    chunk = pending.pop()
+                    self.workers[i].conn.send((handler, chunks[chunk]))
+                    running[i] = chunk
+
+            if len(running) == 0:
+                break
+
+            conns = {self.workers[i].conn: i for i in running.keys()}
+            sentinels = {self.workers[i].process.sentinel: i for i in running.keys()}
+
+            for ready in wait(list(conns.keys()) + list(sentinels.keys())):
+                i = conns.get(ready, sentinels.get(ready))
+                if i not in running:
+                    continue
+
+                try:
+                    ok, result = self.workers[i].conn.recv()
+                except (EOFError, OSError):
+                    # Died mid chunk: run the chunk again on a fresh worker
+                    pending.append(running.pop(i))
+                    self.replace(i)
+
+                    restarts += 1
+                    if restarts > self.max_restarts and error is None:
+                        error = WorkerError(f'Workers crashed {restarts} times in one batch.')
+                    continue
+
+                chunk = running.pop(i)
+                if ok:
+                    results[chunk] = result
+                    self.tasks += 1
+                elif error is None:
+                    error = WorkerError(result)
+
+        if error is not None:
+            raise error
+
+        return results
+
+    def stop(self, timeout=5):
+        for worker in self.workers:
+            worker.stop(timeout)
+
+        self.workers = []
+
+        log.info('Workers stopped.')
+
+    @property
+    def stats(self):
+        return {
+            'workers': self.size,
+            'alive': sum(1 for worker in self.workers if worker.process.is_alive()),
+            'tasks': self.tasks,
+            'restarts': self.restarts
+        }
@@ -1,17 +1,15 @@
-import asyncio
 from copy import deepcopy
 import time
+from lamden import router
 
 
-async def gather_transaction_batches(queue: dict, expected_batches: int, timeout=5):
+async def gather_transaction_batches(queue: dict, inbox: router.Inbox, expected_batches: int, timeout=5):
+    # Producers call inbox.notify() after adding to the queue
     # Wait until the queue is filled before starting timeout
-    while len(set(queue.keys())) == 0:
-        await asyncio.sleep(0)
+    await inbox.wait(condition=lambda: len(queue) > 0)
 
     # Now wait until the rest come in or the timeout is triggered
-    start = time.time()
-    while len(set(queue.keys())) < expected_batches and time.time() - start < timeout:
-        await asyncio.sleep(0)
+    await inbox.wait(condition=lambda: len(queue) >= expected_batches, timeout=timeout)
 
     work = deepcopy(list(queue.values()))
     queue.clear()
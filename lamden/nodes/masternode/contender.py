@@ -2,21 +2,26 @@ from contracting.db.encoder import encode
 from collections import defaultdict
 from lamden import router
 from lamden.crypto.canonical import merklize, block_from_subblocks
-from lamden.crypto.wallet import verify
+from lamden.crypto.wallet import verify, verify_many
 from lamden.logger.base import get_logger
 from lamden import storage
-import asyncio
+from lamden.cache import LRUCache, MISSING
+from lamden.timing import AdaptiveTimeout
 import time
 
 log = get_logger('Contender')
 
-class SBCInbox(router.Processor):
-    def __init__(self, expected_subblocks=4, debug=True):
-        self.q = []
+class SBCInbox(router.Inbox):
+    def __init__(self, expected_subblocks=4, debug=True, merkle_cache_size=256):
+        super().__init__()
         self.expected_subblocks = expected_subblocks
         self.log = get_logger('Subblock Gatherer')
         self.log.propagate = debug
 
+        # Merkle root -> (transactions, leaves) already proven to hash to it this round. Delegates that agree sign
+        # the same root, so only the first of them has its tree rebuilt. Cleared after every block.
+        self.proven = LRUCache(max_size=merkle_cache_size)
+
         self.block_q = []
 
     async def process_message(self, msg):
@@ -27,61 +32,77 @@ class SBCInbox(router.Processor):
             self.log.error('Contender does not have enough subblocks!')
             return
 
+        # Every subblock signature is checked in one pass before the per subblock checks
+        signed = verify_many([self.signature_triple(sbc) for sbc in msg])
+
         for i in range(len(msg)):
-            if not self.sbc_is_valid(msg[i], i):
+            if not self.sbc_is_valid(msg[i], i, signature_valid=signed[i]):
                 self.log.error('Contender is not valid!')
                 return
 
-            self.q.append(msg)
-
-    def sbc_is_valid(self, sbc, sb_idx=0):
-        if sbc['subblock'] != sb_idx:
-            self.log.error(f'Subblock Contender[{sb_idx}] is out order.')
-            return False
+        self.put(msg)
 
-        # Make sure signer is in the delegates
+    def signature_triple(self, sbc):
+        # Empty subblocks sign their input hash. Otherwise the signature is over the merkle root.
         if len(sbc['transactions']) == 0:
             message = sbc['input_hash']
         else:
             message = sbc['merkle_tree']['leaves'][0]
 
-        valid_sig = verify(
-            vk=sbc['signer'],
-            msg=message,
-            signature=sbc['merkle_tree']['signature']
-        )
+        return sbc['signer'], message, sbc['merkle_tree']['signature']
+
+    def sbc_is_valid(self, sbc, sb_idx=0, signature_valid=None):
+        if sbc['subblock'] != sb_idx:
+            self.log.error(f'Subblock Contender[{sb_idx}] is out order.')
+            return False
 
-        if not valid_sig:
+        # Make sure signer is in the delegates
+        if signature_valid is None:
+            vk, message, signature = self.signature_triple(sbc)
+            signature_valid = verify(vk=vk, msg=message, signature=signature)
+
+        if not signature_valid:
             self.log.error(f'Subblock Contender[{sb_idx}] from {sbc["signer"][:8]} has an invalid signature.')
             return False
 
         if len(sbc['merkle_tree']['leaves']) > 0:
-            txs = [encode(tx).encode() for tx in sbc['transactions']]
-            expected_tree = merklize(txs)
+            root = sbc['merkle_tree']['leaves'][0]
+
+            # Only contenders with transactions signed the root itself, so only they can use an earlier proof
+            proven = self.proven.get(root) if len(sbc['transactions']) > 0 else MISSING
 
-            # Missing leaves, etc
-            if len(sbc['merkle_tree']['leaves']) != len(expected_tree) and len(sbc['transactions']) > 0:
-                self.log.error('Merkle Tree Len mismatch')
-                return False
+            if proven is not MISSING:
+                # The signature vouches for the root, which stands for exactly the proven transactions
+                sbc['transactions'], sbc['merkle_tree']['leaves'] = proven
+            else:
+                txs = [encode(tx).encode() for tx in sbc['transactions']]
+                expected_tree = merklize(txs)
 
-            for i in range(len(expected_tree)):
-                if expected_tree[i] != sbc['merkle_tree']['leaves'][i]:
-                    self.log.error('Subblock Contender[{}] from {} has an Merkle tree proof.')
+                # Missing leaves, etc
+                if len(sbc['merkle_tree']['leaves']) != len(expected_tree) and len(sbc['transactions']) > 0:
+                    self.log.error('Merkle Tree Len mismatch')
                     return False
 
+                for i in range(len(expected_tree)):
+                    if expected_tree[i] != sbc['merkle_tree']['leaves'][i]:
+                        self.log.error('Subblock Contender[{}] from {} has an Merkle tree proof.')
+                        return False
+
+                if len(sbc['transactions']) > 0:
+                    self.proven.set(root, (sbc['transactions'], sbc['merkle_tree']['leaves']))
+
         self.log.info(f'Subblock[{sbc["subblock"]}] from {sbc["signer"][:8]} is valid.')
 
         return True
 
     def has_sbc(self):
-        return len(self.q) > 0
+        return self.has_items()
 
     async def receive_sbc(self):
         self.log.debug('Receiving Subblock Contender...')
-        while len(self.q) <= 0:
-            await asyncio.sleep(0)
+        await self.wait()
 
-        return self.q.pop(0)
+        return self.get()
 
 
 class PotentialSolution:
@@ -121,6 +142,10 @@ class SubBlockContender:
         self.potential_solutions = {}
         self.best_solution = None
 
+        # Another solution has as many votes as the best one. Neither is picked then, so the outcome does not depend on
+        # which arrived first.
+        self.tied = False
+
         self.total_responses = 0
         self.total_contacts = total_contacts
 
@@ -141,10 +166,16 @@ class SubBlockContender:
         p = self.potential_solutions.get(result_hash)
         p.signatures.append((sbc['merkle_tree']['signature'], sbc['signer']))
 
-        # Update the best solution if the current potential solution now has more votes
+        # Update the best solution if the current potential solution now has more votes. A vote for the best solution
+        # always breaks a tie.
         if self.best_solution is None or p.votes > self.best_solution.votes:
             self.best_solution = p
+            self.tied = False
             self.log.info(f'New best result: {result_hash[:8]}')
+        elif p is self.best_solution:
+            self.tied = False
+        elif p.votes == self.best_solution.votes:
+            self.tied = True
 
         self.log.info(f'Best solution votes: {self.best_solution.votes}')
 
@@ -152,12 +183,12 @@ class SubBlockContender:
 
     @property
     def failed(self):
-        # True if all responses are recorded and required consensus is not possible
-        if self.total_responses >= self.total_contacts and \
-               not self.has_required_consensus:
-            log.error('Failed block created!')
-            return True
-        return False
+        # True once no solution can reach adequate consensus even if everyone left votes for it, at the latest when
+        # all responses are recorded. The outcome is then the same whatever else arrives.
+        best = 0 if self.best_solution is None else self.best_solution.votes
+        remaining = self.total_contacts - self.total_responses
+
+        return (best + remaining) / self.total_contacts < self.adequate_consensus
 
     @property
     def has_required_consensus(self):
@@ -171,7 +202,7 @@ class SubBlockContender:
 
     @property
     def has_adequate_consensus(self):
-        if self.best_solution is None:
+        if self.best_solution is None or self.tied:
             return False
 
         if self.best_solution.votes / self.total_contacts < self.adequate_consensus:
@@ -181,8 +212,9 @@ class SubBlockContender:
 
     @property
     def serialized_solution(self):
-        #if not self.has_adequate_consensus or self.failed:
-        #    return None
+        # Failed and tied subblocks are left out of the block
+        if not self.has_adequate_consensus:
+            return None
 
         try:
             return self.best_solution.struct_to_dict()
@@ -207,6 +239,15 @@ class BlockContender:
 
         self.received = defaultdict(set)
 
+        # Running tallies of subblocks by state, updated as each contender arrives, so the block outcome is known
+        # without rescanning the subblocks. Consensus and failure only ever turn on. Adequate consensus can be lost
+        # again to a tie.
+        self.with_consensus = 0
+        self.with_adequate_consensus = 0
+        self.failed_subblocks = 0
+
+        self.max_responses = 0
+
     def add_sbcs(self, sbcs):
         for sbc in sbcs:
             # If it's out of range, ignore
@@ -222,15 +263,32 @@ class BlockContender:
                 s = SubBlockContender(
                     input_hash=sbc['input_hash'],
                     index=sbc['subblock'],
-                    total_contacts=self.total_contacts
+                    total_contacts=self.total_contacts,
+                    required_consensus=self.required_consensus,
+                    adequate_consensus=self.acceptable_consensus
                 )
                 self.subblock_contenders[sbc['subblock']] = s
 
             # Access the object at the SB index and add a potential solution
             s = self.subblock_contenders[sbc['subblock']]
+
+            had_consensus, had_adequate_consensus, had_failed = \
+                s.has_required_consensus, s.has_adequate_consensus, s.failed
+
             s.add_potential_solution(sbc)
             self.received[sbc['subblock']].add(sbc['signer'])
 
+            if not had_consensus and s.has_required_consensus:
+                self.with_consensus += 1
+
+            self.with_adequate_consensus += s.has_adequate_consensus - had_adequate_consensus
+
+            if not had_failed and s.failed:
+                self.failed_subblocks += 1
+                self.log.error(f'Subblock {s.index} can no longer reach adequate consensus. Leaving it out.')
+
+            self.max_responses = max(self.max_responses, s.total_responses)
+
     def current_responded_sbcs(self):
         i = 0
         for s in self.subblock_contenders:
@@ -240,13 +298,15 @@ class BlockContender:
         return i
 
     def block_has_consensus(self):
-        for sb in self.subblock_contenders:
-            if sb is None:
-                return False
-            if not sb.has_required_consensus:
-                return False
+        return self.with_consensus == self.total_subblocks
 
-        return True
+    def block_has_adequate_consensus(self):
+        return self.with_adequate_consensus == self.total_subblocks
+
+    def block_is_decided(self):
+        # True once more responses cannot change the block. Every subblock either has required consensus, so its best
+        # solution can no longer be overtaken, or has failed and is left out.
+        return self.with_consensus + self.failed_subblocks == self.total_subblocks
 
     def get_current_best_block(self):
         block = []
@@ -262,19 +322,12 @@ class BlockContender:
 
     @property
     def responses(self):
-        m = 0
-        for sb in self.subblock_contenders:
-            if sb is None:
-                continue
-            if sb.total_responses > m:
-                m = sb.total_responses
-
-        return m
+        return self.max_responses
 
 
 # Can probably move this into the masternode. Move the sbc inbox there and deprecate this class
 class Aggregator:
-    def __init__(self, driver, expected_subblocks=4, seconds_to_timeout=300, debug=True):
+    def __init__(self, driver, expected_subblocks=4, seconds_to_timeout=300, debug=True, timing=None):
         self.expected_subblocks = expected_subblocks
         self.sbc_inbox = SBCInbox(
             expected_subblocks=self.expected_subblocks,
@@ -282,17 +335,21 @@ class Aggregator:
 
         self.driver = driver
 
+        # Upper bound for a round. The deadline actually used is learned from how long delegates take to answer.
         self.seconds_to_timeout = seconds_to_timeout
+        self.timing = timing or AdaptiveTimeout(initial=min(30, seconds_to_timeout), maximum=seconds_to_timeout)
 
         self.log = get_logger('AGG')
         self.log.propagate = debug
 
-    async def gather_subblocks(self, total_contacts, current_height=0, current_hash='0' * 64, quorum_ratio=0.66, adequate_ratio=0.5, expected_subblocks=4):
+    async def gather_subblocks(self, total_contacts, current_height=0, current_hash='0' * 64, quorum_ratio=0.66, adequate_ratio=0.5, expected_subblocks=4, peers=None):
         self.sbc_inbox.expected_subblocks = expected_subblocks
 
         block = storage.get_latest_block_height(self.driver)
 
-        self.log.info(f'Expecting {expected_subblocks} subblocks from {total_contacts} delegates.')
+        timeout = self.timing.timeout(peers)
+
+        self.log.info(f'Expecting {expected_subblocks} subblocks from {total_contacts} delegates within {timeout:.2f}s.')
 
         contenders = BlockContender(
             total_contacts=total_contacts,
@@ -301,27 +358,49 @@ class Aggregator:
             acceptable_consensus=adequate_ratio
         )
 
-        # Add timeout condition.
+        responded = set()
+
+        # Add timeout condition. Stops as soon as the remaining responses cannot change the outcome.
         started = time.time()
         last_log = started
-        while (not contenders.block_has_consensus() and contenders.responses < contenders.total_contacts) and \
-                time.time() - started < self.seconds_to_timeout:
-
-            if self.sbc_inbox.has_sbc():
-                sbcs = await self.sbc_inbox.receive_sbc() # Can probably make this raw sync code
+        while time.time() - started < timeout:
+            for sbcs in self.sbc_inbox.drain():
                 self.log.info('Pop it in there.')
+
+                if len(sbcs) > 0 and sbcs[0]['signer'] not in responded:
+                    responded.add(sbcs[0]['signer'])
+                    self.timing.record(sbcs[0]['signer'], time.time() - started)
+
                 contenders.add_sbcs(sbcs)
 
+            if contenders.block_is_decided() or contenders.responses >= contenders.total_contacts:
+                break
+
             if time.time() - last_log > 5:
                 self.log.error(f'Waiting for contenders for {int(time.time() - started)}s.')
                 last_log = time.time()
 
-            await asyncio.sleep(0)
+            # Sleep until a contender arrives, waking up in time for the next log line or the block timeout
+            await self.sbc_inbox.wait(timeout=min(
+                timeout - (time.time() - started),
+                5 - (time.time() - last_log)
+            ))
+
+        timed_out = time.time() - started >= timeout
+
+        if timed_out:
+            self.log.error(f'Block timeout after {timeout:.2f}s. Too many delegates are offline! Kick out the non-responsive ones! {block}')
+
+        if not contenders.block_has_adequate_consensus():
+            self.log.error('Some subblocks have no adequate consensus. Leaving them out of the block.')
+
+        missing = [] if peers is None else [peer for peer in peers if peer not in responded]
+        self.timing.finish(missing=missing, early=not timed_out and contenders.responses < contenders.total_contacts)
 
-        if time.time() - started > self.seconds_to_timeout:
-            self.log.error(f'Block timeout. Too many delegates are offline! Kick out the non-responsive ones! {block}')
+        self.log.info(f'Done aggregating new block. Merkle proofs: {self.sbc_inbox.proven.stats}')
 
-        self.log.info('Done aggregating new block.')
+        # Proofs only apply to this height
+        self.sbc_inbox.proven.clear()
 
         block = contenders.get_current_best_block()
 
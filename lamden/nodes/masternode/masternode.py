@@ -1,10 +1,13 @@
 import asyncio
 import hashlib
+import json
 import time
+from contracting.db.encoder import encode
 from lamden import router
 from lamden.crypto.wallet import Wallet
-from lamden.storage import BlockStorage, get_latest_block_height
+from lamden.storage import BlockStorage, AsyncBlockStorage, get_latest_block_height
 from lamden.nodes.masternode import contender, webserver
+from lamden.nodes.masternode.mempool import Mempool
 from lamden.formatting import primatives
 from lamden.nodes import base
 from contracting.db.driver import ContractDriver
@@ -17,40 +20,76 @@ BLOCK_SERVICE = 'service'
 
 
 class BlockService(router.Processor):
-    def __init__(self, blocks: BlockStorage=None, driver=ContractDriver()):
+    def __init__(self, blocks: BlockStorage=None, driver=ContractDriver(), max_blocks=100, max_bytes=4_000_000,
+                 executor=None):
         self.blocks = blocks
+        self.async_blocks = AsyncBlockStorage(blocks, executor=executor)
         self.driver = driver
 
+        # Upper bounds for a single get_blocks response
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+
     async def process_message(self, msg):
         response = None
         mn_logger.debug('Got a msg')
         if primatives.dict_has_keys(msg, keys={'name', 'arg'}):
             if msg['name'] == base.GET_BLOCK:
-                response = self.get_block(msg)
+                response = await self.get_block(msg)
+            elif msg['name'] == base.GET_BLOCKS:
+                response = await self.get_blocks(msg)
             elif msg['name'] == base.GET_HEIGHT:
                 response = get_latest_block_height(self.driver)
 
         return response
 
-    def get_block(self, command):
+    async def get_block(self, command):
         num = command.get('arg')
         if not primatives.number_is_formatted(num):
             return None
 
-        block = self.blocks.get_block(num)
+        block = await self.async_blocks.get_block(num)
 
         if block is None:
             return None
 
         return block
 
+    async def get_blocks(self, command):
+        arg = command.get('arg')
+        if not isinstance(arg, dict):
+            return None
+
+        start = arg.get('start')
+        count = arg.get('count')
+        if not primatives.number_is_formatted(start) or not primatives.number_is_formatted(count):
+            return None
+
+        max_bytes = arg.get('max_bytes', self.max_bytes)
+        if not primatives.number_is_formatted(max_bytes):
+            return None
+
+        blocks = await self.async_blocks.get_blocks(start, min(count, self.max_blocks))
+
+        # Stop at the byte budget, but always return at least one block so the requester makes progress
+        size = 0
+        for i in range(len(blocks)):
+            size += len(encode(blocks[i]))
+            if size > min(max_bytes, self.max_bytes) and i > 0:
+                return blocks[:i]
+
+        return blocks
+
 
 class TransactionBatcher:
-    def __init__(self, wallet: Wallet, queue):
+    def __init__(self, wallet: Wallet, queue, stamp_budget=None):
         self.wallet = wallet
-        self.queue = queue
+        self.queue = queue if isinstance(queue, Mempool) else Mempool(txs=queue)
+
+        # Total stamps_supplied allowed in one batch. None means only tx_number limits it.
+        self.stamp_budget = stamp_budget
 
-    def make_batch(self, transactions):
+    def make_batch(self, transactions, height=None, previous=None):
         timestamp = int(time.time())
 
         h = hashlib.sha3_256()
@@ -67,39 +106,69 @@ class TransactionBatcher:
             'input_hash': input_hash
         }
 
+        # Tags the block the batch is meant for, so delegates can tell it apart from the rounds around it
+        if height is not None:
+            batch['height'] = height
+            batch['previous'] = previous
+
         mn_logger.debug(f'Made new batch of {len(transactions)} transactions.')
 
         return batch
 
-    def pack_current_queue(self, tx_number=250):
-        tx_list = []
-
-        # len(tx_list) < tx_number and
+    def pack_current_queue(self, tx_number=250, height=None, previous=None):
+        tx_list = self.queue.select(tx_number=tx_number, stamp_budget=self.stamp_budget)
 
-        while len(self.queue) > 0:
-            tx_list.append(self.queue.pop(0))
+        mn_logger.debug(f'Mempool: {self.queue.stats}')
 
-        batch = self.make_batch(tx_list)
+        batch = self.make_batch(tx_list, height=height, previous=previous)
 
         return batch
 
 
 class Masternode(base.Node):
-    def __init__(self, webserver_port=8080, *args, **kwargs):
+    def __init__(self, webserver_port=8080, pipelined=False, round_delay=1, batch_size=250, tx_expiry=300,
+                 *args, **kwargs):
         super().__init__(store=True, *args, **kwargs)
+
+        # Pipelined rounds send and store each block in the background while the next round is batched, and put back
+        # the transactions of a batch that did not make it into its block
+        self.pipelined = pipelined
+
+        # Longest pause before each round when not pipelined. It ends early once a full batch is waiting.
+        self.round_delay = round_delay
+        self.batch_size = batch_size
+
+        # Seconds an accepted transaction may wait in the mempool. The webserver holds up to 10,000 transactions,
+        # which is 40 rounds at the default batch size, so this must outlast that many rounds.
+        self.tx_expiry = tx_expiry
+
+        self.async_blocks = AsyncBlockStorage(self.blocks, executor=self.storage_executor)
+
+        # Background work of the last pipelined round
+        self.confirming = None
+        self.storing = None
+
+        # The batch this node sent for the round in progress
+        self.in_flight = None
         # Services
         self.webserver_port = webserver_port
         self.webserver = webserver.WebServer(
             contracting_client=self.client,
             driver=self.driver,
             blocks=self.blocks,
+            nonces=self.nonces,
             wallet=self.wallet,
-            port=self.webserver_port
+            port=self.webserver_port,
+            storage_executor=self.storage_executor
         )
         self.upgrade_manager.webserver_port = self.webserver_port
         self.upgrade_manager.node_type = 'masternode'
 
-        self.tx_batcher = TransactionBatcher(wallet=self.wallet, queue=[])
+        # New transactions wake up hang() and the wait for a full batch
+        self.tx_batcher = TransactionBatcher(
+            wallet=self.wallet,
+            queue=Mempool(expiry=tx_expiry, on_add=self.new_block_processor.notify, on_evict=self.release_nonce)
+        )
         self.webserver.queue = self.tx_batcher.queue
 
         self.aggregator = contender.Aggregator(
@@ -111,8 +180,14 @@ class Masternode(base.Node):
         # Network upgrade flag
         self.active_upgrade = False
 
+    def release_nonce(self, sender, processor, nonce):
+        # Expired transactions leave the mempool without reaching a block, so their nonces can be used again
+        asyncio.ensure_future(self.webserver.release_nonce(sender, processor, nonce))
+
     async def start(self):
-        self.router.add_service(base.BLOCK_SERVICE, BlockService(self.blocks, self.driver))
+        self.router.add_service(
+            base.BLOCK_SERVICE, BlockService(self.blocks, self.driver, executor=self.storage_executor)
+        )
 
         await super().start()
 
@@ -142,11 +217,13 @@ class Masternode(base.Node):
         # If another masternode has transactions, it will send use a new block notification.
         # If we have transactions, we will do the opposite. This 'wakes' up the network.
         mn_logger.debug('Waiting for work or blocks...')
-        while len(self.tx_batcher.queue) <= 0 and len(self.new_block_processor.q) <= 0:
-            if not self.running:
-                return
+        await self.new_block_processor.wait(
+            condition=lambda: len(self.tx_batcher.queue) > 0 or self.new_block_processor.has_items() or not self.running
+        )
+
+        if not self.running:
+            return
 
-            await asyncio.sleep(0)
         mn_logger.debug('Work / blocks available. Continuing.')
 
     async def broadcast_new_blockchain_started(self):
@@ -163,7 +240,8 @@ class Masternode(base.Node):
                     **self.get_delegate_peers(),
                     **self.get_masternode_peers()
                 },
-                ctx=self.ctx
+                ctx=self.ctx,
+                pool=self.socket_pool
             )
 
     async def new_blockchain_boot(self):
@@ -179,12 +257,14 @@ class Masternode(base.Node):
     async def wait_for_block(self):
         self.new_block_processor.clean(self.current_height)
 
-        while len(self.new_block_processor.q) <= 0:
-            if not self.running:
-                return
-            await asyncio.sleep(0)
+        await self.new_block_processor.wait(
+            condition=lambda: self.new_block_processor.has_items() or not self.running
+        )
 
-        block = self.new_block_processor.q.pop(0)
+        if not self.running:
+            return
+
+        block = self.new_block_processor.get()
         self.process_new_block(block)
 
     async def join_quorum(self):
@@ -199,12 +279,14 @@ class Masternode(base.Node):
         members = self.driver.get_var(contract='masternodes', variable='S', arguments=['members'], mark=False)
 
         if len(members) > 1:
-            while len(self.new_block_processor.q) <= 0:
-                if not self.running:
-                    return
-                await asyncio.sleep(0)
+            await self.new_block_processor.wait(
+                condition=lambda: self.new_block_processor.has_items() or not self.running
+            )
 
-            block = self.new_block_processor.q.pop(0)
+            if not self.running:
+                return
+
+            block = self.new_block_processor.get()
             self.process_new_block(block)
             self.new_block_processor.clean(self.current_height)
 
@@ -219,7 +301,12 @@ class Masternode(base.Node):
         # Else, batch some more txs
         self.log.info(f'Sending {len(self.tx_batcher.queue)} transactions.')
 
-        tx_batch = self.tx_batcher.pack_current_queue()
+        tx_batch = self.tx_batcher.pack_current_queue(
+            tx_number=self.batch_size,
+            height=self.current_height + 1,
+            previous=self.current_hash
+        )
+        self.in_flight = tx_batch
 
         # LOOK AT SOCKETS CLASS
         if len(self.get_delegate_peers()) == 0:
@@ -232,11 +319,16 @@ class Masternode(base.Node):
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.socket_pool
         )
 
     async def get_work_processed(self):
-        await asyncio.sleep(1)
+        if not self.pipelined:
+            await self.new_block_processor.wait(
+                condition=lambda: len(self.tx_batcher.queue) >= self.batch_size or not self.running,
+                timeout=self.round_delay
+            )
 
         await self.send_work()
 
@@ -249,45 +341,86 @@ class Masternode(base.Node):
             total_contacts=len(self.get_delegate_peers()),
             expected_subblocks=len(masters),
             current_height=self.current_height,
-            current_hash=self.current_hash
+            current_hash=self.current_hash,
+            peers=list(self.get_delegate_peers().keys())
         )
 
+        self.log.info(f'Round timing: {self.aggregator.timing.stats}')
+
         self.process_new_block(block)
 
         self.new_block_processor.clean(self.current_height)
 
+        if self.pipelined:
+            self.restore_unconfirmed(block)
+
         return block
 
-    async def loop(self):
-        self.log.info('=== ENTERING SEND WORK STATE ===')
-        self.upgrade_manager.version_check(constitution=self.make_constitution())
+    def restore_unconfirmed(self, block):
+        # Rolls back the batch sent for this block if its subblock is missing, e.g. the block failed
+        batch, self.in_flight = self.in_flight, None
 
-        block = await self.get_work_processed()
+        if batch is None or len(batch['transactions']) == 0:
+            return
+
+        confirmed = {sb['input_hash'] for sb in block['subblocks'] if block['hash'] != 'f' * 64}
+
+        if batch['input_hash'] not in confirmed:
+            self.log.error(f'Block {block["number"]} is missing our batch. Requeueing {len(batch["transactions"])} txs.')
+            self.tx_batcher.queue.restore(batch['transactions'])
+
+    def store_block(self, block):
+        if not self.pipelined:
+            return super().store_block(block)
+
+        # Written in the background, one block after the other
+        self.storing = asyncio.ensure_future(self.store_block_after(block, self.storing))
+
+    async def store_block_after(self, block, previous):
+        if previous is not None:
+            await previous
+
+        encoded_block = json.loads(encode(block))
+        await self.async_blocks.run(self.blocks.store_block, encoded_block)
 
+    async def send_block(self, block, peers):
         await router.secure_multicast(
             msg=block,
             service=base.NEW_BLOCK_SERVICE,
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
-            peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
+            peer_map=peers,
+            ctx=self.ctx,
+            pool=self.socket_pool
         )
 
+    async def loop(self):
+        self.log.info('=== ENTERING SEND WORK STATE ===')
+        self.upgrade_manager.version_check(constitution=self.make_constitution())
+
+        block = await self.get_work_processed()
+
+        if self.pipelined:
+            # Delegates get the block while this node waits for and batches the next round
+            if self.confirming is not None:
+                await self.confirming
+
+            self.confirming = asyncio.ensure_future(self.send_block(block, self.get_delegate_peers()))
+        else:
+            await self.send_block(block, self.get_delegate_peers())
+
         await self.hang()
 
-        await router.secure_multicast(
-            msg=block,
-            service=base.NEW_BLOCK_SERVICE,
-            cert_dir=self.socket_authenticator.cert_dir,
-            wallet=self.wallet,
-            peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
-        )
+        await self.send_block(block, self.get_masternode_peers())
 
-        self.aggregator.sbc_inbox.q.clear()
+        self.aggregator.sbc_inbox.clear()
 
     def stop(self):
         super().stop()
+
+        # Blocks still being stored are left to finish
+        if self.confirming is not None and not self.confirming.done():
+            self.confirming.cancel()
         self.router.socket.close()
         self.webserver.coroutine.result().close()
 
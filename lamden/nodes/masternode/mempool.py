@@ -0,0 +1,237 @@
+import heapq
+import itertools
+from lamden.cache import LRUCache
+from lamden.crypto import transaction
+from lamden.logger.base import get_logger
+
+log = get_logger('Mempool')
+
+
+class Entry:
+    def __init__(self, tx, seq):
+        self.tx = tx
+        self.seq = seq
+
+        self.sender = tx['payload']['sender']
+        self.processor = tx['payload'].get('processor')
+        self.nonce = tx['payload']['nonce']
+        self.stamps = tx['payload']['stamps_supplied']
+
+
+def is_transaction(tx):
+    try:
+        tx['payload']['sender']
+        tx['payload']['nonce']
+        tx['payload']['stamps_supplied']
+        tx['metadata']['timestamp']
+    except (KeyError, TypeError):
+        return False
+
+    return True
+
+
+class Mempool:
+    # Pending transactions indexed by sender and nonce. Batches are filled by stamps_supplied, highest first, while
+    # each sender's transactions still go out in nonce order and never past a gap.
+    # Appended like the list it replaces so the webserver and tests can keep using append / extend / len.
+    def __init__(self, txs=None, expiry=300, on_add=None, on_evict=None, idle_senders=10_000):
+        self.senders = {}
+
+        # Called after each accepted transaction so waiters on the mempool wake up
+        self.on_add = on_add
+
+        # Called as on_evict(sender, processor, nonce) with the lowest nonce of each sender's expired transactions, so
+        # the nonce can be handed out again
+        self.on_evict = on_evict
+
+        # Lowest nonce of each sender with pending transactions that can go into the next batch
+        self.next_nonces = {}
+
+        # The same for senders whose transactions have all left, so a later nonce still waits for the ones before it
+        self.idle_nonces = LRUCache(max_size=idle_senders)
+
+        self.expiry = expiry
+
+        # Transactions held across all senders
+        self.size = 0
+
+        self.seq = itertools.count()
+
+        self.added = 0
+        self.selected = 0
+        self.evicted = 0
+        self.rejected = 0
+
+        if txs is not None:
+            self.extend(txs)
+
+    def append(self, tx):
+        # Returns False if the transaction was rejected: it is malformed, its nonce was already batched, or it does not
+        # pay more than the transaction already held at its nonce
+        if not is_transaction(tx):
+            self.rejected += 1
+            return False
+
+        entry = Entry(tx, next(self.seq))
+
+        next_nonce = self.next_nonces.get(entry.sender)
+        if next_nonce is not None and entry.nonce < next_nonce:
+            self.rejected += 1
+            return False
+
+        pending = self.senders.setdefault(entry.sender, {})
+
+        # The same nonce twice only replaces the earlier transaction when it pays more
+        current = pending.get(entry.nonce)
+        if current is not None and current.stamps >= entry.stamps:
+            self.rejected += 1
+            return False
+
+        if current is None:
+            self.size += 1
+
+        pending[entry.nonce] = entry
+        self.added += 1
+
+        if next_nonce is None:
+            # A lower nonce than an idle sender left off at was handed out again, so the sender starts over from it
+            idle_nonce = self.idle_nonces.get(entry.sender, None)
+            if idle_nonce is None or entry.nonce < idle_nonce:
+                idle_nonce = entry.nonce
+
+            self.next_nonces[entry.sender] = idle_nonce
+            self.idle_nonces.pop(entry.sender)
+
+        self.notify()
+
+        return True
+
+    def notify(self):
+        if self.on_add is not None:
+            self.on_add()
+
+    def extend(self, txs):
+        for tx in txs:
+            self.append(tx)
+
+    def restore(self, txs):
+        # Puts back transactions that were selected but did not make it into a block, ahead of anything newer
+        for tx in txs:
+            if not is_transaction(tx):
+                continue
+
+            sender, nonce = tx['payload']['sender'], tx['payload']['nonce']
+
+            next_nonce = self.next_nonces.get(sender)
+            if next_nonce is not None and nonce < next_nonce:
+                self.next_nonces[sender] = nonce
+
+            self.append(tx)
+
+    def clear(self):
+        self.senders.clear()
+        self.next_nonces.clear()
+        self.idle_nonces.clear()
+        self.size = 0
+
+    def remove(self, sender, nonce):
+        pending = self.senders[sender]
+        del pending[nonce]
+        self.size -= 1
+
+        if len(pending) == 0:
+            del self.senders[sender]
+            self.idle_nonces.set(sender, self.next_nonces.pop(sender))
+
+    def evict_expired(self):
+        expired = []
+        for sender, pending in self.senders.items():
+            for nonce, entry in pending.items():
+                if not transaction.transaction_is_not_expired(entry.tx, timeout=self.expiry):
+                    expired.append(entry)
+
+        # Lowest expired nonce of each sender. The sender has to send it again before anything after it can go out.
+        released = {}
+        for entry in expired:
+            self.remove(entry.sender, entry.nonce)
+
+            key = (entry.sender, entry.processor)
+            if key not in released or entry.nonce < released[key]:
+                released[key] = entry.nonce
+
+        self.evicted += len(expired)
+
+        if len(expired) > 0:
+            log.warning(f'Evicted {len(expired)} expired transactions from {len(released)} senders.')
+
+        if self.on_evict is not None:
+            for (sender, processor), nonce in released.items():
+                self.on_evict(sender, processor, nonce)
+
+        return len(expired)
+
+    def head(self, sender):
+        # None when the sender's next nonce is missing, so nothing after the gap can be batched
+        pending = self.senders.get(sender)
+        if pending is None:
+            return None
+
+        return pending.get(self.next_nonces[sender])
+
+    def select(self, tx_number=250, stamp_budget=None):
+        self.evict_expired()
+
+        batch = []
+
+        # One candidate per sender: the transaction at its next nonce
+        ready = []
+        for sender in self.senders.keys():
+            entry = self.head(sender)
+            if entry is not None:
+                ready.append((-entry.stamps, entry.seq, sender))
+
+        heapq.heapify(ready)
+
+        stamps = 0
+        while len(ready) > 0 and len(batch) < tx_number:
+            _, _, sender = heapq.heappop(ready)
+            entry = self.head(sender)
+
+            # Senders that do not fit the stamp budget wait for the next batch
+            if stamp_budget is not None and stamps + entry.stamps > stamp_budget:
+                continue
+
+            batch.append(entry.tx)
+            stamps += entry.stamps
+
+            self.next_nonces[sender] = entry.nonce + 1
+            self.remove(sender, entry.nonce)
+
+            if sender in self.senders:
+                successor = self.head(sender)
+                if successor is not None:
+                    heapq.heappush(ready, (-successor.stamps, successor.seq, sender))
+
+        self.selected += len(batch)
+
+        return batch
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self),
+            'senders': len(self.senders),
+            'ready': sum(1 for sender in self.senders.keys() if self.head(sender) is not None),
+            'added': self.added,
+            'selected': self.selected,
+            'evicted': self.evicted,
+            'rejected': self.rejected
+        }
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for pending in self.senders.values():
+            for nonce in sorted(pending.keys()):
+                yield pending[nonce].tx
@@ -7,13 +7,14 @@ from contracting.db.encoder import encode, decode
 from contracting.db.driver import ContractDriver
 from contracting.compilation import parser
 from lamden import storage
-from lamden.crypto.canonical import tx_hash_from_tx
 from lamden.crypto.transaction import TransactionException
 
 import ssl
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from lamden.crypto import transaction
+from lamden.nodes.masternode.mempool import Mempool
 
 log = get_logger("MN-WebServer")
 
@@ -26,35 +27,72 @@ class ByteEncoder(_json.JSONEncoder):
         return super().default(self, o)
 
 
+def is_single_tx(message):
+    # A stream message holding one TX is a JSON object rather than a list. Checked without decoding it.
+    if isinstance(message, bytes):
+        message = message[:64].decode(errors='ignore')
+
+    return message.lstrip()[:1] == '{'
+
+
 class WebServer:
-    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks, queue=[], port=8080, ssl_port=443, ssl_enabled=False,
+    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks, queue=None, nonces=None,
+                 port=8080, ssl_port=443, ssl_enabled=False,
                  ssl_cert_file='~/.ssh/server.csr',
                  ssl_key_file='~/.ssh/server.key',
                  workers=2, debug=True, access_log=False,
                  max_queue_len=10_000,
+                 keep_alive=True, keep_alive_timeout=5,
+                 request_max_size=1_000_000, max_tx_size=10_000, max_batch_len=1_000,
+                 validation_executor=None, validation_workers=4, tx_timeout=5, storage_executor=None
                  ):
 
         # Setup base Sanic class and CORS
         self.app = Sanic(__name__)
         self.app.config.update({
-            'REQUEST_MAX_SIZE': 10000,
+            'REQUEST_MAX_SIZE': request_max_size,
+            # Stream messages are held to the same size as a request
+            'WEBSOCKET_MAX_SIZE': request_max_size,
             'REQUEST_TIMEOUT': 5,
-            'KEEP_ALIVE': False,
+            'KEEP_ALIVE': keep_alive,
+            'KEEP_ALIVE_TIMEOUT': keep_alive_timeout,
         })
         self.cors = None
 
         # Initialize the backend data interfaces
         self.client = contracting_client
         self.driver = driver
-        self.nonces = storage.NonceStorage()
+        # Share the node's nonce storage so that block commits keep the nonce cache current
+        self.nonces = nonces if nonces is not None else storage.NonceStorage()
         self.blocks = blocks
 
+        # Handlers await these so that Mongo I/O runs off the event loop, on the node's storage threads when given
+        self.async_nonces = storage.AsyncNonceStorage(self.nonces, executor=storage_executor)
+        self.async_blocks = storage.AsyncBlockStorage(self.blocks, executor=storage_executor)
+
+        # Stateless checks (format, signature, hash) run here so they stay off the event loop. Anything that reads
+        # contract state stays on the loop because the driver is not thread safe.
+        self.validation_executor = validation_executor
+        if self.validation_executor is None:
+            self.validation_executor = ThreadPoolExecutor(max_workers=validation_workers)
+
+        # Latest request holding each sender. Later requests for that sender wait on it before reserving nonces, so
+        # each sender's pending nonces are read, checked and reserved as one step. Other senders never wait.
+        self.sender_tails = {}
+
         self.static_headers = {}
 
         self.wallet = wallet
-        self.queue = queue
+        self.queue = queue if queue is not None else Mempool()
         self.max_queue_len = max_queue_len
 
+        # Batches may use the whole request size. Single transactions are held to the old limit.
+        self.max_tx_size = max_tx_size
+        self.max_batch_len = max_batch_len
+
+        # Seconds a transaction's timestamp may lag behind this node's clock when it is submitted
+        self.tx_timeout = tx_timeout
+
         self.port = port
 
         self.ssl_port = ssl_port
@@ -73,6 +111,8 @@ class WebServer:
 
         # Add Routes
         self.app.add_route(self.submit_transaction, '/', methods=['POST', 'OPTIONS'])
+        self.app.add_route(self.submit_transactions, '/batch', methods=['POST', 'OPTIONS'])
+        self.app.add_websocket_route(self.stream_transactions, '/stream')
         self.app.add_route(self.ping, '/ping', methods=['GET', 'OPTIONS'])
         self.app.add_route(self.get_id, '/id', methods=['GET'])
         self.app.add_route(self.get_nonce, '/nonce/<vk>', methods=['GET'])
@@ -127,59 +167,225 @@ class WebServer:
     async def submit_transaction(self, request):
         log.debug(f'New request: {request}')
         # Reject TX if the queue is too large
-        if len(self.queue) >= self.max_queue_len:
+        if self.queue_is_full():
             return response.json({'error': "Queue full. Resubmit shortly."}, status=503, headers={'Access-Control-Allow-Origin': '*'})
 
+        if len(request.body) > self.max_tx_size:
+            return response.json({'error': 'Transaction too large.'}, status=413, headers={'Access-Control-Allow-Origin': '*'})
+
         # Check that the payload is valid JSON
         tx = decode(request.body)
         if tx is None:
 
             return response.json({'error': 'Malformed request body.'}, headers={'Access-Control-Allow-Origin': '*'})
 
-        # Check that the TX is correctly formatted
-        try:
-            transaction.check_tx_formatting(tx, self.wallet.verifying_key)
-
-            transaction.transaction_is_valid(
-                transaction=tx,
-                expected_processor=self.wallet.verifying_key,
-                client=self.client,
-                nonces=self.nonces
-            )
+        results = await self.add_transactions([tx])
 
-            nonce, pending_nonce = transaction.get_nonces(
-                sender=tx['payload']['sender'],
-                processor=tx['payload']['processor'],
-                driver=self.nonces
-            )
+        return response.json(results[0], headers={'Access-Control-Allow-Origin': '*'})
 
-            pending_nonce = transaction.get_new_pending_nonce(
-                tx_nonce=tx['payload']['nonce'],
-                nonce=nonce,
-                pending_nonce=pending_nonce
-            )
+    # Submit a list of TXs in one request. Results come back in the same order.
+    async def submit_transactions(self, request):
+        log.debug(f'New batch request: {request}')
+        txs = decode(request.body)
+        if not isinstance(txs, list):
+            return response.json({'error': 'Malformed request body.'}, headers={'Access-Control-Allow-Origin': '*'})
 
-            self.nonces.set_pending_nonce(
-                sender=tx['payload']['sender'],
-                processor=tx['payload']['processor'],
-                value=pending_nonce
-            )
-        except TransactionException as e:
-            log.error(f'Tx has error: {type(e)}')
+        if len(txs) > self.max_batch_len:
             return response.json(
-                transaction.EXCEPTION_MAP[type(e)], headers={'Access-Control-Allow-Origin': '*'}
+                {'error': f'Too many transactions. Send at most {self.max_batch_len} per batch.'},
+                status=413, headers={'Access-Control-Allow-Origin': '*'}
             )
 
-        # Add TX to the processing queue
-        self.queue.append(tx)
+        results = await self.add_transactions(txs)
 
-        # Return the TX hash to the user so they can track it
-        tx_hash = tx_hash_from_tx(tx)
+        return response.json(results, headers={'Access-Control-Allow-Origin': '*'})
 
-        return response.json({
-            'success': 'Transaction successfully submitted to the network.',
-            'hash': tx_hash
-        }, headers={'Access-Control-Allow-Origin': '*'})
+    # Long lived WebSocket for high volume producers. Each message is a TX or a list of TXs and gets one reply.
+    async def stream_transactions(self, request, ws):
+        while True:
+            message = await ws.recv()
+            if message is None:
+                return
+
+            # Same guards as a single posted TX, before anything is decoded or verified
+            if self.queue_is_full():
+                await ws.send(encode({'error': "Queue full. Resubmit shortly."}))
+                continue
+
+            if is_single_tx(message) and len(message) > self.max_tx_size:
+                await ws.send(encode({'error': 'Transaction too large.'}))
+                continue
+
+            txs = decode(message)
+
+            if isinstance(txs, dict):
+                results = await self.add_transactions([txs])
+                await ws.send(encode(results[0]))
+
+            elif isinstance(txs, list) and len(txs) <= self.max_batch_len:
+                results = await self.add_transactions(txs)
+                await ws.send(encode(results))
+
+            else:
+                await ws.send(encode({'error': 'Malformed request body.'}))
+
+    def queue_is_full(self):
+        return len(self.queue) >= self.max_queue_len
+
+    async def add_transactions(self, txs: list):
+        results = [None for _ in range(len(txs))]
+
+        candidates = []
+        for i in range(len(txs)):
+            if isinstance(txs[i], dict):
+                candidates.append(i)
+            else:
+                results[i] = {'error': 'Malformed request body.'}
+
+        senders, done, earlier = self.hold_senders([txs[i] for i in candidates])
+
+        try:
+            await self.check_and_reserve(txs, candidates, results, earlier)
+        finally:
+            self.release_senders(senders, done)
+
+        return results
+
+    async def check_and_reserve(self, txs, candidates, results, earlier):
+        checks = await asyncio.get_event_loop().run_in_executor(
+            self.validation_executor,
+            transaction.check_tx_batch,
+            [txs[i] for i in candidates],
+            self.wallet.verifying_key
+        )
+
+        checked = []
+        hashes = {}
+        for i, (error, tx_hash) in zip(candidates, checks):
+            if error is not None:
+                log.error(f'Tx has error: {error}')
+                results[i] = transaction.EXCEPTION_MAP[error]
+                continue
+
+            checked.append(i)
+            hashes[i] = tx_hash
+
+        # Checks can finish out of order on the pool. Nonces are still reserved in the order requests arrived.
+        await asyncio.gather(*earlier)
+
+        # Load every sender's nonces into the cache at once so validation below does no Mongo I/O
+        senders = {(txs[i]['payload']['sender'], txs[i]['payload']['processor']) for i in checked}
+        await asyncio.gather(*[self.prefetch_nonces(sender, processor) for sender, processor in senders])
+
+        # In order, so consecutive nonces from one sender in the same batch are accepted
+        for i in checked:
+            if self.queue_is_full():
+                results[i] = {'error': "Queue full. Resubmit shortly."}
+                continue
+
+            try:
+                await self.reserve_nonce(txs[i])
+            except TransactionException as e:
+                log.error(f'Tx has error: {type(e)}')
+                results[i] = transaction.EXCEPTION_MAP[type(e)]
+                continue
+
+            # Add TX to the processing queue. Its nonce is handed back if the queue turns it down.
+            if not self.queue.append(txs[i]):
+                await self.reset_pending_nonce(
+                    sender=txs[i]['payload']['sender'],
+                    processor=txs[i]['payload']['processor'],
+                    nonce=txs[i]['payload']['nonce']
+                )
+                results[i] = {'error': 'Transaction nonce is already queued with as many stamps or more.'}
+                continue
+
+            # Return the TX hash to the user so they can track it
+            results[i] = {
+                'success': 'Transaction successfully submitted to the network.',
+                'hash': hashes[i]
+            }
+
+    def hold_senders(self, txs: list):
+        senders = set()
+        for tx in txs:
+            try:
+                senders.add(tx['payload']['sender'])
+            except (KeyError, TypeError):
+                continue
+
+        return self.hold(senders)
+
+    def hold(self, senders):
+        earlier = [self.sender_tails[sender] for sender in senders if sender in self.sender_tails]
+
+        done = asyncio.get_event_loop().create_future()
+        for sender in senders:
+            self.sender_tails[sender] = done
+
+        return senders, done, earlier
+
+    def release_senders(self, senders, done):
+        done.set_result(None)
+
+        for sender in senders:
+            if self.sender_tails.get(sender) is done:
+                del self.sender_tails[sender]
+
+    async def prefetch_nonces(self, sender, processor):
+        await self.async_nonces.get_nonce(sender=sender, processor=processor)
+        await self.async_nonces.get_pending_nonce(sender=sender, processor=processor)
+
+    async def reserve_nonce(self, tx):
+        # Must be called while holding the sender (see hold_senders), on a transaction whose signature has been checked
+        sender = tx['payload']['sender']
+        processor = tx['payload']['processor']
+
+        if not transaction.transaction_is_not_expired(tx, timeout=self.tx_timeout):
+            raise transaction.TransactionExpired
+
+        transaction.transaction_is_valid(
+            transaction=tx,
+            expected_processor=self.wallet.verifying_key,
+            client=self.client,
+            nonces=self.nonces,
+            signature_valid=True
+        )
+
+        nonce, pending_nonce = transaction.get_nonces(
+            sender=sender,
+            processor=processor,
+            driver=self.nonces
+        )
+
+        pending_nonce = transaction.get_new_pending_nonce(
+            tx_nonce=tx['payload']['nonce'],
+            nonce=nonce,
+            pending_nonce=pending_nonce
+        )
+
+        await self.async_nonces.set_pending_nonce(
+            sender=sender,
+            processor=processor,
+            value=pending_nonce
+        )
+
+    async def release_nonce(self, sender, processor, nonce):
+        # Lets a sender reuse a nonce whose transaction expired in the mempool. Holds the sender like a submission so
+        # it cannot interleave with a reservation.
+        senders, done, earlier = self.hold({sender})
+
+        try:
+            await asyncio.gather(*earlier)
+            await self.reset_pending_nonce(sender, processor, nonce)
+        finally:
+            self.release_senders(senders, done)
+
+    async def reset_pending_nonce(self, sender, processor, nonce):
+        # Must be called while holding the sender. Only ever lowers the pending nonce.
+        pending_nonce = await self.async_nonces.get_pending_nonce(sender=sender, processor=processor)
+        if pending_nonce is not None and pending_nonce > nonce:
+            await self.async_nonces.set_pending_nonce(sender=sender, processor=processor, value=nonce)
 
     # Network Status
     async def ping(self, request):
@@ -191,7 +397,7 @@ class WebServer:
 
     # Get the Nonce of a VK
     async def get_nonce(self, request, vk):
-        latest_nonce = self.nonces.get_latest_nonce(sender=vk, processor=self.wallet.verifying_key)
+        latest_nonce = await self.async_nonces.get_latest_nonce(sender=vk, processor=self.wallet.verifying_key)
 
         return response.json({
             'nonce': latest_nonce,
@@ -269,7 +475,7 @@ class WebServer:
     #     return response.json({'values': values, 'next': values[-1]}, status=200)
 
     async def get_latest_block(self, request):
-        index = self.blocks.get_last_n(n=1, collection=storage.BlockStorage.BLOCK)
+        index = await self.async_blocks.get_last_n(n=1, collection=storage.BlockStorage.BLOCK)
         if len(index) == 0:
             block = {
                 'hash': (b'\x00' * 32).hex(),
@@ -293,9 +499,9 @@ class WebServer:
         _hash = request.args.get('hash')
 
         if num is not None:
-            block = self.blocks.get_block(int(num))
+            block = await self.async_blocks.get_block(int(num))
         elif _hash is not None:
-            block = self.blocks.get_block(_hash)
+            block = await self.async_blocks.get_block(_hash)
         else:
             return response.json({'error': 'No number or hash provided.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
 
@@ -310,7 +516,7 @@ class WebServer:
         if _hash is not None:
             try:
                 int(_hash, 16)
-                tx = self.blocks.get_tx(_hash)
+                tx = await self.async_blocks.get_tx(_hash)
             except ValueError:
                 return response.json({'error': 'Malformed hash.'}, status=400, headers={'Access-Control-Allow-Origin': '*'})
         else:
@@ -1,5 +1,10 @@
 import asyncio
+import itertools
+from collections import deque
+import time
 from lamden.crypto.wallet import Wallet
+from lamden.cache import LRUCache
+from lamden import codec
 import zmq
 import zmq.asyncio
 from contracting.db.encoder import encode, decode
@@ -30,12 +35,126 @@ class Processor:
         raise NotImplementedError
 
 
-class QueueProcessor(Processor):
-    def __init__(self):
+class Inbox(Processor):
+    # Queue of received messages that coroutines can wait on without spinning. Producers call put(), or notify() after
+    # changing their own structures. Waiters only wake up on those calls or their timeout.
+    def __init__(self, max_size=None):
         self.q = []
 
+        # Items moved out of q by get() so they can be taken from the front in O(1)
+        self.ready = deque()
+
+        # New items are rejected past this size. None means unbounded.
+        self.max_size = max_size
+        self.dropped = 0
+
+        # Created on first wait so it belongs to the running loop
+        self.event = None
+
+        # Time from the first unhandled arrival until a waiter saw it
+        self.arrived = None
+        self.wakeups = 0
+        self.wakeup_latency = 0
+        self.max_wakeup_latency = 0
+
     async def process_message(self, msg):
-        self.q.append(msg)
+        self.put(msg)
+
+    def put(self, item):
+        # Returns False if the inbox is full. The new item is the one dropped so that whatever arrived first is still
+        # handled first.
+        if self.max_size is not None and self.size() >= self.max_size:
+            self.dropped += 1
+            return False
+
+        self.q.append(item)
+        self.notify()
+
+        return True
+
+    def get(self):
+        # Oldest item
+        if len(self.ready) == 0:
+            self.ready.extend(self.q)
+            self.q = []
+
+        return self.ready.popleft()
+
+    def drain(self):
+        # Swap in a fresh list rather than popping from the front one item at a time
+        items, self.q = self.q, []
+
+        if len(self.ready) > 0:
+            items = list(self.ready) + items
+            self.ready.clear()
+
+        return items
+
+    def clear(self):
+        self.q = []
+        self.ready.clear()
+
+    def size(self):
+        return len(self.ready) + len(self.q)
+
+    def notify(self):
+        if self.arrived is None:
+            self.arrived = time.time()
+
+        if self.event is not None:
+            self.event.set()
+
+    def has_items(self):
+        return self.size() > 0
+
+    async def wait(self, condition=None, timeout=None):
+        # Returns True once the condition holds (default: q is not empty) or False if the timeout passes first
+        if condition is None:
+            condition = self.has_items
+
+        started = time.time()
+
+        while not condition():
+            remaining = None if timeout is None else timeout - (time.time() - started)
+            if remaining is not None and remaining <= 0:
+                return False
+
+            if self.event is None:
+                self.event = asyncio.Event()
+
+            self.event.clear()
+
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        self.record_wakeup()
+        return True
+
+    def record_wakeup(self):
+        if self.arrived is None:
+            return
+
+        self.wakeup_latency = time.time() - self.arrived
+        self.max_wakeup_latency = max(self.max_wakeup_latency, self.wakeup_latency)
+        self.wakeups += 1
+
+        self.arrived = None
+
+    @property
+    def stats(self):
+        return {
+            'size': self.size(),
+            'dropped': self.dropped,
+            'wakeups': self.wakeups,
+            'wakeup_latency': self.wakeup_latency,
+            'max_wakeup_latency': self.max_wakeup_latency
+        }
+
+
+class QueueProcessor(Inbox):
+    pass
 
 
 '''
@@ -44,10 +163,15 @@ Router takes messages in the following format:
     'service': <name of service as string>,
     'msg': {
         <any JSON payload here>
-    }
+    },
+    'id': <optional request id>,
+    'codecs': <optional list of codecs the requester can decode>
 }
 It then sends the msg to the registered 'processor' and returns
-a message to the requester.
+a message to the requester. If the message has an id or offers
+codecs, the reply is wrapped as
+{'id': <request id>, 'msg': <response>, 'codec': <chosen codec>}.
+See lamden.codec for the wire format.
 '''
 
 
@@ -97,10 +221,12 @@ class AsyncInbox:
         await self.return_msg(_id, msg)
 
     async def return_msg(self, _id, msg):
+        frames = msg if isinstance(msg, list) else [msg]
+
         sent = False
         while not sent:
             try:
-                await self.socket.send_multipart([_id, msg])
+                await self.socket.send_multipart([_id, *frames])
                 sent = True
             except zmq.error.ZMQError:
                 self.socket.close()
@@ -125,6 +251,9 @@ class JSONAsyncInbox(AsyncInbox):
 
         super().__init__(*args, **kwargs)
 
+        # Identities that sent a binary codec get their replies in the same codec. Everyone else gets JSON.
+        self.peer_codecs = LRUCache(max_size=10_000)
+
     def setup_socket(self):
         self.socket = self.ctx.socket(zmq.ROUTER)
 
@@ -138,14 +267,21 @@ class JSONAsyncInbox(AsyncInbox):
         self.socket.bind(self.address)
 
     async def receive_message(self):
-        _id = await self.socket.recv()
-        msg = await self.socket.recv()
+        _id, *frames = await self.socket.recv_multipart()
+
+        if len(frames) == 0:
+            return _id, None
 
-        return _id, decode(msg)
+        # A negotiated codec wins over the header, which drops the compression suffix on small messages
+        name = codec.header(frames)
+        if name != codec.JSON and _id not in self.peer_codecs:
+            self.peer_codecs.set(_id, name)
+
+        return _id, codec.unpack(frames)
 
     async def return_msg(self, _id, msg):
-        msg = encode(msg).encode()
-        await super().return_msg(_id, msg)
+        frames = codec.pack(msg, self.peer_codecs.get(_id, None))
+        await super().return_msg(_id, frames)
 
 
 class Router(JSONAsyncInbox):
@@ -157,43 +293,312 @@ class Router(JSONAsyncInbox):
         self.log.propagate = debug
 
     async def handle_msg(self, _id, msg):
+        if not isinstance(msg, dict):
+            self.log.debug('Could not decode message.')
+            await self.reply(_id, None, OK)
+            return
+
         service = msg.get('service')
         request = msg.get('msg')
 
+        # Requests from multiplexed clients carry an id that must come back with the reply
+        request_id = msg.get('id')
+
+        # Newer peers offer the codecs they can decode. The choice rides back on the reply.
+        chosen = codec.negotiate(msg['codecs']) if 'codecs' in msg else None
+        if chosen is not None and chosen != codec.JSON:
+            self.peer_codecs.set(_id, chosen)
+
         self.log.debug(f'Message recieved for: {service}.')
 
         if service is None:
             self.log.debug('No service found for message.')
-            await super().return_msg(_id, OK)
+            await self.reply(_id, request_id, OK, chosen)
             return
 
         if request is None:
             self.log.debug('No request found in message.')
-            await super().return_msg(_id, OK)
+            await self.reply(_id, request_id, OK, chosen)
             return
 
         processor = self.services.get(service)
 
         if processor is None:
-            await super().return_msg(_id, OK)
+            await self.reply(_id, request_id, OK, chosen)
             return
 
         response = await processor.process_message(request)
 
         if response is None:
-            await super().return_msg(_id, OK)
+            await self.reply(_id, request_id, OK, chosen)
             return
 
-        await super().return_msg(_id, response)
+        await self.reply(_id, request_id, response, chosen)
+
+    async def reply(self, _id, request_id, response, chosen=None):
+        if request_id is not None or chosen is not None:
+            response = {
+                'id': request_id,
+                'msg': response
+            }
+
+            if chosen is not None:
+                response['codec'] = chosen
+
+        await self.return_msg(_id, response)
 
     def add_service(self, name: str, processor: Processor):
         self.services[name] = processor
 
 
-async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
+class Connection:
+    # Long lived CURVE DEALER sockets to a single peer. Sends and requests use separate sockets so that the OK
+    # replies to sends never reach the request reader.
+    def __init__(self, ctx: zmq.asyncio.Context, wallet: Wallet, server_pub, ip, linger=500, max_failures=3):
+        self.ctx = ctx
+        self.wallet = wallet
+        self.server_pub = server_pub
+        self.ip = ip
+        self.linger = linger
+
+        self.send_socket = None
+        self.request_socket = None
+
+        # Requests are multiplexed on the request socket. Each one carries an id that the Router echoes back.
+        self.request_ids = itertools.count()
+        self.pending = {}
+        self.reader = None
+
+        # JSON until the peer says which codec it picked. None means it has not been asked yet.
+        self.codec = None
+
+        # Consecutive timeouts before the request socket is considered unhealthy and rebuilt
+        self.max_failures = max_failures
+        self.failures = 0
+
+    def connect(self):
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, self.linger)
+        socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+
+        socket.curve_secretkey = self.wallet.curve_sk
+        socket.curve_publickey = self.wallet.curve_vk
+        socket.curve_serverkey = self.server_pub
+
+        try:
+            socket.connect(self.ip)
+        except ZMQBaseError:
+            logger.debug(f'Could not connect to {self.ip}')
+            socket.close()
+            return None
+
+        return socket
+
+    def encode(self, message: dict):
+        if self.codec is None:
+            offered = codec.available()
+            if len(offered) > 0:
+                message = {**message, 'codecs': offered}
+
+        return codec.pack(message, self.codec)
+
+    def adopt(self, response):
+        if isinstance(response, dict) and codec.supported(response.get('codec')):
+            self.codec = response['codec']
+
+    async def send(self, message: dict):
+        if self.send_socket is None:
+            self.send_socket = self.connect()
+
+            if self.send_socket is None:
+                return False
+
+        # Throw away the OK replies to earlier sends, keeping any codec the peer picked
+        while await self.send_socket.poll(timeout=0, flags=zmq.POLLIN):
+            self.adopt(codec.unpack(await self.send_socket.recv_multipart()))
+
+        try:
+            await self.send_socket.send_multipart(self.encode(message), flags=zmq.NOBLOCK)
+        except zmq.error.ZMQError:
+            self.reset_send()
+            return False
+
+        return True
+
+    async def request(self, message: dict, timeout=1000):
+        if self.request_socket is None:
+            self.request_socket = self.connect()
+
+            if self.request_socket is None:
+                return None
+
+            self.reader = asyncio.ensure_future(self.read_responses(self.request_socket))
+
+        request_id = next(self.request_ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+
+        try:
+            await self.request_socket.send_multipart(self.encode({**message, 'id': request_id}))
+            response = await asyncio.wait_for(future, timeout=timeout / 1000)
+        except (asyncio.TimeoutError, zmq.error.ZMQError):
+            self.pending.pop(request_id, None)
+
+            self.failures += 1
+
+            # Rebuilding the socket ends every request on it, so leave that to the last one still waiting
+            if self.failures >= self.max_failures and len(self.pending) == 0:
+                logger.debug(f'{self.ip} stopped responding. Reconnecting.')
+                self.reset_request()
+
+            return None
+
+        self.failures = 0
+        return response
+
+    async def read_responses(self, socket):
+        while True:
+            try:
+                response = codec.unpack(await socket.recv_multipart())
+            except asyncio.CancelledError:
+                return
+            except zmq.error.ZMQError:
+                return
+
+            if not isinstance(response, dict):
+                continue
+
+            self.adopt(response)
+
+            request_id = response.get('id')
+
+            # Peers without correlation ids reply with the bare response. Only safe to match with one request waiting.
+            if request_id is None:
+                if len(self.pending) != 1:
+                    continue
+                request_id = next(iter(self.pending.keys()))
+            else:
+                response = response.get('msg')
+
+            # Late replies to requests that already timed out are dropped here
+            future = self.pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+    def reset_send(self):
+        if self.send_socket is not None:
+            self.send_socket.close()
+        self.send_socket = None
+
+    def reset_request(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        self.reader = None
+
+        if self.request_socket is not None:
+            self.request_socket.close()
+        self.request_socket = None
+
+        # Requests still waiting get no reply rather than a CancelledError their callers do not expect
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(None)
+        self.pending.clear()
+
+        self.failures = 0
+
+    def close(self):
+        self.reset_send()
+        self.reset_request()
+
+
+class SocketPool:
+    # Keeps one Connection per (vk, ip) and caches server certificates so repeated messages skip the handshake
+    def __init__(self, ctx: zmq.asyncio.Context, wallet: Wallet, cert_dir=DEFAULT_DIR, linger=500):
+        self.ctx = ctx
+        self.wallet = wallet
+        self.cert_dir = cert_dir
+        self.linger = linger
+
+        self.connections = {}
+        self.certs = {}
+
+    def server_key(self, vk):
+        server_pub = self.certs.get(vk)
+
+        if server_pub is None:
+            # Only peers with a certificate on disk (the current governance set) can be reached
+            filename = str(self.cert_dir / f'{vk}.key')
+            if not os.path.exists(filename):
+                return None
+
+            server_pub, _ = load_certificate(filename)
+            self.certs[vk] = server_pub
+
+        return server_pub
+
+    def get(self, vk, ip):
+        connection = self.connections.get((vk, ip))
+
+        if connection is None:
+            server_pub = self.server_key(vk)
+            if server_pub is None:
+                return None
+
+            connection = Connection(ctx=self.ctx, wallet=self.wallet, server_pub=server_pub, ip=ip, linger=self.linger)
+            self.connections[(vk, ip)] = connection
+
+        return connection
+
+    def evict(self, vk):
+        self.certs.pop(vk, None)
+
+        for key in [key for key in self.connections.keys() if key[0] == vk]:
+            self.connections.pop(key).close()
+
+    def retain(self, vks):
+        # Drop every connection and certificate that is not for one of the given verifying keys
+        vks = set(vks)
+
+        for vk in {key[0] for key in self.connections.keys()} | set(self.certs.keys()):
+            if vk not in vks:
+                self.evict(vk)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+        self.connections.clear()
+        self.certs.clear()
+
+
+def check_pool_cert_dir(cert_dir, pool: SocketPool):
+    # Pooled sockets load certificates from the pool's directory. Callers that name another one are refused rather
+    # than silently authenticated against the wrong certificates. None means the pool's.
+    if cert_dir is not None:
+        assert pathlib.Path(cert_dir) == pathlib.Path(pool.cert_dir), \
+            f'Socket pool uses certificates in {pool.cert_dir}, not {cert_dir}.'
+
+
+async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=None,
+                      pool: SocketPool=None):
     #if wallet.verifying_key == vk:
     #    return
 
+    if pool is not None:
+        check_pool_cert_dir(cert_dir, pool)
+
+        connection = pool.get(vk, ip)
+        if connection is None:
+            return None
+
+        message = build_message(service=service, message=msg)
+        await connection.send(message)
+        return
+
+    if cert_dir is None:
+        cert_dir = DEFAULT_DIR
+
     socket = ctx.socket(zmq.DEALER)
     socket.setsockopt(zmq.LINGER, linger)
     socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
@@ -224,10 +629,23 @@ async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.async
 
 
 async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context,
-                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR):
+                         linger=500, timeout=1000, cert_dir=None, pool: SocketPool=None):
     #if wallet.verifying_key == vk:
     #    return
 
+    if pool is not None:
+        check_pool_cert_dir(cert_dir, pool)
+
+        connection = pool.get(vk, ip)
+        if connection is None:
+            return None
+
+        message = build_message(service=service, message=msg)
+        return await connection.request(message, timeout=timeout)
+
+    if cert_dir is None:
+        cert_dir = DEFAULT_DIR
+
     socket = ctx.socket(zmq.DEALER)
     socket.setsockopt(zmq.LINGER, linger)
     socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
@@ -269,11 +687,13 @@ async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: s
     return msg
 
 
-async def secure_multicast(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
+async def secure_multicast(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, linger=500, cert_dir=None,
+                           pool: SocketPool=None):
     coroutines = []
     for vk, ip in peer_map.items():
         coroutines.append(
-            secure_send(msg=msg, service=service, cert_dir=cert_dir, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger)
+            secure_send(msg=msg, service=service, cert_dir=cert_dir, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger,
+                        pool=pool)
         )
 
     await asyncio.gather(*coroutines)
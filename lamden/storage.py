@@ -1,7 +1,13 @@
 from contracting.db.driver import ContractDriver
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, OperationFailure, ConnectionFailure
 
 import lamden
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from lamden.cache import LRUCache, MISSING
 from lamden.logger.base import get_logger
 
 BLOCK_HASH_KEY = '_current_block_hash'
@@ -11,9 +17,83 @@ PENDING_NONCE_KEY = '__pn'
 
 log = get_logger('STATE')
 
+# (keys, name) of the unique indexes each collection is expected to have
+BLOCK_INDEXES = [
+    ([('number', ASCENDING)], 'number_unique'),
+    ([('hash', ASCENDING)], 'hash_unique')
+]
+
+TX_INDEXES = [
+    ([('hash', ASCENDING)], 'hash_unique')
+]
+
+NONCE_INDEXES = [
+    ([('sender', ASCENDING), ('processor', ASCENDING)], 'sender_processor_unique')
+]
+
+
+def create_indexes(collection, indexes):
+    # Returns a message for every index that could not be created. Never raises, so a node still starts when Mongo is
+    # down or the collection holds duplicates; `cil indexes verify` reports what is missing.
+    errors = []
+
+    for keys, name in indexes:
+        try:
+            collection.create_index(keys, name=name, unique=True)
+        except OperationFailure as e:
+            errors.append(f'Could not create index {name} on {collection.name}: {e}')
+        except ConnectionFailure as e:
+            # Every other index would wait out the same server selection timeout
+            errors.append(f'Could not reach Mongo to create indexes on {collection.name}: {e}')
+            break
+
+    for error in errors:
+        log.error(error)
+
+    return errors
+
+
+def missing_indexes(collection, indexes):
+    existing = collection.index_information()
+
+    return [name for _, name in indexes if name not in existing or not existing[name].get('unique')]
+
+
+def find_duplicates(collection, keys, limit=10):
+    # Values of the index keys held by more than one document, which a unique index would reject
+    results = collection.aggregate([
+        {'$group': {'_id': {key: f'${key}' for key, _ in keys}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': limit}
+    ], allowDiskUse=True)
+
+    return [result['_id'] for result in results]
+
+
+def rebuild_indexes(collection, indexes):
+    # Returns a message for every index that could not be rebuilt. An index is only dropped once its re-create can
+    # succeed, so duplicates leave the existing index in place.
+    errors = []
+    existing = collection.index_information()
+
+    for keys, name in indexes:
+        duplicates = find_duplicates(collection, keys)
+        if len(duplicates) > 0:
+            errors.append(f'Not rebuilding index {name} on {collection.name}. Remove the duplicate documents first: '
+                          f'{duplicates}')
+            continue
+
+        if name in existing:
+            collection.drop_index(name)
+
+        errors.extend(create_indexes(collection, [(keys, name)]))
+
+    return errors
+
 
 class NonceStorage:
-    def __init__(self, port=27027, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces', config_path=lamden.__path__[0]):
+    def __init__(self, port=27027, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces',
+                 config_path=lamden.__path__[0], cache_size=10_000):
         self.config_path = config_path
 
         self.port = port
@@ -23,6 +103,26 @@ class NonceStorage:
         self.nonces = self.db[nonce_collection]
         self.pending_nonces = self.db[pending_collection]
 
+        # Write-through caches keyed by (sender, processor). Every write goes through this object, so a cached
+        # value (including None) is always what Mongo holds.
+        self.nonce_cache = LRUCache(max_size=cache_size)
+        self.pending_nonce_cache = LRUCache(max_size=cache_size)
+
+        self.create_indexes()
+
+    def create_indexes(self):
+        create_indexes(self.nonces, NONCE_INDEXES)
+        create_indexes(self.pending_nonces, NONCE_INDEXES)
+
+    def missing_indexes(self):
+        return {
+            self.nonces.name: missing_indexes(self.nonces, NONCE_INDEXES),
+            self.pending_nonces.name: missing_indexes(self.pending_nonces, NONCE_INDEXES)
+        }
+
+    def rebuild_indexes(self):
+        return rebuild_indexes(self.nonces, NONCE_INDEXES) + rebuild_indexes(self.pending_nonces, NONCE_INDEXES)
+
     @staticmethod
     def get_one(sender, processor, db):
         v = db.find_one(
@@ -52,17 +152,61 @@ class NonceStorage:
             }, upsert=True
         )
 
+    def get_cached(self, sender, processor, db, cache: LRUCache):
+        value = cache.get((sender, processor))
+
+        if value is MISSING:
+            # Runs off the event loop for async callers, so a write can land between the read and the fill. The
+            # write always wins.
+            value = cache.add((sender, processor), self.get_one(sender, processor, db))
+
+        return value
+
     def get_nonce(self, sender, processor):
-        return self.get_one(sender, processor, self.nonces)
+        return self.get_cached(sender, processor, self.nonces, self.nonce_cache)
 
     def get_pending_nonce(self, sender, processor):
-        return self.get_one(sender, processor, self.pending_nonces)
+        return self.get_cached(sender, processor, self.pending_nonces, self.pending_nonce_cache)
 
     def set_nonce(self, sender, processor, value):
         self.set_one(sender, processor, value, self.nonces)
+        self.nonce_cache.set((sender, processor), value)
 
     def set_pending_nonce(self, sender, processor, value):
         self.set_one(sender, processor, value, self.pending_nonces)
+        self.pending_nonce_cache.set((sender, processor), value)
+
+    def set_nonces(self, nonces: dict):
+        # Commits a write batch of {(sender, processor): value} and clears the matching pending nonces
+        if len(nonces) == 0:
+            return
+
+        nonce_requests = []
+        pending_requests = []
+
+        for (sender, processor), value in nonces.items():
+            q = {
+                'sender': sender,
+                'processor': processor
+            }
+
+            nonce_requests.append(UpdateOne(q, {'$set': {'value': value}}, upsert=True))
+            pending_requests.append(DeleteOne(q))
+
+        self.nonces.bulk_write(nonce_requests, ordered=False)
+        self.pending_nonces.bulk_write(pending_requests, ordered=False)
+
+        # A committed block is the only thing that moves nonces forward, so refresh the cache here
+        for key, value in nonces.items():
+            self.nonce_cache.set(key, value)
+            self.pending_nonce_cache.set(key, None)
+
+    @property
+    def cache_stats(self):
+        return {
+            'nonces': self.nonce_cache.stats,
+            'pending_nonces': self.pending_nonce_cache.stats
+        }
 
     def get_latest_nonce(self, sender, processor):
         latest_nonce = self.get_pending_nonce(sender=sender, processor=processor)
@@ -78,9 +222,16 @@ class NonceStorage:
     def flush(self):
         self.nonces.drop()
         self.pending_nonces.drop()
+        self.nonce_cache.clear()
+        self.pending_nonce_cache.clear()
+
+        self.create_indexes()
 
     def flush_pending(self):
         self.pending_nonces.drop()
+        self.pending_nonce_cache.clear()
+
+        create_indexes(self.pending_nonces, NONCE_INDEXES)
 
 
 def get_latest_block_hash(driver: ContractDriver):
@@ -105,30 +256,33 @@ def set_latest_block_height(h, driver: ContractDriver):
     driver.driver.set(BLOCK_NUM_HEIGHT, h)
 
 
-def update_state_with_transaction(tx, driver: ContractDriver, nonces: NonceStorage):
-    nonces_to_delete = []
+def update_state_with_transaction(tx, driver: ContractDriver, nonces: NonceStorage, nonce_batch: dict=None):
+    # Without a batch from the caller, the nonce is committed straight away
+    commit = nonce_batch is None
+    if commit:
+        nonce_batch = {}
 
     if tx['state'] is not None and len(tx['state']) > 0:
         for delta in tx['state']:
             driver.driver.set(delta['key'], delta['value'])
             log.debug(f"{delta['key']} -> {delta['value']}")
 
-            nonces.set_nonce(
-                sender=tx['transaction']['payload']['sender'],
-                processor=tx['transaction']['payload']['processor'],
-                value=tx['transaction']['payload']['nonce'] + 1
-            )
-
-            nonces_to_delete.append((tx['transaction']['payload']['sender'], tx['transaction']['payload']['processor']))
+        payload = tx['transaction']['payload']
+        nonce_batch[(payload['sender'], payload['processor'])] = payload['nonce'] + 1
 
-    for n in nonces_to_delete:
-        nonces.set_pending_nonce(*n, value=None)
+    if commit:
+        nonces.set_nonces(nonce_batch)
 
 
 def update_state_with_block(block, driver: ContractDriver, nonces: NonceStorage):
+    # Collapse nonce updates to the last value per (sender, processor) and write them once per block
+    nonce_batch = {}
+
     for sb in block['subblocks']:
         for tx in sb['transactions']:
-            update_state_with_transaction(tx, driver, nonces)
+            update_state_with_transaction(tx, driver, nonces, nonce_batch)
+
+    nonces.set_nonces(nonce_batch)
 
     # Update our block hash and block num
     set_latest_block_hash(block['hash'], driver=driver)
@@ -139,18 +293,38 @@ class BlockStorage:
     BLOCK = 0
     TX = 1
 
-    def __init__(self, port=27027, config_path=lamden.__path__[0], db='lamden', blocks_collection='blocks', tx_collection='tx'):
+    def __init__(self, port=27027, config_path=lamden.__path__[0], db='lamden', blocks_collection='blocks', tx_collection='tx',
+                 ordered_writes=False):
         # Setup configuration file to read constants
         self.config_path = config_path
 
         self.port = port
 
+        # Ordered bulk writes stop at the first error. Unordered ones let Mongo apply the batch in parallel.
+        self.ordered_writes = ordered_writes
+        self.last_write_latency = None
+
         self.client = MongoClient()
         self.db = self.client.get_database(db)
 
         self.blocks = self.db[blocks_collection]
         self.txs = self.db[tx_collection]
 
+        self.create_indexes()
+
+    def create_indexes(self):
+        create_indexes(self.blocks, BLOCK_INDEXES)
+        create_indexes(self.txs, TX_INDEXES)
+
+    def missing_indexes(self):
+        return {
+            self.blocks.name: missing_indexes(self.blocks, BLOCK_INDEXES),
+            self.txs.name: missing_indexes(self.txs, TX_INDEXES)
+        }
+
+    def rebuild_indexes(self):
+        return rebuild_indexes(self.blocks, BLOCK_INDEXES) + rebuild_indexes(self.txs, TX_INDEXES)
+
     def q(self, v):
         if isinstance(v, int):
             return {'number': v}
@@ -200,6 +374,14 @@ class BlockStorage:
 
         return blocks
 
+    def get_blocks(self, start, count):
+        # One sorted range query for a run of consecutive blocks
+        block_query = self.blocks.find(
+            {'number': {'$gte': start, '$lt': start + count}}, {'_id': False}
+        ).sort('number', ASCENDING).limit(count)
+
+        return [block for block in block_query]
+
     def get_tx(self, h):
         tx = self.txs.find_one({'hash': h})
 
@@ -212,14 +394,116 @@ class BlockStorage:
         self.blocks.drop()
         self.txs.drop()
 
+        self.create_indexes()
+
     def flush(self):
         self.drop_collections()
 
-    def store_block(self, block):
-        self.put(block, BlockStorage.BLOCK)
-        self.store_txs(block)
+    @staticmethod
+    def upsert(data):
+        # Replacing by hash makes replaying the same block or tx a no-op instead of a duplicate
+        return ReplaceOne({'hash': data['hash']}, data, upsert=True)
+
+    def store_block(self, block, ordered=None):
+        if ordered is None:
+            ordered = self.ordered_writes
+
+        start = time.perf_counter()
+
+        try:
+            self.blocks.bulk_write([self.upsert(block)], ordered=ordered)
+        except BulkWriteError:
+            # A different block is already stored at this height
+            log.error(f'Block #{block.get("number")} conflicts with a stored block. Not storing.')
+            return None
+
+        tx_count = self.store_txs(block, ordered=ordered)
+
+        self.last_write_latency = time.perf_counter() - start
+
+        log.info(f'Stored block #{block.get("number")} with {tx_count} txs in '
+                 f'{self.last_write_latency * 1000:.2f}ms.')
+
+        return self.last_write_latency
+
+    def store_txs(self, block, ordered=None):
+        if ordered is None:
+            ordered = self.ordered_writes
+
+        requests = [
+            self.upsert(tx) for subblock in block['subblocks'] for tx in subblock['transactions']
+        ]
+
+        # Mongo rejects empty bulk writes
+        if len(requests) > 0:
+            self.txs.bulk_write(requests, ordered=ordered)
+
+        return len(requests)
+
+
+# Used by async wrappers that are not given an executor, so that creating one does not start more threads. Nodes
+# pass their own, which they shut down when they stop.
+shared_executor = None
+
+
+def get_shared_executor(max_workers=4):
+    global shared_executor
+    if shared_executor is None:
+        shared_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    return shared_executor
+
+
+class AsyncStorage:
+    # Runs blocking pymongo calls on a thread pool so that awaiting them does not stall the event loop
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+
+        if executor is None:
+            executor = get_shared_executor()
+
+        self.executor = executor
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+
+class AsyncBlockStorage(AsyncStorage):
+    async def get_block(self, v=None):
+        return await self.run(self.storage.get_block, v)
+
+    async def get_last_n(self, n, collection=BlockStorage.BLOCK):
+        return await self.run(self.storage.get_last_n, n, collection)
+
+    async def get_blocks(self, start, count):
+        return await self.run(self.storage.get_blocks, start, count)
+
+    async def get_tx(self, h):
+        return await self.run(self.storage.get_tx, h)
+
+    async def put(self, data, collection=BlockStorage.BLOCK):
+        return await self.run(self.storage.put, data, collection)
+
+    async def store_block(self, block, ordered=None):
+        return await self.run(self.storage.store_block, block, ordered)
+
+
+class AsyncNonceStorage(AsyncStorage):
+    async def get_nonce(self, sender, processor):
+        return await self.run(self.storage.get_nonce, sender, processor)
+
+    async def get_pending_nonce(self, sender, processor):
+        return await self.run(self.storage.get_pending_nonce, sender, processor)
+
+    async def set_nonce(self, sender, processor, value):
+        return await self.run(self.storage.set_nonce, sender, processor, value)
+
+    async def set_pending_nonce(self, sender, processor, value):
+        return await self.run(self.storage.set_pending_nonce, sender, processor, value)
+
+    async def set_nonces(self, nonces: dict):
+        return await self.run(self.storage.set_nonces, nonces)
 
-    def store_txs(self, block):
-        for subblock in block['subblocks']:
-            for tx in subblock['transactions']:
-                self.put(tx, BlockStorage.TX)
+    async def get_latest_nonce(self, sender, processor):
+        return await self.run(self.storage.get_latest_nonce, sender, processor)
@@ -0,0 +1,100 @@
+from collections import defaultdict, deque
+import math
+
+'''
+Deadlines for rounds that wait on several peers. Each peer's response times are kept over a sliding window and the
+round deadline is the slowest peer's percentile times a margin, clamped between minimum and maximum.
+
+Peers that never answer add no samples, so an offline peer costs one learned deadline per round instead of the
+maximum. A round that times out waiting on a peer that usually answers doubles the next deadline (up to maximum) in
+case everyone simply got slower. Once a peer has missed more than patience rounds in a row it is taken to be offline
+and stops stretching the deadline.
+'''
+
+
+class AdaptiveTimeout:
+    def __init__(self, initial=10, minimum=1, maximum=300, percentile=0.99, margin=1.5, window=100, patience=2):
+        # Used until any peer has answered
+        self.initial = initial
+
+        self.minimum = minimum
+        self.maximum = maximum
+
+        self.percentile = percentile
+        self.margin = margin
+
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.backoff = 1
+        self.patience = patience
+
+        # Last deadline handed out
+        self.current = None
+
+        self.rounds = 0
+        self.early = 0
+        self.timeouts = 0
+
+        # Rounds in a row each peer has missed
+        self.misses = defaultdict(int)
+
+    def record(self, peer, latency):
+        self.samples[peer].append(latency)
+        self.misses.pop(peer, None)
+
+    def peer_latency(self, peer):
+        samples = self.samples.get(peer)
+        if not samples:
+            return None
+
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, math.ceil(self.percentile * len(ordered)) - 1)]
+
+    def timeout(self, peers=None):
+        if peers is None:
+            peers = list(self.samples.keys())
+
+        latencies = [self.peer_latency(peer) for peer in peers]
+        latencies = [latency for latency in latencies if latency is not None]
+
+        if len(latencies) == 0:
+            deadline = self.initial
+        else:
+            deadline = max(latencies) * self.margin
+
+        self.current = min(self.maximum, max(self.minimum, deadline * self.backoff))
+
+        return self.current
+
+    def finish(self, missing=(), early=False):
+        # Closes a round. Missing are the peers that had not answered when it ended. Early rounds ended before the
+        # deadline because the outcome was already decided, so their missing peers do not count as timeouts.
+        self.rounds += 1
+
+        for peer in missing:
+            self.misses[peer] += 1
+
+        if early:
+            self.early += 1
+            return
+
+        if len(missing) > 0:
+            self.timeouts += 1
+
+        slow = [peer for peer in missing if peer in self.samples and self.misses[peer] <= self.patience]
+
+        if len(slow) > 0 and (self.current is None or self.current < self.maximum):
+            self.backoff *= 2
+        elif len(slow) == 0:
+            self.backoff = 1
+
+    @property
+    def stats(self):
+        return {
+            'timeout': self.current,
+            'backoff': self.backoff,
+            'peers': {peer[:8]: self.peer_latency(peer) for peer in self.samples.keys()},
+            'rounds': self.rounds,
+            'early': self.early,
+            'timeouts': self.timeouts,
+            'misses': {peer[:8]: misses for peer, misses in self.misses.items()}
+        }
@@ -16,6 +16,8 @@ setup(
         "coloredlogs",
         "pymongo",
         "pyzmq",
+        "msgpack",
+        "zstandard",
         "requests",
         "contracting",
         "checksumdir",
@@ -163,6 +163,117 @@ class TestNode(TestCase):
         self.loop.run_until_complete(tasks)
         self.assertEqual(storage.get_latest_block_height(node.driver), 4)
 
+    def test_fetch_and_process_blocks_applies_out_of_order_responses_in_order(self):
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver,
+            catchup_window=3,
+            catchup_batch_size=1
+        )
+
+        blocks = generate_blocks(5)
+
+        async def request_blocks(start, count, peer):
+            # Later heights answer first
+            await asyncio.sleep(0.01 * (6 - start))
+            return blocks[start - 1:start - 1 + count]
+
+        node.request_blocks = request_blocks
+
+        self.loop.run_until_complete(node.fetch_and_process_blocks(start=1, end=5, peers=[('vk', 'ip')]))
+
+        self.assertEqual(storage.get_latest_block_height(node.driver), 5)
+        self.assertEqual(storage.get_latest_block_hash(node.driver), blocks[4]['hash'])
+
+    def test_fetch_and_process_blocks_retries_missing_block_on_next_peer(self):
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver
+        )
+
+        blocks = generate_blocks(2)
+
+        async def request_blocks(start, count, peer):
+            if peer[0] == 'bad':
+                return []
+            return blocks[start - 1:start - 1 + count]
+
+        node.request_blocks = request_blocks
+
+        self.loop.run_until_complete(
+            node.fetch_and_process_blocks(start=1, end=2, peers=[('bad', 'ip'), ('good', 'ip')])
+        )
+
+        self.assertEqual(storage.get_latest_block_height(node.driver), 2)
+
+    def test_fetch_and_process_blocks_stops_after_max_attempts(self):
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver
+        )
+
+        blocks = generate_blocks(3)
+
+        async def request_blocks(start, count, peer):
+            # Block 2 is never available
+            return blocks[start - 1:min(start - 1 + count, 1)]
+
+        node.request_blocks = request_blocks
+
+        self.loop.run_until_complete(node.fetch_and_process_blocks(start=1, end=3, peers=[('vk', 'ip')]))
+
+        self.assertEqual(storage.get_latest_block_height(node.driver), 1)
+
+    def test_fetch_and_process_blocks_continues_partial_batch(self):
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver,
+            catchup_batch_size=4
+        )
+
+        blocks = generate_blocks(4)
+        requests = []
+
+        async def request_blocks(start, count, peer):
+            requests.append((start, count))
+            # Only ever return two blocks, like a byte budget being hit
+            return blocks[start - 1:start - 1 + min(count, 2)]
+
+        node.request_blocks = request_blocks
+
+        self.loop.run_until_complete(node.fetch_and_process_blocks(start=1, end=4, peers=[('vk', 'ip')]))
+
+        self.assertEqual(requests, [(1, 4), (3, 2)])
+        self.assertEqual(storage.get_latest_block_height(node.driver), 4)
+
     def test_should_process_block_false_if_failed_block(self):
         block = {
             'hash': 'f' * 64,
@@ -323,6 +434,32 @@ class TestNode(TestCase):
 
         self.assertEqual(b, block)
 
+    def test_process_new_block_does_not_store_invalid_block(self):
+        block = canonical.block_from_subblocks(
+            subblocks=[],
+            previous_hash='a' * 64,
+            block_num=1
+        )
+
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver,
+            store=True,
+            blocks=self.blocks,
+        )
+
+        node.process_new_block(block)
+
+        self.assertIsNone(node.blocks.get_block(1))
+        self.assertEqual(node.current_height, 0)
+
     def test_process_new_block_clears_cache(self):
         block = canonical.block_from_subblocks(
             subblocks=[],
@@ -531,6 +668,29 @@ class TestNode(TestCase):
 
         self.assertEqual(nb.q, [])
 
+    def test_clean_removes_nbns_at_or_below_height(self):
+        nb = base.NewBlock(driver=ContractDriver())
+
+        nb.q.append({'number': 1})
+        nb.q.append({'number': 2})
+        nb.q.append({'number': 3})
+
+        nb.clean(2)
+
+        self.assertEqual(nb.q, [{'number': 3}])
+
+    def test_full_new_block_drops_highest_number(self):
+        nb = base.NewBlock(driver=ContractDriver(), max_size=2)
+
+        nb.put({'number': 2})
+        nb.put({'number': 3})
+
+        self.assertTrue(nb.put({'number': 1}))
+        self.assertFalse(nb.put({'number': 4}))
+
+        self.assertEqual(nb.drain(), [{'number': 2}, {'number': 1}])
+        self.assertEqual(nb.dropped, 2)
+
     def test_get_member_peers_returns_vk_ip_pairs(self):
         mn_wallet = Wallet()
         dl_wallet = Wallet()
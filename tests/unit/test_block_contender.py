@@ -5,7 +5,9 @@ from lamden.crypto.canonical import merklize, block_from_subblocks
 from lamden.crypto.wallet import Wallet
 from lamden.nodes.masternode import contender
 import asyncio
+import itertools
 import secrets
+import time
 
 from contracting.db.driver import ContractDriver
 
@@ -407,6 +409,112 @@ class TestCurrentContenders(TestCase):
         con.add_sbcs([a, b, c, d, g, h])
 
         self.assertFalse(con.block_has_consensus())
+    def test_block_is_decided_once_adequate_consensus_is_impossible(self):
+        con = contender.BlockContender(total_contacts=6, required_consensus=0.66, total_subblocks=1)
+
+        for i in range(4):
+            con.add_sbcs([MockSBC(input=1, result=f'res_{i}', index=0).to_dict()])
+
+        # 1 vote plus the 2 still out could reach 3 of 6
+        self.assertFalse(con.block_is_decided())
+
+        con.add_sbcs([MockSBC(input=1, result='res_4', index=0).to_dict()])
+
+        self.assertTrue(con.block_is_decided())
+        self.assertFalse(con.block_has_consensus())
+
+        # A failed subblock is left out of the block
+        self.assertEqual(con.get_current_best_block(), [None])
+
+    def test_block_is_not_decided_while_adequate_consensus_is_reachable(self):
+        con = contender.BlockContender(total_contacts=4, required_consensus=0.66, total_subblocks=1)
+
+        for i in range(3):
+            con.add_sbcs([MockSBC(input=1, result=f'res_{i}', index=0).to_dict()])
+
+        # Required consensus is out of reach, but the last response could still give 2 of 4
+        self.assertFalse(con.block_is_decided())
+
+    def test_early_decision_does_not_depend_on_arrival_order(self):
+        # Subblock 0 reaches consensus and subblock 1 fails before the last delegate answers
+        delegates = []
+        for i in range(6):
+            delegates.append([
+                MockSBC(input=1, result='res_B' if i == 5 else 'res_A', index=0).to_dict(),
+                MockSBC(input=2, result=f'res_{i}', index=1).to_dict()
+            ])
+
+        hashes = set()
+        for order in itertools.permutations(range(6)):
+            con = contender.BlockContender(total_contacts=6, required_consensus=0.66, total_subblocks=2)
+
+            arrived = 0
+            for i in order:
+                con.add_sbcs(delegates[i])
+                arrived += 1
+
+                if con.block_is_decided():
+                    break
+
+            self.assertEqual(arrived, 5)
+
+            block = con.get_current_best_block()
+            self.assertIsNone(block[1])
+
+            hashes.add(block_from_subblocks(block, previous_hash='0' * 64, block_num=1)['hash'])
+
+        self.assertEqual(len(hashes), 1)
+
+    def test_tied_subblock_has_no_adequate_consensus(self):
+        con = contender.BlockContender(total_contacts=4, required_consensus=0.66, total_subblocks=1)
+
+        for result in ['res_1', 'res_1', 'res_2']:
+            con.add_sbcs([MockSBC(input=1, result=result, index=0).to_dict()])
+
+        self.assertTrue(con.block_has_adequate_consensus())
+
+        con.add_sbcs([MockSBC(input=1, result='res_2', index=0).to_dict()])
+
+        self.assertFalse(con.block_has_adequate_consensus())
+        self.assertEqual(con.get_current_best_block(), [None])
+
+    def test_block_is_decided_once_consensus_is_reached(self):
+        con = contender.BlockContender(total_contacts=4, required_consensus=0.66, total_subblocks=1)
+
+        for i in range(3):
+            con.add_sbcs([MockSBC(input=1, result='res_1', index=0).to_dict()])
+
+        self.assertTrue(con.block_is_decided())
+
+    def test_block_contender_uses_its_required_consensus(self):
+        con = contender.BlockContender(total_contacts=4, required_consensus=0.9, total_subblocks=1)
+
+        for i in range(3):
+            con.add_sbcs([MockSBC(input=1, result='res_1', index=0).to_dict()])
+
+        self.assertFalse(con.block_has_consensus())
+        self.assertFalse(con.block_is_decided())
+
+        con.add_sbcs([MockSBC(input=1, result='res_1', index=0).to_dict()])
+
+        self.assertTrue(con.block_has_consensus())
+
+    def test_block_has_adequate_consensus_once_every_subblock_does(self):
+        con = contender.BlockContender(total_contacts=4, required_consensus=0.66, total_subblocks=2,
+                                       acceptable_consensus=0.5)
+
+        for i in range(2):
+            con.add_sbcs([MockSBC(input=1, result='res_1', index=0).to_dict()])
+
+        self.assertFalse(con.block_has_adequate_consensus())
+
+        for i in range(2):
+            con.add_sbcs([MockSBC(input=1, result='res_2', index=1).to_dict()])
+
+        self.assertTrue(con.block_has_adequate_consensus())
+        self.assertFalse(con.block_has_consensus())
+        self.assertEqual(con.responses, 2)
+
     # def test_none_added_if_quorum_cannot_be_reached(self):
     #     con = CurrentContenders(3)
     #
@@ -558,6 +666,32 @@ class TestAggregator(TestCase):
         self.assertNotEqual(res['hash'], 'f' * 64)
 
 
+    def test_gather_subblocks_stops_once_adequate_consensus_is_impossible(self):
+        a = contender.Aggregator(driver=ContractDriver())
+
+        a.sbc_inbox.q = [[MockSBC('input_1', f'res_{i}', 0).to_dict()] for i in range(5)]
+
+        started = time.time()
+        res = self.loop.run_until_complete(a.gather_subblocks(6, expected_subblocks=1))
+
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(a.timing.stats['early'], 1)
+        self.assertEqual(res['subblocks'], [])
+
+    def test_gather_subblocks_learns_delegate_timeout(self):
+        a = contender.Aggregator(driver=ContractDriver())
+
+        sbcs = [[MockSBC('input_1', 'res_1', 0).to_dict()] for _ in range(2)]
+        a.sbc_inbox.q = sbcs
+
+        peers = [sbc[0]['signer'] for sbc in sbcs]
+
+        self.loop.run_until_complete(a.gather_subblocks(2, expected_subblocks=1, peers=peers))
+
+        # Both answered right away, so the next round waits the minimum instead of the initial timeout
+        self.assertEqual(a.timing.timeout(peers), a.timing.minimum)
+
+
 class TestSBCProcessor(TestCase):
     def test_subblock_with_bad_sb_idx_returns_false(self):
         sbc = {
@@ -720,6 +854,48 @@ class TestSBCProcessor(TestCase):
 
         self.assertTrue(s.sbc_is_valid(sbc, 1))
 
+    def build_sbc(self, wallet, transactions, leaves):
+        return {
+            'subblock': 1,
+            'transactions': transactions,
+            'input_hash': 'something',
+            'signer': wallet.verifying_key,
+            'merkle_tree': {
+                'signature': wallet.sign(leaves[0]),
+                'leaves': leaves
+            }
+        }
+
+    def test_proven_merkle_root_is_not_rebuilt(self):
+        transactions = [{'something': 'who_cares'}, {'something_else': 'who_cares'}]
+        expected_tree = merklize([encode(tx).encode() for tx in transactions])
+
+        s = contender.SBCInbox()
+
+        self.assertTrue(s.sbc_is_valid(self.build_sbc(Wallet(), transactions, expected_tree), 1))
+
+        # Same signed root, but the transactions do not hash to it. The earlier proof is used instead.
+        sbc = self.build_sbc(Wallet(), [{'other': 'stuff'}], [expected_tree[0], 'crap'])
+
+        self.assertTrue(s.sbc_is_valid(sbc, 1))
+        self.assertEqual(sbc['transactions'], transactions)
+        self.assertEqual(sbc['merkle_tree']['leaves'], expected_tree)
+        self.assertEqual(s.proven.hits, 1)
+
+    def test_merkle_root_is_rebuilt_after_proofs_are_cleared(self):
+        transactions = [{'something': 'who_cares'}, {'something_else': 'who_cares'}]
+        expected_tree = merklize([encode(tx).encode() for tx in transactions])
+
+        s = contender.SBCInbox()
+
+        self.assertTrue(s.sbc_is_valid(self.build_sbc(Wallet(), transactions, expected_tree), 1))
+
+        s.proven.clear()
+
+        sbc = self.build_sbc(Wallet(), [{'other': 'stuff'}], [expected_tree[0], 'crap'])
+
+        self.assertFalse(s.sbc_is_valid(sbc, 1))
+
     def test_process_message_good_and_bad_sbc_doesnt_pass_to_q(self):
         ### GOOD SBC
         tx_1_1 = {
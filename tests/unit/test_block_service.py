@@ -120,6 +120,85 @@ class TestBlockService(TestCase):
 
         self.assertIsNone(res)
 
+    def test_service_returns_range_of_blocks(self):
+        for i in range(1, 6):
+            self.b.blocks.store_block({
+                'hash': str(i) * 64,
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': {
+                'start': 2,
+                'count': 3
+            }
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual([b['number'] for b in res], [2, 3, 4])
+
+    def test_service_get_blocks_capped_by_max_blocks(self):
+        self.b.max_blocks = 2
+
+        for i in range(1, 6):
+            self.b.blocks.store_block({
+                'hash': str(i) * 64,
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': {
+                'start': 1,
+                'count': 5
+            }
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual([b['number'] for b in res], [1, 2])
+
+    def test_service_get_blocks_stops_at_byte_budget_but_returns_one(self):
+        for i in range(1, 4):
+            self.b.blocks.store_block({
+                'hash': str(i) * 64,
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': {
+                'start': 1,
+                'count': 3,
+                'max_bytes': 1
+            }
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual([b['number'] for b in res], [1])
+
+    def test_service_get_blocks_returns_none_if_bad_arg(self):
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': {
+                'start': '1',
+                'count': 3
+            }
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertIsNone(res)
+
     def test_get_latest_block_height(self):
         storage.set_latest_block_height(1337, self.b.driver)
 
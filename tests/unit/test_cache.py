@@ -0,0 +1,78 @@
+from unittest import TestCase
+from lamden.cache import LRUCache, MISSING
+
+
+class TestLRUCache(TestCase):
+    def test_get_missing_returns_sentinel(self):
+        c = LRUCache()
+
+        self.assertIs(c.get('a'), MISSING)
+
+    def test_get_missing_returns_default_if_provided(self):
+        c = LRUCache()
+
+        self.assertIsNone(c.get('a', None))
+
+    def test_set_then_get_returns_value(self):
+        c = LRUCache()
+        c.set('a', 1)
+
+        self.assertEqual(c.get('a'), 1)
+
+    def test_none_values_are_cached(self):
+        c = LRUCache()
+        c.set('a', None)
+
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.hits, 1)
+
+    def test_least_recently_used_evicted(self):
+        c = LRUCache(max_size=2)
+        c.set('a', 1)
+        c.set('b', 2)
+
+        c.get('a')
+
+        c.set('c', 3)
+
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+        self.assertIn('c', c)
+
+    def test_zero_size_cache_stores_nothing(self):
+        c = LRUCache(max_size=0)
+        c.set('a', 1)
+
+        self.assertEqual(len(c), 0)
+
+    def test_hits_and_misses_counted(self):
+        c = LRUCache()
+        c.get('a')
+        c.set('a', 1)
+        c.get('a')
+        c.get('a')
+
+        self.assertEqual(c.hits, 2)
+        self.assertEqual(c.misses, 1)
+        self.assertEqual(c.stats['hit_rate'], 2 / 3)
+
+    def test_pop_and_clear_remove_items(self):
+        c = LRUCache()
+        c.set('a', 1)
+        c.set('b', 2)
+
+        c.pop('a')
+        self.assertNotIn('a', c)
+
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+    def test_add_does_not_replace_cached_value(self):
+        c = LRUCache()
+
+        self.assertEqual(c.add('a', 1), 1)
+
+        c.set('a', 2)
+
+        self.assertEqual(c.add('a', 1), 2)
+        self.assertEqual(c.get('a'), 2)
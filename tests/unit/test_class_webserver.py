@@ -1,4 +1,5 @@
 from unittest import TestCase
+import asyncio
 
 from lamden.nodes.masternode.webserver import WebServer
 from lamden.crypto.wallet import Wallet
@@ -11,6 +12,22 @@ from lamden import storage
 n = ContractDriver()
 
 
+class FakeStream:
+    # Hands out the given messages, then closes, and keeps the decoded replies
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.sent = []
+
+    async def recv(self):
+        if len(self.messages) == 0:
+            return None
+
+        return self.messages.pop(0)
+
+    async def send(self, message):
+        self.sent.append(decode(message))
+
+
 class TestClassWebserver(TestCase):
     def setUp(self):
         self.w = Wallet()
@@ -400,9 +417,82 @@ def get():
 
         self.assertEqual(len(self.ws.queue), 1)
 
-    def test_submit_transaction_error_if_queue_full(self):
-        self.ws.queue.extend(range(10_000))
+    def test_expired_transaction_is_rejected(self):
+        w = Wallet()
+
+        self.ws.client.set_var(
+            contract='currency',
+            variable='balances',
+            arguments=[w.verifying_key],
+            value=1_000_000
+        )
+
+        tx = decode(build_transaction(
+            wallet=w,
+            processor=self.ws.wallet.verifying_key,
+            stamps=6000,
+            nonce=0,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 123,
+                'to': 'jeff'
+            }
+        ))
+
+        # The timestamp is not signed, so the signature still holds
+        tx['metadata']['timestamp'] -= self.ws.tx_timeout + 1
 
+        _, response = self.ws.app.test_client.post('/', data=encode(tx))
+
+        self.assertDictEqual(response.json, {'error': 'Transaction timestamp is too old. Submit with a current timestamp.'})
+        self.assertEqual(len(self.ws.queue), 0)
+
+    def test_transaction_turned_down_by_queue_returns_error_and_hands_back_nonce(self):
+        w = Wallet()
+
+        self.ws.client.set_var(
+            contract='currency',
+            variable='balances',
+            arguments=[w.verifying_key],
+            value=1_000_000
+        )
+
+        self.ws.client.set_var(
+            contract='stamp_cost',
+            variable='S',
+            arguments=['value'],
+            value=1_000_000
+        )
+
+        txs = [build_transaction(
+            wallet=w,
+            processor=self.ws.wallet.verifying_key,
+            stamps=stamps,
+            nonce=0,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 123,
+                'to': 'jeff'
+            }
+        ) for stamps in [7000, 6000]]
+
+        # Already queued at the same nonce with more stamps
+        self.ws.queue.append(decode(txs[0]))
+
+        _, response = self.ws.app.test_client.post('/', data=txs[1])
+
+        self.assertDictEqual(response.json, {'error': 'Transaction nonce is already queued with as many stamps or more.'})
+
+        pending_nonce = self.ws.nonces.get_pending_nonce(sender=w.verifying_key, processor=self.ws.wallet.verifying_key)
+
+        self.assertEqual(pending_nonce, 0)
+        self.assertEqual(len(self.ws.queue), 1)
+
+        self.ws.queue.clear()
+
+    def test_submit_transaction_error_if_queue_full(self):
         tx = build_transaction(
             wallet=Wallet(),
             processor=self.ws.wallet.verifying_key,
@@ -416,12 +506,256 @@ def get():
             }
         )
 
+        # Fill the queue with the same transaction at every nonce up to its capacity
+        queued = decode(tx)
+        self.ws.queue.extend(
+            {**queued, 'payload': {**queued['payload'], 'nonce': nonce}} for nonce in range(self.ws.max_queue_len)
+        )
+
         _, response = self.ws.app.test_client.post('/', data=tx)
 
         self.assertDictEqual(response.json, {'error': 'Queue full. Resubmit shortly.'})
 
         self.ws.queue.clear()
 
+    def test_batch_of_consecutive_nonces_all_put_into_queue(self):
+        w = Wallet()
+
+        self.ws.client.set_var(
+            contract='currency',
+            variable='balances',
+            arguments=[w.verifying_key],
+            value=1_000_000
+        )
+
+        self.ws.client.set_var(
+            contract='stamp_cost',
+            variable='S',
+            arguments=['value'],
+            value=1_000_000
+        )
+
+        txs = [decode(build_transaction(
+            wallet=w,
+            processor=self.ws.wallet.verifying_key,
+            stamps=6000,
+            nonce=i,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 123,
+                'to': 'jeff'
+            }
+        )) for i in range(3)]
+
+        _, response = self.ws.app.test_client.post('/batch', data=encode(txs))
+
+        self.assertEqual(len(response.json), 3)
+        for result in response.json:
+            self.assertIn('hash', result)
+
+        self.assertEqual(len(self.ws.queue), 3)
+
+        self.ws.queue.clear()
+
+    def test_concurrent_requests_from_one_sender_reserve_nonces_in_order(self):
+        w = Wallet()
+
+        self.ws.client.set_var(
+            contract='currency',
+            variable='balances',
+            arguments=[w.verifying_key],
+            value=1_000_000
+        )
+
+        self.ws.client.set_var(
+            contract='stamp_cost',
+            variable='S',
+            arguments=['value'],
+            value=1_000_000
+        )
+
+        txs = [decode(build_transaction(
+            wallet=w,
+            processor=self.ws.wallet.verifying_key,
+            stamps=6000,
+            nonce=i,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 123,
+                'to': 'jeff'
+            }
+        )) for i in range(5)]
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        results = loop.run_until_complete(asyncio.gather(*[self.ws.add_transactions([tx]) for tx in txs]))
+
+        loop.close()
+
+        for result in results:
+            self.assertIn('hash', result[0])
+
+        self.assertEqual(len(self.ws.queue), 5)
+        self.assertEqual(self.ws.sender_tails, {})
+
+        self.ws.queue.clear()
+
+    def test_requests_from_different_senders_do_not_wait_on_each_other(self):
+        a = Wallet()
+        b = Wallet()
+
+        for w in [a, b]:
+            self.ws.client.set_var(
+                contract='currency',
+                variable='balances',
+                arguments=[w.verifying_key],
+                value=1_000_000
+            )
+
+        self.ws.client.set_var(
+            contract='stamp_cost',
+            variable='S',
+            arguments=['value'],
+            value=1_000_000
+        )
+
+        tx_a, tx_b = [decode(build_transaction(
+            wallet=w,
+            processor=self.ws.wallet.verifying_key,
+            stamps=6000,
+            nonce=0,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 123,
+                'to': 'jeff'
+            }
+        )) for w in [a, b]]
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        release = asyncio.Event()
+        prefetch_nonces = self.ws.prefetch_nonces
+
+        # The first sender's nonce lookup hangs until the second sender's request is done
+        async def slow_prefetch_nonces(sender, processor):
+            if sender == a.verifying_key:
+                await release.wait()
+            await prefetch_nonces(sender, processor)
+
+        self.ws.prefetch_nonces = slow_prefetch_nonces
+
+        async def submit():
+            first = asyncio.ensure_future(self.ws.add_transactions([tx_a]))
+            second = await asyncio.wait_for(self.ws.add_transactions([tx_b]), timeout=5)
+            release.set()
+            return await first, second
+
+        first, second = loop.run_until_complete(submit())
+
+        loop.close()
+
+        self.assertIn('hash', first[0])
+        self.assertIn('hash', second[0])
+
+        self.ws.queue.clear()
+
+    def test_release_nonce_lowers_pending_nonce(self):
+        w2 = Wallet()
+
+        self.ws.nonces.set_pending_nonce(
+            sender=w2.verifying_key,
+            processor=self.w.verifying_key,
+            value=5
+        )
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        loop.run_until_complete(self.ws.release_nonce(w2.verifying_key, self.w.verifying_key, 3))
+
+        # Never raised back up by a later release
+        loop.run_until_complete(self.ws.release_nonce(w2.verifying_key, self.w.verifying_key, 4))
+
+        loop.close()
+
+        pending_nonce = self.ws.nonces.get_pending_nonce(sender=w2.verifying_key, processor=self.w.verifying_key)
+
+        self.assertEqual(pending_nonce, 3)
+        self.assertEqual(self.ws.sender_tails, {})
+
+    def test_batch_returns_result_per_transaction(self):
+        tx = build_transaction(
+            wallet=Wallet(),
+            processor='b' * 64,
+            stamps=123,
+            nonce=0,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 123,
+                'to': 'jeff'
+            }
+        )
+
+        _, response = self.ws.app.test_client.post('/batch', data=encode([decode(tx), 'junk']))
+
+        self.assertListEqual(response.json, [
+            {'error': 'Transaction processor does not match expected processor.'},
+            {'error': 'Malformed request body.'}
+        ])
+
+    def test_batch_must_be_a_list(self):
+        _, response = self.ws.app.test_client.post('/batch', data=encode({'a': 1}))
+
+        self.assertDictEqual(response.json, {'error': 'Malformed request body.'})
+
+    def test_batch_too_long_returns_error(self):
+        self.ws.max_batch_len = 1
+
+        _, response = self.ws.app.test_client.post('/batch', data=encode([{}, {}]))
+
+        self.assertEqual(response.status, 413)
+
+    def test_single_transaction_too_large_returns_error(self):
+        _, response = self.ws.app.test_client.post('/', data='a' * 10_001)
+
+        self.assertDictEqual(response.json, {'error': 'Transaction too large.'})
+
+    def test_stream_transaction_too_large_returns_error(self):
+        ws = FakeStream(['a' * 10, '{"a": "' + 'a' * 10_000 + '"}'])
+
+        self.run_stream(ws)
+
+        self.assertListEqual(ws.sent, [
+            {'error': 'Malformed request body.'},
+            {'error': 'Transaction too large.'}
+        ])
+
+    def test_stream_error_if_queue_full(self):
+        self.ws.max_queue_len = 0
+
+        ws = FakeStream([encode({'a': 1}), encode([{'a': 1}])])
+
+        self.run_stream(ws)
+
+        self.assertListEqual(ws.sent, [
+            {'error': 'Queue full. Resubmit shortly.'},
+            {'error': 'Queue full. Resubmit shortly.'}
+        ])
+
+    def run_stream(self, ws):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        loop.run_until_complete(self.ws.stream_transactions(None, ws))
+
+        loop.close()
+
     def test_get_tx_by_hash_if_it_exists(self):
         b = '0' * 64
 
@@ -0,0 +1,113 @@
+from unittest import TestCase, skipIf
+from lamden import codec
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+from contracting.stdlib.bridge.time import Datetime, Timedelta
+
+
+class TestJSONCodec(TestCase):
+    def test_pack_without_codec_is_single_json_frame(self):
+        frames = codec.pack({'a': 1})
+
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(codec.unpack(frames), {'a': 1})
+
+    def test_header_of_single_frame_is_json(self):
+        self.assertEqual(codec.header([b'{}']), codec.JSON)
+
+    def test_unknown_header_unpacks_to_none(self):
+        self.assertIsNone(codec.unpack([b'nope', b'\x00']))
+
+    def test_negotiate_falls_back_to_json(self):
+        self.assertEqual(codec.negotiate(['nope']), codec.JSON)
+        self.assertEqual(codec.negotiate('msgpack'), codec.JSON)
+
+
+@skipIf(codec.msgpack is None, 'msgpack not installed')
+class TestMsgpackCodec(TestCase):
+    def test_negotiate_prefers_msgpack(self):
+        self.assertEqual(codec.negotiate([codec.JSON, codec.MSGPACK]), codec.MSGPACK)
+
+    def test_pack_adds_header_frame(self):
+        frames = codec.pack({'a': 1}, codec.MSGPACK)
+
+        self.assertEqual(frames[0], codec.MSGPACK.encode())
+        self.assertEqual(codec.header(frames), codec.MSGPACK)
+
+    def test_round_trip_contracting_types(self):
+        msg = {
+            'amount': ContractingDecimal('1.234'),
+            'now': Datetime(2020, 1, 2, 3, 4, 5, 6),
+            'delta': Timedelta(days=2, seconds=30),
+            'raw': b'\x01\x02',
+            'list': [1, 'a', None]
+        }
+
+        unpacked = codec.unpack(codec.pack(msg, codec.MSGPACK))
+
+        self.assertEqual(unpacked['amount'], ContractingDecimal('1.234'))
+        self.assertEqual(unpacked['now'], msg['now'])
+        self.assertEqual(unpacked['delta'], msg['delta'])
+        self.assertEqual(unpacked['raw'], b'\x01\x02')
+        self.assertEqual(unpacked['list'], [1, 'a', None])
+
+    def test_big_ints_fall_back_to_json(self):
+        msg = {'a': 2 ** 70}
+
+        frames = codec.pack(msg, codec.MSGPACK)
+
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(codec.unpack(frames), msg)
+
+    def test_msgpack_is_smaller_than_json(self):
+        msg = {'hash': 'a' * 64, 'number': 100, 'transactions': [{'nonce': i} for i in range(10)]}
+
+        json_frames = codec.pack(msg)
+        msgpack_frames = codec.pack(msg, codec.MSGPACK)
+
+        self.assertLess(len(msgpack_frames[1]), len(json_frames[0]))
+
+
+@skipIf(codec.zstandard is None, 'zstandard not installed')
+class TestCompression(TestCase):
+    def setUp(self):
+        self.block = {
+            'hash': 'a' * 64,
+            'number': 1,
+            'previous': 'b' * 64,
+            'subblocks': [codec.SAMPLE_SUBBLOCK for _ in range(10)]
+        }
+
+    def test_small_messages_skip_compression(self):
+        name = f'{codec.JSON}+{codec.ZSTD}'
+
+        frames = codec.pack({'a': 1}, name)
+
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(codec.unpack(frames), {'a': 1})
+
+    def test_large_messages_compressed_and_flagged(self):
+        name = f'{codec.JSON}+{codec.ZSTD}'
+
+        frames = codec.pack(self.block, name)
+
+        self.assertEqual(codec.header(frames), name)
+        self.assertLess(len(frames[1]), len(codec.pack(self.block)[0]))
+        self.assertEqual(codec.unpack(frames), self.block)
+
+    def test_stats_count_bytes_saved(self):
+        name = f'{codec.JSON}+{codec.ZSTD}'
+        compressor = codec.COMPRESSORS[name]
+
+        saved = compressor.bytes_saved
+        codec.pack(self.block, name)
+
+        self.assertGreater(compressor.bytes_saved, saved)
+        self.assertIn(name, codec.compression_stats())
+
+    def test_unsupported_compression_unpacks_to_none(self):
+        self.assertIsNone(codec.unpack([b'json+lz4', b'\x00']))
+
+    def test_supported_rejects_unknown_names(self):
+        self.assertFalse(codec.supported('json+lz4'))
+        self.assertFalse(codec.supported(None))
+        self.assertTrue(codec.supported(codec.JSON))
@@ -1,9 +1,10 @@
 from lamden.crypto import transaction
 from lamden.crypto.wallet import Wallet, verify
 from lamden.crypto import canonical
-from contracting.db.driver import decode, ContractDriver, InMemDriver
+from contracting.db.driver import decode, encode, ContractDriver, InMemDriver
 from contracting.client import ContractingClient
 from lamden.nodes.delegate import execution, work
+from lamden.nodes.delegate.delegate import WorkProcessor, predict_block
 from lamden.nodes import masternode, delegate, base
 from lamden import storage, authentication, router
 import zmq.asyncio
@@ -490,6 +491,373 @@ def get():
 
         self.assertEqual(h.hexdigest(), results[0]['merkle_tree']['leaves'][0])
 
+    def submit_testing_contract(self):
+        test_contract = '''
+v = Variable()
+
+@construct
+def seed():
+    v.set('hello')
+
+@export
+def set(var: str):
+    v.set(var)
+
+@export
+def get():
+    return v.get()
+        '''
+
+        self.client.submit(test_contract, name='testing')
+
+        self.client.raw_driver.commit()
+        self.client.raw_driver.clear_pending_state()
+
+    def build_testing_tx(self, wallet, function, kwargs={}):
+        tx = transaction.build_transaction(
+            wallet=wallet,
+            contract='testing',
+            function=function,
+            kwargs=kwargs,
+            stamps=100_000,
+            processor='0' * 64,
+            nonce=0
+        )
+
+        return decode(tx)
+
+    def test_optimistic_executor_matches_serial_executor(self):
+        self.submit_testing_contract()
+
+        stu = Wallet()
+        jeff = Wallet()
+
+        work = [
+            {
+                'transactions': [
+                    self.build_testing_tx(stu, 'set', {'var': 'howdy'}),
+                    self.build_testing_tx(jeff, 'get'),
+                    self.build_testing_tx(jeff, 'set', {'var': 'poo'})
+                ],
+                'timestamp': time.time(),
+                'input_hash': 'C' * 64
+            },
+            {
+                'transactions': [
+                    self.build_testing_tx(jeff, 'get'),
+                    self.build_testing_tx(stu, 'set', {'var': '123'}),
+                    self.build_testing_tx(stu, 'get')
+                ],
+                'timestamp': time.time(),
+                'input_hash': 'A' * 64
+            }
+        ]
+
+        w = Wallet()
+
+        serial = execution.SerialExecutor(executor=self.client.executor).execute_work(
+            driver=self.client.raw_driver,
+            work=work,
+            previous_block_hash='B' * 64,
+            wallet=w,
+            stamp_cost=20_000
+        )
+
+        self.client.raw_driver.clear_pending_state()
+
+        optimistic = execution.OptimisticExecutor(executor=self.client.executor).execute_work(
+            driver=self.client.raw_driver,
+            work=work,
+            previous_block_hash='B' * 64,
+            wallet=w,
+            stamp_cost=20_000
+        )
+
+        self.assertEqual(encode(serial), encode(optimistic))
+
+    def test_optimistic_executor_workers_match_serial_executor_on_node_driver(self):
+        # The node's driver is in memory here, so workers only see its state through the driver factory
+        self.submit_testing_contract()
+
+        driver = self.client.raw_driver
+
+        work = [{
+            'transactions': [self.build_testing_tx(Wallet(), 'get') for i in range(4)],
+            'timestamp': time.time(),
+            'input_hash': 'C' * 64
+        }]
+
+        w = Wallet()
+
+        exe = execution.OptimisticExecutor(executor=self.client.executor, workers=2, min_parallel_batch=1)
+
+        try:
+            # Starts the workers on the state as it is now
+            exe.execute_work(driver=driver, work=work, previous_block_hash='B' * 64, wallet=w, stamp_cost=20_000)
+            driver.clear_pending_state()
+
+            # Changed after the workers started, so only the node's driver sees it
+            driver.set('testing.v', 'howdy')
+            driver.commit()
+            driver.clear_pending_state()
+
+            serial = execution.SerialExecutor(executor=self.client.executor).execute_work(
+                driver=driver,
+                work=work,
+                previous_block_hash='B' * 64,
+                wallet=w,
+                stamp_cost=20_000
+            )
+
+            driver.clear_pending_state()
+
+            optimistic = exe.execute_work(
+                driver=driver,
+                work=work,
+                previous_block_hash='B' * 64,
+                wallet=w,
+                stamp_cost=20_000
+            )
+        finally:
+            exe.stop_pool()
+
+        self.assertIn('howdy', serial[0]['transactions'][0]['result'])
+        self.assertEqual(encode(serial), encode(optimistic))
+
+    def test_optimistic_executor_reexecutes_transaction_that_read_stale_state(self):
+        self.submit_testing_contract()
+
+        stu = Wallet()
+
+        tx_batch = {
+            'transactions': [
+                self.build_testing_tx(stu, 'set', {'var': 'howdy'}),
+                self.build_testing_tx(stu, 'get')
+            ]
+        }
+
+        exe = execution.OptimisticExecutor(executor=self.client.executor)
+
+        td1, td2 = exe.execute_tx_batch(
+            driver=self.client.raw_driver,
+            batch=tx_batch,
+            timestamp=time.time(),
+            input_hash='A' * 64,
+            stamp_cost=20_000
+        )
+
+        self.assertEqual(td1['state'][0]['value'], 'howdy')
+        self.assertIn('howdy', td2['result'])
+        self.assertEqual(exe.conflicts, 1)
+
+    def test_optimistic_executor_accepts_blind_writes_without_reexecuting(self):
+        self.submit_testing_contract()
+
+        tx_batch = {
+            'transactions': [
+                self.build_testing_tx(Wallet(), 'set', {'var': 'howdy'}),
+                self.build_testing_tx(Wallet(), 'set', {'var': 'poo'})
+            ]
+        }
+
+        exe = execution.OptimisticExecutor(executor=self.client.executor)
+
+        exe.execute_tx_batch(
+            driver=self.client.raw_driver,
+            batch=tx_batch,
+            timestamp=time.time(),
+            input_hash='A' * 64,
+            stamp_cost=20_000
+        )
+
+        self.assertEqual(exe.conflicts, 0)
+        self.assertEqual(self.client.raw_driver.get('testing.v'), 'poo')
+
+    def test_speculative_executor_reuses_pre_executed_batch(self):
+        self.submit_testing_contract()
+
+        stu = Wallet()
+
+        work = [{
+            'transactions': [
+                self.build_testing_tx(stu, 'set', {'var': 'howdy'}),
+                self.build_testing_tx(stu, 'get')
+            ],
+            'timestamp': time.time(),
+            'input_hash': 'C' * 64
+        }]
+
+        w = Wallet()
+
+        serial = execution.SerialExecutor(executor=self.client.executor).execute_work(
+            driver=self.client.raw_driver,
+            work=work,
+            previous_block_hash='B' * 64,
+            wallet=w,
+            stamp_cost=20_000
+        )
+
+        self.client.raw_driver.clear_pending_state()
+
+        exe = execution.SpeculativeExecutor(execution.SerialExecutor(executor=self.client.executor))
+
+        self.assertTrue(exe.pre_execute(
+            driver=self.client.raw_driver,
+            batch=work[0],
+            previous_block_hash='B' * 64,
+            current_height=0,
+            stamp_cost=20_000
+        ))
+
+        # Pre-execution leaves the state untouched
+        self.assertEqual(self.client.raw_driver.get('testing.v'), 'hello')
+
+        results = exe.execute_work(
+            driver=self.client.raw_driver,
+            work=work,
+            previous_block_hash='B' * 64,
+            wallet=w,
+            stamp_cost=20_000
+        )
+
+        self.assertEqual(encode(serial), encode(results))
+        self.assertEqual(exe.hits, 1)
+        self.assertEqual(self.client.raw_driver.get('testing.v'), 'howdy')
+
+    def test_speculative_executor_reexecutes_batch_that_read_changed_state(self):
+        self.submit_testing_contract()
+
+        stu = Wallet()
+
+        work = [
+            {
+                'transactions': [self.build_testing_tx(stu, 'set', {'var': 'howdy'})],
+                'timestamp': time.time(),
+                'input_hash': 'A' * 64
+            },
+            {
+                'transactions': [self.build_testing_tx(stu, 'get')],
+                'timestamp': time.time(),
+                'input_hash': 'C' * 64
+            }
+        ]
+
+        exe = execution.SpeculativeExecutor(execution.SerialExecutor(executor=self.client.executor))
+
+        exe.pre_execute(
+            driver=self.client.raw_driver,
+            batch=work[1],
+            previous_block_hash='B' * 64,
+            current_height=0,
+            stamp_cost=20_000
+        )
+
+        sb1, sb2 = exe.execute_work(
+            driver=self.client.raw_driver,
+            work=work,
+            previous_block_hash='B' * 64,
+            wallet=Wallet(),
+            stamp_cost=20_000
+        )
+
+        self.assertIn('howdy', sb2['transactions'][0]['result'])
+        self.assertEqual(exe.hits, 0)
+        self.assertEqual(exe.misses, 2)
+
+    def test_speculative_executor_ignores_results_from_other_blocks(self):
+        self.submit_testing_contract()
+
+        batch = {
+            'transactions': [self.build_testing_tx(Wallet(), 'set', {'var': 'howdy'})],
+            'timestamp': time.time(),
+            'input_hash': 'A' * 64
+        }
+
+        exe = execution.SpeculativeExecutor(execution.SerialExecutor(executor=self.client.executor))
+
+        exe.pre_execute(
+            driver=self.client.raw_driver,
+            batch=batch,
+            previous_block_hash='B' * 64,
+            current_height=0,
+            stamp_cost=20_000
+        )
+
+        exe.invalidate('D' * 64)
+
+        self.assertEqual(exe.invalidated, 1)
+        self.assertFalse(exe.has_result(batch, 'B' * 64))
+
+        exe.execute_work(
+            driver=self.client.raw_driver,
+            work=[batch],
+            previous_block_hash='D' * 64,
+            wallet=Wallet(),
+            stamp_cost=20_000
+        )
+
+        self.assertEqual(exe.hits, 0)
+
+    def test_speculative_executor_does_not_pre_execute_while_paused(self):
+        exe = execution.SpeculativeExecutor(execution.SerialExecutor(executor=self.client.executor))
+        exe.pause()
+
+        batch = {
+            'transactions': [self.build_testing_tx(Wallet(), 'get')],
+            'timestamp': time.time(),
+            'input_hash': 'A' * 64
+        }
+
+        self.assertFalse(exe.pre_execute(
+            driver=self.client.raw_driver,
+            batch=batch,
+            previous_block_hash='B' * 64,
+            current_height=0,
+            stamp_cost=20_000
+        ))
+
+    def test_work_processor_drops_batches_for_past_blocks(self):
+        w = WorkProcessor(client=self.client, nonces=None)
+
+        w.new_work['a'] = [{'sender': 'a', 'height': 3}, {'sender': 'a', 'height': 5}]
+        w.new_work['b'] = [{'sender': 'b'}]
+
+        batches = self.loop.run_until_complete(
+            w.gather_transaction_batches(masters=['a', 'b'], timeout=0.1, height=4)
+        )
+
+        # Untagged batches are always kept
+        self.assertEqual(batches, [{'sender': 'a', 'height': 5}, {'sender': 'b'}])
+
+    def test_predict_block_matches_block_built_by_masters(self):
+        self.submit_testing_contract()
+
+        work = [{
+            'transactions': [self.build_testing_tx(Wallet(), 'set', {'var': 'howdy'})],
+            'timestamp': time.time(),
+            'input_hash': 'C' * 64
+        }]
+
+        results = execution.SerialExecutor(executor=self.client.executor).execute_work(
+            driver=self.client.raw_driver,
+            work=work,
+            previous_block_hash='B' * 64,
+            wallet=Wallet(),
+            stamp_cost=20_000
+        )
+
+        subblocks = [{
+            'input_hash': sb['input_hash'],
+            'transactions': sb['transactions'],
+            'merkle_leaves': sb['merkle_tree']['leaves'],
+            'subblock': sb['subblock'],
+            'signatures': [{'signature': sb['merkle_tree']['signature'], 'signer': sb['signer']}]
+        } for sb in results]
+
+        block = canonical.block_from_subblocks(subblocks=subblocks, previous_hash='B' * 64, block_num=2)
+
+        self.assertEqual(predict_block(results, 'B' * 64, 2), block['hash'])
+
     def test_acquire_work_1_master_gathers_tx_batches(self):
         ips = [
             'tcp://127.0.0.1:18001',
@@ -814,6 +1182,90 @@ def get():
         self.assertEqual(dbal, 1338)
         self.assertEqual(mbal, 1338)
 
+    def test_masternode_pipelined_delegate_single_loop_commits_state_changes(self):
+        ips = [
+            'tcp://127.0.0.1:18001',
+            'tcp://127.0.0.1:18002'
+        ]
+
+        dw = Wallet()
+        mw = Wallet()
+
+        self.authenticator.add_verifying_key(mw.verifying_key)
+        self.authenticator.add_verifying_key(dw.verifying_key)
+        self.authenticator.configure()
+
+        mnd = ContractDriver(driver=InMemDriver())
+        mn = masternode.Masternode(
+            socket_base=ips[0],
+            ctx=self.ctx,
+            wallet=mw,
+            constitution={
+                'masternodes': [mw.verifying_key],
+                'delegates': [dw.verifying_key]
+            },
+            driver=mnd
+        )
+        sender = Wallet()
+        mnd.set_var(contract='currency', variable='balances', arguments=[sender.verifying_key], value=1_000_000)
+
+        dld = ContractDriver(driver=InMemDriver())
+        dld.set_var(contract='currency', variable='balances', arguments=[sender.verifying_key], value=1_000_000)
+        dl = delegate.Delegate(
+            socket_base=ips[1],
+            ctx=self.ctx,
+            wallet=dw,
+            constitution={
+                'masternodes': [mw.verifying_key],
+                'delegates': [dw.verifying_key]
+            },
+            driver=dld,
+            pipelined=True
+        )
+
+        # Pipelining implies speculative execution
+        self.assertIsInstance(dl.transaction_executor, execution.SpeculativeExecutor)
+
+        tx = transaction.build_transaction(
+            wallet=sender,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 1338,
+                'to': 'jeff'
+            },
+            stamps=5000,
+            nonce=0,
+            processor=mw.verifying_key
+        )
+
+        mn.tx_batcher.queue.append(decode(tx))
+
+        peers = {
+            mw.verifying_key: ips[0],
+            dw.verifying_key: ips[1]
+        }
+
+        mn.network.peers = peers
+        dl.network.peers = peers
+
+        tasks = asyncio.gather(
+            mn.router.serve(),
+            dl.router.serve(),
+            mn.loop(),
+            dl.loop(),
+            stop_server(mn.router, 1),
+            stop_server(dl.router, 1),
+        )
+
+        self.loop.run_until_complete(tasks)
+
+        dbal = dld.get_var(contract='currency', variable='balances', arguments=['jeff'])
+
+        self.assertEqual(dbal, 1338)
+        self.assertEqual(dl.current_height, 1)
+        self.assertIsNone(dl.expected_block)
+
     def test_masternode_delegate_single_loop_updates_block_num(self):
         ips = [
             'tcp://127.0.0.1:18001',
@@ -913,17 +1365,21 @@ class TestWork(TestCase):
 
     def test_gather_work_waits_for_all(self):
         q = {}
+        inbox = router.Inbox()
 
         async def fill_q():
             q['1'] = 123
+            inbox.notify()
             await asyncio.sleep(0.1)
             q['3'] = 678
+            inbox.notify()
             await asyncio.sleep(0.5)
             q['x'] = 'zzz'
+            inbox.notify()
 
         tasks = asyncio.gather(
             fill_q(),
-            work.gather_transaction_batches(q, expected_batches=3, timeout=5)
+            work.gather_transaction_batches(q, inbox, expected_batches=3, timeout=5)
         )
 
         loop = asyncio.get_event_loop()
@@ -935,17 +1391,21 @@ class TestWork(TestCase):
 
     def test_gather_past_timeout_returns_current_work(self):
         q = {}
+        inbox = router.Inbox()
 
         async def fill_q():
             q['1'] = 123
+            inbox.notify()
             await asyncio.sleep(0.1)
             q['3'] = 678
+            inbox.notify()
             await asyncio.sleep(1.1)
             q['x'] = 'zzz'
+            inbox.notify()
 
         tasks = asyncio.gather(
             fill_q(),
-            work.gather_transaction_batches(q, expected_batches=3, timeout=1)
+            work.gather_transaction_batches(q, inbox, expected_batches=3, timeout=1)
         )
 
         loop = asyncio.get_event_loop()
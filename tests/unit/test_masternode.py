@@ -1,4 +1,5 @@
 from lamden.nodes.masternode import masternode
+from lamden.nodes.masternode.mempool import Mempool
 from lamden.nodes import base
 from lamden import router, storage, network, authentication
 from lamden.crypto.wallet import Wallet
@@ -9,6 +10,7 @@ import zmq.asyncio
 import asyncio
 
 from unittest import TestCase
+import time
 
 
 def generate_blocks(number_of_blocks, subblocks=[]):
@@ -36,6 +38,25 @@ def generate_blocks(number_of_blocks, subblocks=[]):
     return blocks
 
 
+def make_tx(sender='a', nonce=0):
+    # Queued as is, so it only needs the fields the mempool reads
+    return {
+        'metadata': {
+            'signature': '0' * 128,
+            'timestamp': int(time.time())
+        },
+        'payload': {
+            'contract': 'currency',
+            'function': 'transfer',
+            'kwargs': {},
+            'nonce': nonce,
+            'processor': '0' * 64,
+            'sender': sender,
+            'stamps_supplied': 100
+        }
+    }
+
+
 async def stop_server(s, timeout):
     await asyncio.sleep(timeout)
     s.stop()
@@ -89,7 +110,7 @@ class TestMasternode(TestCase):
 
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
-            node.tx_batcher.queue.append('MOCK TX')
+            node.tx_batcher.queue.append(make_tx())
 
         tasks = asyncio.gather(
             node.hang(),
@@ -115,7 +136,7 @@ class TestMasternode(TestCase):
 
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
-            node.new_block_processor.q.append('MOCK BLOCK')
+            node.new_block_processor.put('MOCK BLOCK')
 
         tasks = asyncio.gather(
             node.hang(),
@@ -196,7 +217,7 @@ class TestMasternode(TestCase):
             dl_wallet.verifying_key: dl_bootnode
         }
 
-        node.tx_batcher.queue.append('MOCK TX')
+        node.tx_batcher.queue.append(make_tx())
 
         tasks = asyncio.gather(
             mn_router.serve(),
@@ -451,13 +472,13 @@ class TestMasternode(TestCase):
             dl_wallet.verifying_key: dl_bootnode
         }
 
-        node.tx_batcher.queue.append('MOCK TX')
+        node.tx_batcher.queue.append(make_tx())
 
         node.running = True
 
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
-            node.tx_batcher.queue.append('MOCK TX')
+            node.tx_batcher.queue.append(make_tx(nonce=1))
 
         async def late_kill(timeout=1):
             node.running = False
@@ -474,3 +495,40 @@ class TestMasternode(TestCase):
 
         self.loop.run_until_complete(tasks)
 
+
+
+class TestTransactionBatcher(TestCase):
+    def test_pack_current_queue_drains_shared_queue(self):
+        txs = [make_tx(sender) for sender in ['a', 'b', 'c']]
+        queue = Mempool(txs=txs)
+        batcher = masternode.TransactionBatcher(wallet=Wallet(), queue=queue)
+
+        batch = batcher.pack_current_queue()
+
+        self.assertEqual(batch['transactions'], txs)
+        self.assertEqual(len(queue), 0)
+        self.assertIs(batcher.queue, queue)
+
+    def test_pack_current_queue_respects_tx_number(self):
+        txs = [make_tx(sender) for sender in ['a', 'b', 'c']]
+        batcher = masternode.TransactionBatcher(wallet=Wallet(), queue=txs)
+
+        batch = batcher.pack_current_queue(tx_number=2)
+
+        self.assertEqual(batch['transactions'], txs[:2])
+        self.assertEqual(len(batcher.queue), 1)
+
+    def test_pack_current_queue_tags_height_and_previous(self):
+        batcher = masternode.TransactionBatcher(wallet=Wallet(), queue=[make_tx()])
+
+        batch = batcher.pack_current_queue(height=5, previous='A' * 64)
+
+        self.assertEqual(batch['height'], 5)
+        self.assertEqual(batch['previous'], 'A' * 64)
+
+    def test_pack_current_queue_untagged_by_default(self):
+        batcher = masternode.TransactionBatcher(wallet=Wallet(), queue=[make_tx()])
+
+        batch = batcher.pack_current_queue()
+
+        self.assertNotIn('height', batch)
@@ -0,0 +1,223 @@
+from unittest import TestCase
+from lamden.nodes.masternode.mempool import Mempool
+import time
+
+
+def make_tx(sender, nonce, stamps=100, timestamp=None):
+    return {
+        'metadata': {
+            'signature': '0' * 128,
+            'timestamp': int(time.time()) if timestamp is None else timestamp
+        },
+        'payload': {
+            'contract': 'currency',
+            'function': 'transfer',
+            'kwargs': {},
+            'nonce': nonce,
+            'processor': '0' * 64,
+            'sender': sender,
+            'stamps_supplied': stamps
+        }
+    }
+
+
+def nonces(batch):
+    return [(tx['payload']['sender'], tx['payload']['nonce']) for tx in batch]
+
+
+class TestMempool(TestCase):
+    def test_append_increases_len(self):
+        m = Mempool()
+        m.append(make_tx('a', 0))
+        m.append(make_tx('b', 0))
+
+        self.assertEqual(len(m), 2)
+
+    def test_on_add_called_for_accepted_transactions(self):
+        added = []
+        m = Mempool(on_add=lambda: added.append(True))
+
+        m.append(make_tx('a', 0))
+        m.append(make_tx('b', 0))
+
+        # Rejected: same nonce without more stamps
+        m.append(make_tx('a', 0))
+
+        self.assertEqual(len(added), 2)
+
+    def test_select_orders_by_stamps_supplied(self):
+        m = Mempool()
+        m.append(make_tx('a', 0, stamps=10))
+        m.append(make_tx('b', 0, stamps=1000))
+        m.append(make_tx('c', 0, stamps=100))
+
+        self.assertEqual(nonces(m.select()), [('b', 0), ('c', 0), ('a', 0)])
+        self.assertEqual(len(m), 0)
+
+    def test_select_keeps_sender_nonce_order(self):
+        m = Mempool()
+        m.append(make_tx('a', 0, stamps=10))
+        m.append(make_tx('a', 1, stamps=1000))
+        m.append(make_tx('b', 0, stamps=100))
+
+        self.assertEqual(nonces(m.select()), [('b', 0), ('a', 0), ('a', 1)])
+
+    def test_select_respects_tx_number(self):
+        m = Mempool()
+        for i in range(5):
+            m.append(make_tx('a', i))
+
+        self.assertEqual(len(m.select(tx_number=3)), 3)
+        self.assertEqual(len(m), 2)
+        self.assertEqual(nonces(m.select()), [('a', 3), ('a', 4)])
+
+    def test_select_respects_stamp_budget(self):
+        m = Mempool()
+        m.append(make_tx('a', 0, stamps=600))
+        m.append(make_tx('b', 0, stamps=500))
+        m.append(make_tx('c', 0, stamps=300))
+
+        self.assertEqual(nonces(m.select(stamp_budget=1000)), [('a', 0), ('c', 0)])
+        self.assertEqual(nonces(m.select()), [('b', 0)])
+
+    def test_select_stops_at_nonce_gap(self):
+        m = Mempool()
+        m.append(make_tx('a', 0))
+        m.append(make_tx('a', 2))
+
+        self.assertEqual(nonces(m.select()), [('a', 0)])
+        self.assertEqual(len(m), 1)
+
+        m.append(make_tx('a', 1))
+
+        self.assertEqual(nonces(m.select()), [('a', 1), ('a', 2)])
+
+    def test_select_evicts_expired(self):
+        m = Mempool(expiry=5)
+        m.append(make_tx('a', 0, timestamp=int(time.time()) - 10))
+        m.append(make_tx('b', 0))
+
+        self.assertEqual(nonces(m.select()), [('b', 0)])
+        self.assertEqual(m.evicted, 1)
+
+    def test_transactions_after_expired_nonce_held_back(self):
+        m = Mempool(expiry=5)
+        m.append(make_tx('a', 0, timestamp=int(time.time()) - 10))
+        m.append(make_tx('a', 1))
+
+        self.assertEqual(m.select(), [])
+        self.assertEqual(len(m), 1)
+
+    def test_next_nonce_kept_after_sender_emptied(self):
+        m = Mempool()
+        m.append(make_tx('a', 0))
+        m.select()
+
+        m.append(make_tx('a', 2))
+
+        self.assertEqual(m.select(), [])
+
+        m.append(make_tx('a', 1))
+
+        self.assertEqual(nonces(m.select()), [('a', 1), ('a', 2)])
+
+    def test_lower_nonce_after_sender_emptied_starts_over(self):
+        m = Mempool()
+        m.append(make_tx('a', 0))
+        m.append(make_tx('a', 1))
+        m.select()
+
+        # Nonce 0 never made it into a block and was handed out again
+        m.append(make_tx('a', 0))
+
+        self.assertEqual(nonces(m.select()), [('a', 0)])
+
+    def test_evict_releases_lowest_expired_nonce(self):
+        released = []
+        m = Mempool(expiry=5, on_evict=lambda sender, processor, nonce: released.append((sender, nonce)))
+        m.append(make_tx('a', 1, timestamp=int(time.time()) - 10))
+        m.append(make_tx('a', 2, timestamp=int(time.time()) - 10))
+        m.append(make_tx('b', 0))
+
+        m.evict_expired()
+
+        self.assertEqual(released, [('a', 1)])
+        self.assertEqual(m.evicted, 2)
+
+        # The sender can send the expired nonce again
+        m.append(make_tx('a', 1))
+
+        self.assertEqual(nonces(m.select()), [('b', 0), ('a', 1)])
+
+    def test_append_returns_whether_accepted(self):
+        m = Mempool()
+
+        self.assertTrue(m.append(make_tx('a', 0, stamps=100)))
+        self.assertFalse(m.append(make_tx('a', 0, stamps=100)))
+        self.assertTrue(m.append(make_tx('a', 0, stamps=200)))
+        self.assertTrue(m.append(make_tx('a', 1)))
+
+        m.select(tx_number=1)
+
+        # Nonce 0 is already batched while 1 is still waiting
+        self.assertFalse(m.append(make_tx('a', 0, stamps=300)))
+
+    def test_duplicate_nonce_replaced_only_by_higher_stamps(self):
+        m = Mempool()
+        m.append(make_tx('a', 0, stamps=100))
+        m.append(make_tx('a', 0, stamps=50))
+
+        self.assertEqual(m.rejected, 1)
+
+        m.append(make_tx('a', 0, stamps=200))
+
+        self.assertEqual(len(m), 1)
+        self.assertEqual(m.select()[0]['payload']['stamps_supplied'], 200)
+
+    def test_non_transactions_rejected(self):
+        m = Mempool()
+
+        self.assertFalse(m.append('x'))
+        self.assertFalse(m.append({'payload': {}}))
+
+        self.assertEqual(len(m), 0)
+        self.assertEqual(m.rejected, 2)
+
+    def test_restore_puts_back_selected_transactions(self):
+        m = Mempool()
+        m.append(make_tx('a', 0))
+        m.append(make_tx('a', 1))
+        m.append(make_tx('a', 2))
+
+        batch = m.select(tx_number=2)
+        m.restore(batch)
+
+        self.assertEqual(len(m), 3)
+        self.assertEqual(nonces(m.select()), [('a', 0), ('a', 1), ('a', 2)])
+
+    def test_restore_after_sender_emptied(self):
+        m = Mempool()
+        m.append(make_tx('a', 0))
+
+        batch = m.select()
+        m.restore(batch)
+
+        self.assertEqual(nonces(m.select()), [('a', 0)])
+
+    def test_clear_empties(self):
+        m = Mempool(txs=[make_tx('a', 0), make_tx('b', 0)])
+        m.clear()
+
+        self.assertEqual(len(m), 0)
+
+    def test_stats(self):
+        m = Mempool()
+        m.append(make_tx('a', 0))
+        m.append(make_tx('a', 2))
+        m.append(make_tx('b', 0))
+
+        stats = m.stats
+
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['senders'], 2)
+        self.assertEqual(stats['ready'], 2)
@@ -0,0 +1,79 @@
+from lamden.nodes.delegate.pool import WorkerPool, WorkerError
+from unittest import TestCase
+import tempfile
+import os
+
+state = {}
+
+
+def initialize(value):
+    state['value'] = value
+
+
+def add_value(numbers):
+    return [n + state['value'] for n in numbers]
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def crash_once(marker, n):
+    # Exits the worker the first time it is called, then returns normally on the replacement
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+
+    return n
+
+
+class TestWorkerPool(TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(workers=2, initializer=initialize, initargs=(10,))
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_map_returns_results_in_chunk_order(self):
+        chunks = [([i, i + 1],) for i in range(0, 20, 2)]
+
+        results = self.pool.map(add_value, chunks)
+
+        self.assertEqual(results, [[i + 10, i + 11] for i in range(0, 20, 2)])
+
+    def test_map_starts_pool_lazily(self):
+        self.assertFalse(self.pool.started)
+
+        self.pool.map(add_value, [([1],)])
+
+        self.assertTrue(self.pool.started)
+        self.assertEqual(self.pool.stats['alive'], 2)
+
+    def test_map_empty_chunks_returns_empty_list(self):
+        self.assertEqual(self.pool.map(add_value, []), [])
+
+    def test_task_error_raises_worker_error(self):
+        with self.assertRaises(WorkerError):
+            self.pool.map(fail, [('bad',), ('worse',)])
+
+        # The pool is still usable afterwards
+        self.assertEqual(self.pool.map(add_value, [([1],)]), [[11]])
+
+    def test_crashed_worker_is_restarted_and_chunk_rerun(self):
+        with tempfile.TemporaryDirectory() as d:
+            marker = os.path.join(d, 'crashed')
+
+            results = self.pool.map(crash_once, [(marker, 1)])
+
+        self.assertEqual(results, [1])
+        self.assertEqual(self.pool.restarts, 1)
+        self.assertEqual(self.pool.stats['alive'], 2)
+
+    def test_stop_shuts_down_workers(self):
+        self.pool.start()
+        processes = [worker.process for worker in self.pool.workers]
+
+        self.pool.stop()
+
+        self.assertFalse(any(p.is_alive() for p in processes))
+        self.assertFalse(self.pool.started)
@@ -1,10 +1,12 @@
 from unittest import TestCase
 
-from lamden import router, authentication
+from lamden import router, authentication, codec
 
 from lamden.crypto.wallet import Wallet
 import zmq.asyncio
 import asyncio
+import pathlib
+import time
 from contracting.db.encoder import encode, decode
 from contracting.client import ContractingClient
 
@@ -225,6 +227,41 @@ class TestRouter(TestCase):
         self.assertDictEqual(res[1], expected_msg)
 
 
+    def test_request_id_echoed_with_response(self):
+        r = router.Router(socket_id='tcp://127.0.0.1:18001', ctx=self.ctx, linger=50)
+
+        class MockProcessor(router.Processor):
+            async def process_message(self, msg):
+                return {
+                    'whats': 'good'
+                }
+
+        r.add_service('test', MockProcessor())
+
+        async def recieve():
+            msg = await d.recv()
+            return msg
+
+        async def send():
+            await d.send(encode({'service': 'test', 'msg': {'hello': 'there'}, 'id': 7}).encode())
+
+        tasks = asyncio.gather(
+            r.serve(),
+            send(),
+            recieve(),
+            stop_server(r, 0.2)
+        )
+
+        d = self.ctx.socket(zmq.DEALER)
+        d.connect('tcp://127.0.0.1:18001')
+
+        _, _, msg, _ = self.loop.run_until_complete(tasks)
+
+        self.assertDictEqual(decode(msg), {'id': 7, 'msg': {'whats': 'good'}})
+
+        d.close()
+
+
 class TestAsyncServer(TestCase):
     def setUp(self):
         self.ctx = zmq.asyncio.Context()
@@ -588,3 +625,341 @@ class TestJSONAsyncInbox(TestCase):
 
         self.assertEqual(q1.q[0], {'hello': 'there'})
         self.assertEqual(q2.q[0], {'hello': 'there'})
+
+
+class TestSocketPool(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        self.loop.close()
+
+    def test_get_returns_none_if_no_certificate(self):
+        pool = router.SocketPool(ctx=self.ctx, wallet=Wallet())
+
+        self.assertIsNone(pool.get(Wallet().verifying_key, 'tcp://127.0.0.1:10000'))
+
+    def test_get_returns_same_connection_and_caches_certificate(self):
+        authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        w = Wallet()
+        authenticator.add_verifying_key(w.verifying_key)
+
+        pool = router.SocketPool(ctx=self.ctx, wallet=Wallet())
+
+        c1 = pool.get(w.verifying_key, 'tcp://127.0.0.1:10000')
+        c2 = pool.get(w.verifying_key, 'tcp://127.0.0.1:10000')
+
+        self.assertIs(c1, c2)
+        self.assertIn(w.verifying_key, pool.certs)
+
+        authenticator.authenticator.stop()
+
+    def test_retain_evicts_connections_not_in_governance(self):
+        authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        w1 = Wallet()
+        w2 = Wallet()
+        authenticator.add_verifying_key(w1.verifying_key)
+        authenticator.add_verifying_key(w2.verifying_key)
+
+        pool = router.SocketPool(ctx=self.ctx, wallet=Wallet())
+
+        pool.get(w1.verifying_key, 'tcp://127.0.0.1:10000')
+        pool.get(w2.verifying_key, 'tcp://127.0.0.1:10001')
+
+        pool.retain([w1.verifying_key])
+
+        self.assertIn((w1.verifying_key, 'tcp://127.0.0.1:10000'), pool.connections)
+        self.assertNotIn((w2.verifying_key, 'tcp://127.0.0.1:10001'), pool.connections)
+        self.assertNotIn(w2.verifying_key, pool.certs)
+
+        authenticator.authenticator.stop()
+
+    def test_pooled_request_refuses_other_cert_dir(self):
+        pool = router.SocketPool(ctx=self.ctx, wallet=Wallet())
+
+        with self.assertRaises(AssertionError):
+            self.loop.run_until_complete(router.secure_request(
+                msg={}, service='service', wallet=Wallet(), vk=Wallet().verifying_key, ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx, cert_dir=pathlib.Path('/tmp/other'), pool=pool
+            ))
+
+    def test_pooled_request_uses_pool_cert_dir_by_default(self):
+        pool = router.SocketPool(ctx=self.ctx, wallet=Wallet(), cert_dir=pathlib.Path('/tmp/other'))
+
+        # No certificate in the pool's directory, so there is no one to ask
+        res = self.loop.run_until_complete(router.secure_request(
+            msg={}, service='service', wallet=Wallet(), vk=Wallet().verifying_key, ip='tcp://127.0.0.1:10000',
+            ctx=self.ctx, pool=pool
+        ))
+
+        self.assertIsNone(res)
+
+    def test_pooled_send_and_requests_reuse_connection(self):
+        authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        w = Wallet()
+        w2 = Wallet()
+
+        authenticator.add_verifying_key(w.verifying_key)
+        authenticator.add_verifying_key(w2.verifying_key)
+        authenticator.configure()
+
+        class MockProcessor(router.Processor):
+            async def process_message(self, msg):
+                return {
+                    'whats': msg['hello']
+                }
+
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=w
+        )
+
+        m.add_service('something', MockProcessor())
+
+        pool = router.SocketPool(ctx=self.ctx, wallet=w2)
+
+        async def get():
+            await router.secure_send(msg={'hello': 'sent'}, service='something', wallet=w2, vk=w.verifying_key,
+                                     ip='tcp://127.0.0.1:10000', ctx=self.ctx, pool=pool)
+
+            results = []
+            for i in range(3):
+                r = await router.secure_request(msg={'hello': i}, service='something', wallet=w2,
+                                                vk=w.verifying_key, ip='tcp://127.0.0.1:10000', ctx=self.ctx,
+                                                pool=pool)
+                results.append(r)
+
+            return results
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], [{'whats': 0}, {'whats': 1}, {'whats': 2}])
+        self.assertEqual(len(pool.connections), 1)
+
+        pool.close()
+        authenticator.authenticator.stop()
+
+    def test_concurrent_pooled_requests_get_their_own_responses(self):
+        authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        w = Wallet()
+        w2 = Wallet()
+
+        authenticator.add_verifying_key(w.verifying_key)
+        authenticator.add_verifying_key(w2.verifying_key)
+        authenticator.configure()
+
+        class SlowProcessor(router.Processor):
+            async def process_message(self, msg):
+                # Earlier requests answer last
+                await asyncio.sleep(0.05 * (5 - msg['hello']))
+                return {
+                    'whats': msg['hello']
+                }
+
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=w
+        )
+
+        m.add_service('something', SlowProcessor())
+
+        pool = router.SocketPool(ctx=self.ctx, wallet=w2)
+
+        async def get():
+            return await asyncio.gather(*[
+                router.secure_request(msg={'hello': i}, service='something', wallet=w2, vk=w.verifying_key,
+                                      ip='tcp://127.0.0.1:10000', ctx=self.ctx, pool=pool) for i in range(5)
+            ])
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], [{'whats': i} for i in range(5)])
+
+        connection = pool.get(w.verifying_key, 'tcp://127.0.0.1:10000')
+        self.assertEqual(len(connection.pending), 0)
+
+        # The first reply carries the codec the server picked
+        if len(codec.available()) > 0:
+            self.assertEqual(connection.codec, codec.negotiate(codec.available()))
+
+        pool.close()
+        authenticator.authenticator.stop()
+
+
+    def test_closing_connection_ends_pending_requests_without_reply(self):
+        connection = router.Connection(ctx=self.ctx, wallet=Wallet(), server_pub=b'', ip='tcp://127.0.0.1:10000')
+
+        futures = [self.loop.create_future() for _ in range(2)]
+        connection.pending = dict(enumerate(futures))
+
+        async def wait_all():
+            return await asyncio.gather(*[asyncio.wait_for(f, timeout=1) for f in futures])
+
+        async def close_soon():
+            await asyncio.sleep(0.05)
+            connection.close()
+
+        res = self.loop.run_until_complete(asyncio.gather(wait_all(), close_soon()))
+
+        self.assertEqual(res[0], [None, None])
+        self.assertEqual(connection.pending, {})
+
+    def test_request_timeout_keeps_socket_while_other_requests_wait(self):
+        connection = router.Connection(ctx=self.ctx, wallet=Wallet(), server_pub=b'', ip='tcp://127.0.0.1:10000',
+                                       max_failures=1)
+
+        class MockSocket:
+            closed = False
+
+            async def send_multipart(self, msg):
+                pass
+
+            def close(self):
+                self.closed = True
+
+        socket = MockSocket()
+        connection.request_socket = socket
+
+        other = self.loop.create_future()
+        connection.pending[-1] = other
+
+        res = self.loop.run_until_complete(connection.request({'hello': 'there'}, timeout=10))
+
+        self.assertIsNone(res)
+        self.assertFalse(socket.closed)
+        self.assertFalse(other.done())
+
+
+class TestInbox(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_wait_returns_when_item_put(self):
+        inbox = router.Inbox()
+
+        async def late_put():
+            await asyncio.sleep(0.05)
+            inbox.put('hello')
+
+        res = self.loop.run_until_complete(asyncio.gather(inbox.wait(), late_put()))
+
+        self.assertTrue(res[0])
+        self.assertEqual(inbox.q, ['hello'])
+
+    def test_wait_times_out(self):
+        inbox = router.Inbox()
+
+        res = self.loop.run_until_complete(inbox.wait(timeout=0.1))
+
+        self.assertFalse(res)
+
+    def test_notify_wakes_wait_for_direct_appends(self):
+        inbox = router.Inbox()
+
+        async def late_append():
+            await asyncio.sleep(0.05)
+            inbox.q.append('hello')
+            inbox.notify()
+
+        start = time.time()
+        res = self.loop.run_until_complete(asyncio.gather(inbox.wait(timeout=5), late_append()))
+
+        self.assertTrue(res[0])
+        self.assertLess(time.time() - start, 1)
+
+    def test_wait_with_condition(self):
+        inbox = router.Inbox()
+        state = {'ready': False}
+
+        async def set_ready():
+            await asyncio.sleep(0.05)
+            state['ready'] = True
+            inbox.notify()
+
+        res = self.loop.run_until_complete(asyncio.gather(
+            inbox.wait(condition=lambda: state['ready'], timeout=1),
+            set_ready()
+        ))
+
+        self.assertTrue(res[0])
+
+    def test_wakeup_latency_recorded(self):
+        inbox = router.Inbox()
+        inbox.put('hello')
+
+        self.loop.run_until_complete(inbox.wait())
+
+        self.assertEqual(inbox.wakeups, 1)
+        self.assertGreaterEqual(inbox.max_wakeup_latency, inbox.wakeup_latency)
+        self.assertIsNone(inbox.arrived)
+
+    def test_drain_returns_items_and_empties_q(self):
+        inbox = router.Inbox()
+        inbox.put('a')
+        inbox.put('b')
+
+        self.assertEqual(inbox.drain(), ['a', 'b'])
+        self.assertEqual(inbox.q, [])
+
+    def test_put_rejects_newest_past_max_size(self):
+        inbox = router.Inbox(max_size=2)
+        inbox.put('a')
+        inbox.put('b')
+
+        self.assertFalse(inbox.put('c'))
+        self.assertEqual(inbox.q, ['a', 'b'])
+        self.assertEqual(inbox.dropped, 1)
+
+    def test_get_returns_items_in_order(self):
+        inbox = router.Inbox()
+        inbox.put('a')
+        inbox.put('b')
+
+        self.assertEqual(inbox.get(), 'a')
+
+        inbox.put('c')
+
+        self.assertEqual(inbox.get(), 'b')
+        self.assertEqual(inbox.get(), 'c')
+        self.assertFalse(inbox.has_items())
+
+    def test_drain_includes_items_left_by_get(self):
+        inbox = router.Inbox()
+        inbox.put('a')
+        inbox.put('b')
+        inbox.get()
+        inbox.put('c')
+
+        self.assertEqual(inbox.drain(), ['b', 'c'])
+        self.assertEqual(inbox.size(), 0)
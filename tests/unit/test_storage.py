@@ -1,8 +1,11 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from lamden import storage
 from contracting.db.driver import ContractDriver
 from unittest import TestCase
 
 from lamden.storage import BlockStorage
+from pymongo.errors import ServerSelectionTimeoutError
 
 
 class TestNonce(TestCase):
@@ -93,6 +96,99 @@ class TestNonce(TestCase):
 
         self.assertEqual(n, 2)
 
+    def test_set_nonces_sets_all_nonces_in_batch(self):
+        self.nonces.set_nonces({
+            ('test', 'test2'): 2,
+            ('test3', 'test2'): 5
+        })
+
+        self.assertEqual(self.nonces.get_nonce(sender='test', processor='test2'), 2)
+        self.assertEqual(self.nonces.get_nonce(sender='test3', processor='test2'), 5)
+
+    def test_set_nonces_clears_pending_nonces_in_batch(self):
+        self.nonces.set_pending_nonce(
+            sender='test',
+            processor='test2',
+            value=3
+        )
+
+        self.nonces.set_pending_nonce(
+            sender='other',
+            processor='test2',
+            value=7
+        )
+
+        self.nonces.set_nonces({
+            ('test', 'test2'): 3
+        })
+
+        self.assertIsNone(self.nonces.get_pending_nonce(sender='test', processor='test2'))
+        self.assertEqual(self.nonces.get_pending_nonce(sender='other', processor='test2'), 7)
+
+    def test_set_nonces_empty_batch_does_nothing(self):
+        self.nonces.set_nonces({})
+
+        self.assertIsNone(self.nonces.get_nonce(sender='test', processor='test2'))
+
+    def test_second_read_is_served_from_cache(self):
+        self.nonces.set_nonce(
+            sender='test',
+            processor='test2',
+            value=2
+        )
+
+        self.nonces.nonces.drop()
+
+        n = self.nonces.get_nonce(sender='test', processor='test2')
+
+        self.assertEqual(n, 2)
+        self.assertEqual(self.nonces.nonce_cache.hits, 1)
+
+    def test_missing_nonce_cached_after_first_read(self):
+        self.nonces.get_nonce(sender='test', processor='test2')
+        self.nonces.get_nonce(sender='test', processor='test2')
+
+        self.assertEqual(self.nonces.nonce_cache.misses, 1)
+        self.assertEqual(self.nonces.nonce_cache.hits, 1)
+
+    def test_set_nonces_updates_cache(self):
+        self.nonces.set_pending_nonce(sender='test', processor='test2', value=3)
+        self.nonces.get_nonce(sender='test', processor='test2')
+
+        self.nonces.set_nonces({
+            ('test', 'test2'): 3
+        })
+
+        self.assertEqual(self.nonces.nonce_cache.get(('test', 'test2')), 3)
+        self.assertIsNone(self.nonces.pending_nonce_cache.get(('test', 'test2')))
+
+    def test_write_during_cache_fill_is_not_overwritten(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+        self.nonces.nonce_cache.clear()
+
+        get_one = self.nonces.get_one
+
+        # A block commits between the Mongo read and the cache fill
+        def get_one_then_commit(sender, processor, db):
+            value = get_one(sender, processor, db)
+            self.nonces.set_nonces({('test', 'test2'): 3})
+            return value
+
+        self.nonces.get_one = get_one_then_commit
+
+        self.assertEqual(self.nonces.get_nonce(sender='test', processor='test2'), 3)
+
+        del self.nonces.get_one
+
+        self.assertEqual(self.nonces.get_nonce(sender='test', processor='test2'), 3)
+
+    def test_flush_clears_cache(self):
+        self.nonces.set_nonce(sender='test', processor='test2', value=2)
+
+        self.nonces.flush()
+
+        self.assertIsNone(self.nonces.get_nonce(sender='test', processor='test2'))
+
 
 class TestStorage(TestCase):
     def setUp(self):
@@ -567,10 +663,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block)
@@ -585,10 +681,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -603,10 +699,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -707,3 +803,216 @@ class TestMasterStorage(TestCase):
 
     def test_get_block_v_none_returns_none(self):
         self.assertIsNone(self.db.get_block())
+
+    def test_store_block_twice_does_not_duplicate_block_or_txs(self):
+        tx_1 = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx_1]
+                }
+            ]
+        }
+
+        self.db.store_block(block)
+        self.db.store_block(block)
+
+        self.assertEqual(self.db.blocks.count_documents({'hash': 'hello'}), 1)
+        self.assertEqual(self.db.txs.count_documents({'hash': 'something1'}), 1)
+
+    def test_store_block_ordered_stores_txs_and_block(self):
+        tx_1 = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx_1]
+                }
+            ]
+        }
+
+        self.db.store_block(block, ordered=True)
+
+        self.assertDictEqual(tx_1, self.db.get_tx(h='something1'))
+        self.assertDictEqual(block, self.db.get_block('hello'))
+
+    def test_store_block_no_txs_stores_block(self):
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': []
+        }
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(block, self.db.get_block(1))
+
+    def test_store_block_records_write_latency(self):
+        self.assertIsNone(self.db.last_write_latency)
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': []
+        }
+
+        latency = self.db.store_block(block)
+
+        self.assertEqual(latency, self.db.last_write_latency)
+        self.assertGreaterEqual(latency, 0)
+
+
+class TestAsyncStorage(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.db = BlockStorage()
+        self.nonces = storage.NonceStorage()
+
+        self.async_db = storage.AsyncBlockStorage(self.db)
+        self.async_nonces = storage.AsyncNonceStorage(self.nonces)
+
+    def tearDown(self):
+        self.db.drop_collections()
+        self.nonces.flush()
+        self.loop.close()
+
+    def test_get_block_awaits_stored_block(self):
+        block = {
+            'hash': 'a',
+            'number': 1,
+            'subblocks': []
+        }
+
+        self.db.store_block(block)
+
+        got_block = self.loop.run_until_complete(self.async_db.get_block(1))
+
+        self.assertEqual(block, got_block)
+
+    def test_store_block_then_get_tx(self):
+        tx = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        block = {
+            'hash': 'a',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx]
+                }
+            ]
+        }
+
+        self.loop.run_until_complete(self.async_db.store_block(block))
+
+        got_tx = self.loop.run_until_complete(self.async_db.get_tx('something1'))
+
+        self.assertEqual(tx, got_tx)
+
+    def test_set_then_get_latest_nonce(self):
+        self.loop.run_until_complete(self.async_nonces.set_pending_nonce(sender='test', processor='test2', value=3))
+
+        n = self.loop.run_until_complete(self.async_nonces.get_latest_nonce(sender='test', processor='test2'))
+
+        self.assertEqual(n, 3)
+        self.assertEqual(self.nonces.get_pending_nonce(sender='test', processor='test2'), 3)
+
+    def test_wrappers_share_executor_unless_given_one(self):
+        self.assertIs(self.async_db.executor, self.async_nonces.executor)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        async_db = storage.AsyncBlockStorage(self.db, executor=executor)
+
+        self.assertIs(async_db.executor, executor)
+
+        executor.shutdown()
+
+
+class TestIndexes(TestCase):
+    def setUp(self):
+        self.db = BlockStorage()
+        self.nonces = storage.NonceStorage()
+
+    def tearDown(self):
+        self.db.drop_collections()
+        self.nonces.flush()
+
+    def test_block_storage_has_no_missing_indexes_after_init(self):
+        missing = self.db.missing_indexes()
+
+        self.assertEqual(missing, {'blocks': [], 'tx': []})
+
+    def test_nonce_storage_has_no_missing_indexes_after_init(self):
+        missing = self.nonces.missing_indexes()
+
+        self.assertEqual(missing, {'nonces': [], 'pending_nonces': []})
+
+    def test_indexes_recreated_after_drop(self):
+        self.db.drop_collections()
+        self.nonces.flush()
+
+        self.assertEqual(self.db.missing_indexes(), {'blocks': [], 'tx': []})
+        self.assertEqual(self.nonces.missing_indexes(), {'nonces': [], 'pending_nonces': []})
+
+    def test_missing_index_reported_then_rebuilt(self):
+        self.db.blocks.drop_index('number_unique')
+
+        self.assertEqual(self.db.missing_indexes()['blocks'], ['number_unique'])
+
+        self.db.rebuild_indexes()
+
+        self.assertEqual(self.db.missing_indexes()['blocks'], [])
+
+    def test_rebuild_refuses_to_drop_index_when_duplicates_exist(self):
+        self.db.blocks.drop_index('number_unique')
+        self.db.blocks.insert_many([
+            {'hash': 'a', 'number': 1},
+            {'hash': 'b', 'number': 1}
+        ])
+
+        errors = self.db.rebuild_indexes()
+
+        self.assertEqual(len(errors), 1)
+        self.assertIn('number_unique', errors[0])
+
+        # number_unique cannot be built over the duplicates, so it is still the only missing index
+        self.assertEqual(self.db.missing_indexes()['blocks'], ['number_unique'])
+
+    def test_create_indexes_reports_unreachable_mongo(self):
+        class UnreachableCollection:
+            name = 'blocks'
+            calls = 0
+
+            def create_index(self, *args, **kwargs):
+                self.calls += 1
+                raise ServerSelectionTimeoutError('no servers')
+
+        collection = UnreachableCollection()
+
+        errors = storage.create_indexes(collection, storage.BLOCK_INDEXES)
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(collection.calls, 1)
+
+    def test_store_block_with_conflicting_number_not_stored(self):
+        self.db.store_block({'hash': 'a', 'number': 1, 'subblocks': []})
+
+        res = self.db.store_block({'hash': 'b', 'number': 1, 'subblocks': []})
+
+        self.assertIsNone(res)
+        self.assertIsNone(self.db.get_block('b'))
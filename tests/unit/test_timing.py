@@ -0,0 +1,88 @@
+from lamden.timing import AdaptiveTimeout
+from unittest import TestCase
+
+
+class TestAdaptiveTimeout(TestCase):
+    def test_initial_timeout_used_without_samples(self):
+        t = AdaptiveTimeout(initial=7)
+
+        self.assertEqual(t.timeout(['a', 'b']), 7)
+
+    def test_timeout_is_slowest_peer_percentile_times_margin(self):
+        t = AdaptiveTimeout(minimum=0, margin=2)
+
+        for i in range(100):
+            t.record('a', 1)
+            t.record('b', 2)
+
+        self.assertEqual(t.timeout(['a', 'b']), 4)
+        self.assertEqual(t.timeout(['a']), 2)
+
+    def test_percentile_ignores_outliers(self):
+        t = AdaptiveTimeout(minimum=0, margin=1, percentile=0.9)
+
+        for i in range(9):
+            t.record('a', 1)
+        t.record('a', 100)
+
+        self.assertEqual(t.peer_latency('a'), 1)
+
+    def test_timeout_is_clamped(self):
+        t = AdaptiveTimeout(minimum=1, maximum=5, margin=1)
+
+        t.record('a', 0.01)
+        self.assertEqual(t.timeout(), 1)
+
+        t.record('b', 50)
+        self.assertEqual(t.timeout(), 5)
+
+    def test_peers_without_samples_do_not_stretch_timeout(self):
+        t = AdaptiveTimeout(minimum=0, margin=1)
+
+        t.record('a', 2)
+
+        self.assertEqual(t.timeout(['a', 'offline']), 2)
+
+    def test_missed_round_backs_off_until_complete_round(self):
+        t = AdaptiveTimeout(minimum=0, margin=1)
+
+        t.record('a', 2)
+        t.record('b', 2)
+        t.timeout(['a', 'b'])
+
+        t.finish(missing=['b'])
+        self.assertEqual(t.timeout(['a', 'b']), 4)
+
+        t.record('a', 2)
+        t.record('b', 2)
+        t.finish()
+
+        self.assertEqual(t.timeout(['a', 'b']), 2)
+        self.assertEqual(t.stats['timeouts'], 1)
+
+    def test_offline_peer_stops_backing_off_after_patience(self):
+        t = AdaptiveTimeout(minimum=0, margin=1, patience=2)
+
+        t.record('a', 2)
+        t.record('b', 2)
+
+        timeouts = []
+        for i in range(5):
+            timeouts.append(t.timeout(['a', 'b']))
+            t.record('a', 2)
+            t.finish(missing=['b'])
+
+        self.assertEqual(timeouts, [2, 4, 8, 2, 2])
+
+    def test_early_round_does_not_back_off(self):
+        t = AdaptiveTimeout(minimum=0, margin=1)
+
+        t.record('a', 2)
+        t.record('b', 2)
+        t.timeout(['a', 'b'])
+
+        t.finish(missing=['b'], early=True)
+
+        self.assertEqual(t.timeout(['a', 'b']), 2)
+        self.assertEqual(t.stats['early'], 1)
+        self.assertEqual(t.stats['timeouts'], 0)
@@ -1,6 +1,8 @@
 from unittest import TestCase
-from lamden.crypto.wallet import Wallet, verify
+from lamden.crypto.wallet import Wallet, verify, verify_many, verify_many_async, VERIFIED
 from lamden.crypto.zbase import bytes_to_zbase32
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 
 
 class TestWallet(TestCase):
@@ -83,4 +85,85 @@ class TestWallet(TestCase):
 
         b = 'priv_' + bytes_to_zbase32(bytes.fromhex(w.signing_key))[:-4]
 
-        self.assertEqual(w.sk_pretty, b)
\ No newline at end of file
+        self.assertEqual(w.sk_pretty, b)
+
+    def test_verify_many_returns_results_in_order(self):
+        w = Wallet()
+
+        triples = [
+            (w.verifying_key, 'a', w.sign('a')),
+            (w.verifying_key, 'b', w.sign('a')),
+            (Wallet().verifying_key, 'c', w.sign('c')),
+            (w.verifying_key, 'd', w.sign('d'))
+        ]
+
+        self.assertEqual(verify_many(triples), [True, False, False, True])
+
+    def test_verify_many_malformed_triples_are_false(self):
+        w = Wallet()
+
+        triples = [
+            None,
+            ('zz', 'a', w.sign('a')),
+            (w.verifying_key, 'a', 'zz'),
+            (w.verifying_key, 'a', w.sign('a'))
+        ]
+
+        self.assertEqual(verify_many(triples), [False, False, False, True])
+
+    def test_verify_many_with_executor_matches_serial(self):
+        w = Wallet()
+
+        triples = [(w.verifying_key, str(i), w.sign(str(i // 2 * 2))) for i in range(600)]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(verify_many(triples, executor=executor), verify_many(triples))
+
+    def test_verify_many_async_with_executor_matches_serial(self):
+        w = Wallet()
+
+        triples = [(w.verifying_key, str(i), w.sign(str(i // 2 * 2))) for i in range(600)]
+
+        loop = asyncio.new_event_loop()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            res = loop.run_until_complete(verify_many_async(triples, executor=executor))
+        loop.close()
+
+        self.assertEqual(res, verify_many(triples))
+
+    def test_verified_signature_is_cached(self):
+        w = Wallet()
+        signature = w.sign('cached')
+
+        self.assertTrue(verify(w.verifying_key, 'cached', signature))
+
+        hits = VERIFIED.hits
+        self.assertTrue(verify(w.verifying_key, 'cached', signature))
+        self.assertEqual(VERIFIED.hits, hits + 1)
+
+    def test_invalid_signature_is_not_cached(self):
+        w = Wallet()
+        signature = w.sign('cached')
+
+        size = len(VERIFIED)
+        self.assertFalse(verify(w.verifying_key, 'not cached', signature))
+        self.assertEqual(len(VERIFIED), size)
+
+    def test_cached_signature_does_not_match_shifted_triple(self):
+        w = Wallet()
+        signature = w.sign('shifted')
+
+        self.assertTrue(verify(w.verifying_key, 'shifted', signature))
+        self.assertEqual(verify_many([(w.verifying_key + signature[:2], 'shifted', signature[2:])]), [False])
+
+    def test_verify_many_with_executor_records_results(self):
+        w = Wallet()
+
+        triples = [(w.verifying_key, f'record {i}', w.sign(f'record {i}')) for i in range(300)]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            verify_many(triples, executor=executor)
+
+        hits = VERIFIED.hits
+        self.assertTrue(all(verify_many(triples)))
+        self.assertEqual(VERIFIED.hits, hits + 300)